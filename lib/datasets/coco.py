@@ -296,6 +296,8 @@ class coco(imdb):
         ds_utils.validate_boxes(boxes, width=width, height=height)
         overlaps = scipy.sparse.csr_matrix(overlaps)
         return {'boxes' : boxes,
+                'width' : width,
+                'height' : height,
                 'gt_classes': gt_classes,
                 'gt_overlaps' : overlaps,
                 'flipped' : False,
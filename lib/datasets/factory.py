@@ -11,6 +11,7 @@ __sets = {}
 
 from datasets.pascal_voc import pascal_voc
 from datasets.coco import coco
+from datasets.packed_dataset import packed_dataset
 import numpy as np
 
 # Set up voc_<year>_<split> using selective search "fast" mode
@@ -33,7 +34,10 @@ for year in ['2015']:
         __sets[name] = (lambda split=split, year=year: coco(split, year))
 
 def get_imdb(name):
-    """Get an imdb (image database) by name."""
+    """Get an imdb (image database) by name, or a packed one (see
+    tools/pack_dataset.py) by 'packed:<directory>'."""
+    if name.startswith('packed:'):
+        return packed_dataset(name[len('packed:'):])
     if not __sets.has_key(name):
         raise KeyError('Unknown dataset: {}'.format(name))
     return __sets[name]()
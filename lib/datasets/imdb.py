@@ -8,7 +8,7 @@
 import os
 import os.path as osp
 import PIL
-from utils.cython_bbox import bbox_overlaps
+from utils.cython_overlaps import bbox_overlaps, bbox_overlaps_max
 import numpy as np
 import scipy.sparse
 from fast_rcnn.config import cfg
@@ -95,9 +95,21 @@ class imdb(object):
         """
         raise NotImplementedError
 
+    def image_size_at(self, i):
+        """(width, height) of image i, taken from its roidb entry if the
+        annotations gave it, else read from the image file."""
+        if i < len(self.roidb):
+            entry = self.roidb[i]
+            if 'width' in entry and 'height' in entry:
+                return entry['width'], entry['height']
+        return PIL.Image.open(self.image_path_at(i)).size
+
+    def image_sizes(self):
+        """(width, height) of every image."""
+        return [self.image_size_at(i) for i in xrange(self.num_images)]
+
     def _get_widths(self):
-      return [PIL.Image.open(self.image_path_at(i)).size[0]
-              for i in xrange(self.num_images)]
+      return [w for w, _ in self.image_sizes()]
 
     def append_flipped_images(self):
         num_images = self.num_images
@@ -113,6 +125,9 @@ class imdb(object):
                      'gt_overlaps' : self.roidb[i]['gt_overlaps'],
                      'gt_classes' : self.roidb[i]['gt_classes'],
                      'flipped' : True}
+            if 'height' in self.roidb[i]:
+                entry['width'] = widths[i]
+                entry['height'] = self.roidb[i]['height']
             self.roidb.append(entry)
         self._image_index = self._image_index * 2
 
@@ -218,10 +233,10 @@ class imdb(object):
             if gt_roidb is not None and gt_roidb[i]['boxes'].size > 0:
                 gt_boxes = gt_roidb[i]['boxes']
                 gt_classes = gt_roidb[i]['gt_classes']
-                gt_overlaps = bbox_overlaps(boxes.astype(np.float),
-                                            gt_boxes.astype(np.float))
-                argmaxes = gt_overlaps.argmax(axis=1)
-                maxes = gt_overlaps.max(axis=1)
+                # one thread: small per-image inputs, and the lazy roidb
+                # may run this in forked prefetch workers
+                argmaxes, maxes, _, _ = bbox_overlaps_max(
+                    boxes.astype(np.float), gt_boxes, num_threads=1)
                 I = np.where(maxes > 0)[0]
                 overlaps[I, gt_classes[argmaxes[I]]] = maxes[I]
 
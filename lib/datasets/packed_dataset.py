@@ -0,0 +1,202 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""An imdb and its roidb packed into memory-mapped files.
+
+pack_imdb (see tools/pack_dataset.py) writes, into one directory:
+  - meta.pkl: name, classes, image index and paths, proposal method, the
+    TRAIN.SCALES / TRAIN.MAX_SIZE the images were resized for, and which
+    optional roidb fields were packed
+  - images_<k>.bin: uint8 BGR images, resized for every scale, in shards of
+    images_per_shard images
+  - index.npy: N x S x 4 (shard, offset, height, width) of image i resized
+    for scale s, for O(1) access by roidb index
+  - im_scales.npy: N x S scale factors; sizes.npy: N x 2 (width, height)
+  - <field>.npy and <field>_offsets.npy: the rows of a roidb field (boxes,
+    gt_classes, seg_areas, ...) of all images, image i owning rows
+    offsets[i]:offsets[i + 1]; gt_overlaps is stored as its one nonzero
+    (class, overlap) per row
+
+Only unflipped entries are packed. packed_dataset flips them from the
+stored widths, and flipped entries read mirrored views of the same images.
+Its entries carry a 'packed' (images, index) pair that
+roi_data_layer.minibatch reads instead of decoding entry['image'].
+"""
+
+from datasets.imdb import imdb
+from fast_rcnn.config import cfg
+from utils.blob import get_im_scale
+import numpy as np
+import scipy.sparse
+import cPickle
+import cv2
+import os
+
+# rows of these fields follow the boxes of an image
+BOX_FIELDS = ('boxes', 'gt_classes', 'seg_areas')
+# fields with rows of their own (one per gt box)
+OTHER_FIELDS = ('train_boxes_size',)
+
+class PackedImages(object):
+    """Resized images of a packed dataset, read through np.memmap."""
+    def __init__(self, path, meta):
+        self._scales = tuple(meta['scales'])
+        self._max_size = meta['max_size']
+        self._shards = [
+            np.memmap(os.path.join(path, 'images_{}.bin'.format(k)),
+                      dtype=np.uint8, mode='r')
+            for k in xrange(meta['num_shards'])]
+        self._index = np.load(os.path.join(path, 'index.npy'))
+        self._im_scales = np.load(os.path.join(path, 'im_scales.npy'))
+
+    def imread(self, i, target_size, max_size):
+        """The uint8 BGR image i resized for target_size, and its scale."""
+        assert target_size in self._scales and max_size == self._max_size, \
+            'Images packed for scales {} and max size {}, not {} and {}' \
+            .format(self._scales, self._max_size, target_size, max_size)
+        s = self._scales.index(target_size)
+        shard, offset, height, width = self._index[i, s]
+        im = self._shards[shard][offset:offset + height * width * 3]
+        return im.reshape((height, width, 3)), self._im_scales[i, s]
+
+    def im_for_blob(self, i, flipped, target_size, max_size):
+        """Image i, flipped if asked, mean subtracted and scaled for a blob,
+        and its scale."""
+        im, im_scale = self.imread(i, target_size, max_size)
+        if flipped:
+            im = im[:, ::-1, :]
+        im = im.astype(np.float32)
+        im -= cfg.PIXEL_MEANS
+        return im, im_scale
+
+class packed_dataset(imdb):
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.pkl'), 'rb') as f:
+            meta = cPickle.load(f)
+        imdb.__init__(self, meta['name'])
+        self._path = path
+        self._meta = meta
+        self._classes = meta['classes']
+        self._image_index = list(meta['image_index'])
+        self._image_paths = meta['image_paths']
+        self._sizes = np.load(os.path.join(path, 'sizes.npy'))
+        self._images = PackedImages(path, meta)
+        self._roidb_handler = self.packed_roidb
+
+    def image_path_at(self, i):
+        """
+        Return the absolute path the image was packed from.
+        """
+        return self._image_paths[i % len(self._image_paths)]
+
+    def image_size_at(self, i):
+        return tuple(self._sizes[i % len(self._sizes)])
+
+    def set_proposal_method(self, method):
+        assert method == self._meta['proposal_method'], \
+            'Packed with proposal method {}, not {}'.format(
+                self._meta['proposal_method'], method)
+
+    def packed_roidb(self):
+        """
+        Return the packed roidb, one entry per packed image.
+        """
+        fields = {}
+        for field in BOX_FIELDS + ('overlap_classes', 'overlaps') + \
+                tuple(self._meta['other_fields']):
+            fields[field] = (
+                np.load(os.path.join(self._path, field + '.npy'),
+                        mmap_mode='r'),
+                np.load(os.path.join(self._path, field + '_offsets.npy')))
+        roidb = []
+        for i in xrange(len(self._image_paths)):
+            entry = {'flipped': False, 'packed': (self._images, i)}
+            for field, (rows, offsets) in fields.iteritems():
+                entry[field] = np.array(rows[offsets[i]:offsets[i + 1]])
+            num_boxes = entry['boxes'].shape[0]
+            entry['gt_overlaps'] = scipy.sparse.csr_matrix(
+                (entry.pop('overlaps'),
+                 (np.arange(num_boxes), entry.pop('overlap_classes'))),
+                shape=(num_boxes, self.num_classes), dtype=np.float32)
+            roidb.append(entry)
+        return roidb
+
+    def append_flipped_images(self):
+        num_images = self.num_images
+        imdb.append_flipped_images(self)
+        for i in xrange(num_images):
+            self.roidb[num_images + i]['packed'] = self.roidb[i]['packed']
+
+def _write_field(path, field, arrays):
+    offsets = np.cumsum([0] + [a.shape[0] for a in arrays])
+    np.save(os.path.join(path, field + '.npy'), np.concatenate(arrays))
+    np.save(os.path.join(path, field + '_offsets.npy'), offsets)
+
+def pack_imdb(imdb, path, images_per_shard=1000):
+    """Pack imdb, its roidb from its current proposal method and its images
+    resized for cfg.TRAIN.SCALES and cfg.TRAIN.MAX_SIZE, into path."""
+    if not os.path.exists(path):
+        os.makedirs(path)
+    roidb = imdb.roidb
+    num_images = imdb.num_images
+    scales = tuple(cfg.TRAIN.SCALES)
+    index = np.zeros((num_images, len(scales), 4), dtype=np.int64)
+    im_scales = np.zeros((num_images, len(scales)))
+    sizes = np.zeros((num_images, 2), dtype=np.int64)
+    shard_file = None
+    for i in xrange(num_images):
+        shard = i // images_per_shard
+        if i % images_per_shard == 0:
+            if shard_file is not None:
+                shard_file.close()
+            shard_file = open(
+                os.path.join(path, 'images_{}.bin'.format(shard)), 'wb')
+        im = cv2.imread(imdb.image_path_at(i))
+        assert im is not None, \
+            'Cannot read image {}'.format(imdb.image_path_at(i))
+        sizes[i] = im.shape[1], im.shape[0]
+        for s, target_size in enumerate(scales):
+            im_scale = get_im_scale(im.shape, target_size, cfg.TRAIN.MAX_SIZE)
+            resized = cv2.resize(im, None, None, fx=im_scale, fy=im_scale,
+                                 interpolation=cv2.INTER_LINEAR)
+            index[i, s] = (shard, shard_file.tell(), resized.shape[0],
+                           resized.shape[1])
+            im_scales[i, s] = im_scale
+            shard_file.write(np.ascontiguousarray(resized).tostring())
+        if (i + 1) % 1000 == 0:
+            print 'packed {:d}/{:d}'.format(i + 1, num_images)
+    if shard_file is not None:
+        shard_file.close()
+    np.save(os.path.join(path, 'index.npy'), index)
+    np.save(os.path.join(path, 'im_scales.npy'), im_scales)
+    np.save(os.path.join(path, 'sizes.npy'), sizes)
+
+    for field in BOX_FIELDS:
+        _write_field(path, field, [entry[field] for entry in roidb])
+    # one nonzero per row in gt_overlaps
+    overlaps = [entry['gt_overlaps'].toarray() for entry in roidb]
+    _write_field(path, 'overlap_classes',
+                 [o.argmax(axis=1).astype(np.int32) for o in overlaps])
+    _write_field(path, 'overlaps',
+                 [o.max(axis=1) if o.shape[0] > 0 else
+                  np.zeros((0,), dtype=o.dtype) for o in overlaps])
+    other_fields = [field for field in OTHER_FIELDS if field in roidb[0]]
+    for field in other_fields:
+        _write_field(path, field, [entry[field] for entry in roidb])
+
+    meta = {'name': imdb.name,
+            'classes': imdb.classes,
+            'image_index': imdb.image_index,
+            'image_paths': [imdb.image_path_at(i)
+                            for i in xrange(num_images)],
+            'proposal_method': imdb.roidb_handler.__name__[:-len('_roidb')],
+            'scales': scales,
+            'max_size': cfg.TRAIN.MAX_SIZE,
+            'num_shards': -(-num_images // images_per_shard),
+            'other_fields': other_fields}
+    with open(os.path.join(path, 'meta.pkl'), 'wb') as f:
+        cPickle.dump(meta, f, cPickle.HIGHEST_PROTOCOL)
@@ -241,6 +241,8 @@ class pascal_voc(imdb):
         overlaps = scipy.sparse.csr_matrix(overlaps)
 
         return {'boxes' : boxes,
+                'width' : width,
+                'height' : height,
                 'train_boxes_size' : train_boxes_size,
                 'gt_classes': gt_classes,
                 'gt_overlaps' : overlaps,
@@ -73,3 +73,32 @@ def clip_boxes(boxes, im_shape):
     # y2 < im_shape[0]
     boxes[:, 3::4] = np.maximum(np.minimum(boxes[:, 3::4], im_shape[0] - 1), 0)
     return boxes
+
+def expand_bbox_targets(bbox_target_data, num_reg_class, agnostic,
+                        inside_weights):
+    """Expand compact N x (class, tx, ty, tw, th) regression targets into the
+    4-of-4*K representation used by the network (i.e. only one class has
+    non-zero targets), and the loss weights alike.
+
+    The targets of each foreground row are scattered into columns
+    4 * cls + [0..3], or 4..7 if agnostic, in one fancy-indexed assignment.
+
+    Arguments:
+        bbox_target_data (ndarray): N x 5 compact targets
+        num_reg_class (int): K, the number of column groups of the output
+        agnostic (bool): one foreground group (columns 4..7) for all classes
+        inside_weights (tuple): the 4 loss weights of a foreground row
+
+    Returns:
+        bbox_targets (ndarray): N x 4K blob of regression targets
+        bbox_inside_weights (ndarray): N x 4K blob of loss weights
+    """
+    clss = bbox_target_data[:, 0].astype(np.int)
+    bbox_targets = np.zeros((clss.size, 4 * num_reg_class), dtype=np.float32)
+    bbox_inside_weights = np.zeros(bbox_targets.shape, dtype=np.float32)
+    inds = np.where(clss > 0)[0]
+    groups = np.ones_like(inds) if agnostic else clss[inds]
+    cols = 4 * groups[:, np.newaxis] + np.arange(4)
+    bbox_targets[inds[:, np.newaxis], cols] = bbox_target_data[inds, 1:]
+    bbox_inside_weights[inds[:, np.newaxis], cols] = inside_weights
+    return bbox_targets, bbox_inside_weights
@@ -40,6 +40,13 @@ __C.TRAIN.num_rfcn_regions = 49
 __C.TRAIN.num_samples = 9
 __C.TRAIN.save_feat = 500
 __C.TRAIN.num_classes = 21
+# (seed, sample offset) pairs gathered at once for rfcn_region_weights
+__C.TRAIN.region_weights_chunk = 65536
+# Bucket regions with the per-class bound_%d.mat files instead of bound.mat
+__C.TRAIN.class_bounds = False
+# Which RoI owns a pixel covered by several in the dense box annotation
+# layers: 'area' (smallest RoI) or 'score' (highest class score)
+__C.TRAIN.box_anno_overlap = 'area'
 # Scales to use during training (can list multiple scales)
 # Each scale is the pixel size of an image's shortest side
 __C.TRAIN.SCALES = (600,)
@@ -81,9 +88,15 @@ __C.TRAIN.SNAPSHOT_ITERS = 10000
 # infix to yield the path: <prefix>[_<infix>]_iters_XYZ.caffemodel
 __C.TRAIN.SNAPSHOT_INFIX = ''
 
-# Use a prefetch thread in roi_data_layer.layer
-# So far I haven't found this useful; likely more engineering work is required
+# Build minibatches in worker processes in roi_data_layer.layer
 __C.TRAIN.USE_PREFETCH = False
+# Number of prefetch worker processes
+__C.TRAIN.PREFETCH_WORKERS = 2
+# Minibatches queued ahead of the solver, over all workers
+__C.TRAIN.PREFETCH_DEPTH = 4
+# Build prefetched data blobs in shared memory slots instead of sending them
+# through the queues
+__C.TRAIN.PREFETCH_SHARED_BLOBS = True
 
 # Normalize the targets (subtract empirical mean, divide by empirical stddev)
 __C.TRAIN.BBOX_NORMALIZE_TARGETS = True
@@ -150,10 +163,28 @@ __C.TEST.SCALES = (600,)
 # Max pixel size of the longest side of a scaled input image
 __C.TEST.MAX_SIZE = 1000
 
+# Images per forward in test_net ('rcnn' mode, single test scale); images are
+# grouped by aspect ratio to keep the padding small
+__C.TEST.IMS_PER_BATCH = 1
+
 # Overlap threshold used for non-maximum suppression (suppress boxes with
 # IoU >= this threshold)
 __C.TEST.NMS = 0.3
 
+# NMS variant: 'hard' (greedy NMS), 'linear' or 'gaussian' (Soft-NMS, which
+# decays the scores of overlapping boxes instead of removing them), or
+# 'vote' (greedy NMS, then each kept box is refined by box voting)
+__C.TEST.NMS_MODE = 'hard'
+
+# Soft-NMS: Gaussian decay exp(-IoU^2 / sigma)
+__C.TEST.SOFT_NMS_SIGMA = 0.5
+
+# Soft-NMS: boxes whose decayed score falls below this are dropped
+__C.TEST.SOFT_NMS_MIN_SCORE = 0.001
+
+# Box voting: boxes with IoU >= this with a kept box vote for its position
+__C.TEST.BBOX_VOTE_THRESH = 0.5
+
 # Experimental: treat the (K+1) units in the cls_score layer as linear
 # predictors (trained, eg, with one-vs-rest SVMs).
 __C.TEST.SVM = False
@@ -179,6 +210,14 @@ __C.TEST.RPN_MIN_SIZE = 16
 # whether use class aware box or not
 __C.TEST.AGNOSTIC = False
 
+## Seed points of the box_prediction decoder: pixels whose best foreground
+## score is above SEED_THRESH, at most SEED_TOP_K of them (0 keeps all)
+__C.TEST.SEED_THRESH = 0.7
+__C.TEST.SEED_TOP_K = 0
+## Blobs read by im_detect_boxcls: class scores, region scores and region
+## offsets, all 1 x C x H x W maps
+__C.TEST.BOXCLS_BLOBS = ['cls_prob', 'bbox_cls', 'bbox_reg']
+
 
 #
 # MISC
@@ -220,9 +259,29 @@ __C.EXP_DIR = 'default'
 # Use GPU implementation of non-maximum suppression
 __C.USE_GPU_NMS = True
 
+# NMS backend: 'greedy' (cpu_nms), 'bitmask' (cpu_nms_bitmask), 'python'
+# (py_cpu_nms), 'gpu' (gpu_nms), or 'auto' for the fastest available one per
+# box count, calibrated once and cached in NMS_AUTOTUNE_FILE
+__C.NMS_BACKEND = 'auto'
+
+# Autotune cache; empty for DATA_DIR/cache/nms_autotune.json
+__C.NMS_AUTOTUNE_FILE = ''
+
 # Default GPU device id
 __C.GPU_ID = 0
 
+# Shifted anchor grids (and inside-image anchor indices) kept per feature map
+# size, see rpn.anchor_grid
+__C.ANCHOR_CACHE_SIZE = 32
+
+# Decoded images kept in memory by utils.image_cache, in bytes per process
+# (0 for none). Every prefetch worker holds its own cache, so with
+# TRAIN.USE_PREFETCH this takes up to TRAIN.PREFETCH_WORKERS times as much RAM
+__C.IMAGE_CACHE_BYTES = 0
+# Directory of the on-disk tier of utils.image_cache, holding decoded
+# (training: resized) uint8 images as memory-mapped .npy files ('' for none)
+__C.IMAGE_CACHE_DIR = ''
+
 
 def get_output_dir(imdb, net=None):
     """Return the directory where experimental artifacts are placed.
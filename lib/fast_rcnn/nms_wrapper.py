@@ -5,16 +5,220 @@
 # Written by Ross Girshick
 # --------------------------------------------------------
 
+import json
+import os
+import os.path as osp
+import socket
+import numpy as np
 from fast_rcnn.config import cfg
-from nms.gpu_nms import gpu_nms
-from nms.cpu_nms import cpu_nms
+from nms.cpu_nms import cpu_nms, cpu_nms_bitmask, cpu_nms_multiclass, \
+    cpu_soft_nms_multiclass, cpu_box_voting
+from nms.py_cpu_nms import py_cpu_nms
+from utils.timer import Timer
+try:
+    from nms.gpu_nms import gpu_nms
+except ImportError:
+    # CPU-only build
+    gpu_nms = None
+
+CPU_NMS = {'greedy': cpu_nms, 'bitmask': cpu_nms_bitmask,
+           'python': py_cpu_nms}
+
+# cfg.TEST.NMS_MODE values; Soft-NMS method codes of cpu_soft_nms_multiclass
+NMS_MODES = ('hard', 'linear', 'gaussian', 'vote')
+SOFT_NMS_METHODS = {'linear': 1, 'gaussian': 2}
+
+# upper edges of the box count buckets the calibration is run on; larger
+# inputs use the last bucket (RPN_PRE_NMS_TOP_N is at most 12000)
+AUTOTUNE_BUCKETS = [300, 1000, 3000, 6000, 12000]
+
+_tuned = {}
+
+def available_backends(force_cpu=False):
+    """Names of the NMS backends that can run here, GPU last."""
+    backends = sorted(CPU_NMS.keys())
+    if gpu_nms is not None and cfg.USE_GPU_NMS and not force_cpu:
+        backends.append('gpu')
+    return backends
+
+def _run(backend, dets, thresh):
+    if backend == 'gpu':
+        return gpu_nms(dets, thresh, device_id=cfg.GPU_ID)
+    return CPU_NMS[backend](dets, thresh)
+
+def _calibration_boxes(num_boxes, im_w=1000, im_h=600):
+    """Clustered RPN-like proposals with random scores."""
+    centers = np.random.rand(max(num_boxes / 50, 1), 2) * [im_w, im_h]
+    ctr = centers[np.random.randint(0, centers.shape[0], num_boxes)] + \
+        np.random.randn(num_boxes, 2) * 30
+    size = 2 ** np.random.uniform(4, 9, (num_boxes, 2))
+    boxes = np.hstack((ctr - size / 2, ctr + size / 2))
+    return np.hstack((boxes, np.random.rand(num_boxes, 1))).astype(np.float32)
+
+def calibrate(backends, buckets=AUTOTUNE_BUCKETS, threshs=(0.3, 0.7)):
+    """Time every backend on every bucket and pick the fastest.
+
+    Arguments:
+        backends (list): backend names, see available_backends
+        buckets (list): box counts to time
+        threshs (tuple): NMS thresholds, timings are summed over them
+
+    Returns:
+        choice (dict): str(bucket) -> fastest backend name
+    """
+    rng_state = np.random.get_state()
+    np.random.seed(cfg.RNG_SEED)
+    choice = {}
+    for num_boxes in buckets:
+        dets = _calibration_boxes(num_boxes)
+        timers = dict((b, Timer()) for b in backends)
+        for backend in backends:
+            # warm up (GPU context, first-call allocations)
+            _run(backend, dets[:64], 0.7)
+            for thresh in threshs:
+                timers[backend].tic()
+                _run(backend, dets, thresh)
+                timers[backend].toc()
+        choice[str(num_boxes)] = min(backends,
+                                     key=lambda b: timers[b].total_time)
+    np.random.set_state(rng_state)
+    return choice
+
+def _autotune_file():
+    if cfg.NMS_AUTOTUNE_FILE:
+        return cfg.NMS_AUTOTUNE_FILE
+    return osp.join(cfg.DATA_DIR, 'cache', 'nms_autotune.json')
+
+def _read_cache(cache_file):
+    # a missing, truncated or otherwise unreadable cache counts as empty
+    try:
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+def _write_cache(cache_file, key, choice):
+    cache_dir = osp.dirname(cache_file)
+    if cache_dir and not osp.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass  # made by another process in the meantime
+    # merge into the latest cache, then write and rename, as other
+    # processes may be reading or calibrating at the same time
+    cache = _read_cache(cache_file)
+    cache[key] = choice
+    tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.rename(tmp_file, cache_file)
+
+def autotuned_choice(force_cpu=False):
+    """Fastest backend per bucket, calibrated once and cached to JSON.
+
+    The cache is keyed by host and by the set of available backends, so a
+    CPU-only node and a GPU node sharing the file keep separate entries.
+    """
+    backends = available_backends(force_cpu)
+    key = '{}:{}'.format(socket.gethostname(), ','.join(backends))
+    if key in _tuned:
+        return _tuned[key]
+
+    cache_file = _autotune_file()
+    choice = _read_cache(cache_file).get(key)
+    if not isinstance(choice, dict) or \
+            sorted(choice, key=int) != map(str, AUTOTUNE_BUCKETS):
+        print 'Calibrating NMS backends {} ...'.format(backends)
+        choice = calibrate(backends)
+        print 'NMS backend per box count: {}'.format(
+            ', '.join('<= {}: {}'.format(b, choice[str(b)])
+                      for b in AUTOTUNE_BUCKETS))
+        _write_cache(cache_file, key, choice)
+    _tuned[key] = choice
+    return _tuned[key]
+
+def select_backend(num_boxes, force_cpu=False):
+    """NMS backend for num_boxes boxes.
+
+    cfg.NMS_BACKEND names a backend ('greedy', 'bitmask', 'python' or 'gpu')
+    or 'auto' for the autotuned choice of the smallest bucket holding
+    num_boxes. A GPU backend that is unavailable or excluded by
+    cfg.USE_GPU_NMS / force_cpu falls back to the autotuned CPU choice.
+    """
+    backends = available_backends(force_cpu)
+    if cfg.NMS_BACKEND in backends:
+        return cfg.NMS_BACKEND
+    assert cfg.NMS_BACKEND in ('auto', 'gpu'), \
+        'unknown NMS backend {}'.format(cfg.NMS_BACKEND)
+    choice = autotuned_choice(force_cpu)
+    ind = min(np.searchsorted(AUTOTUNE_BUCKETS, num_boxes),
+              len(AUTOTUNE_BUCKETS) - 1)
+    return choice[str(AUTOTUNE_BUCKETS[ind])]
 
 def nms(dets, thresh, force_cpu=False):
-    """Dispatch to either CPU or GPU NMS implementations."""
+    """Dispatch to the NMS backend picked by select_backend."""
 
     if dets.shape[0] == 0:
         return []
-    if cfg.USE_GPU_NMS and not force_cpu:
-        return gpu_nms(dets, thresh, device_id=cfg.GPU_ID)
+    return _run(select_backend(dets.shape[0], force_cpu), dets, thresh)
+
+def multiclass_nms(dets, classes, thresh, max_per_image=0, force_cpu=False,
+                   mode=None):
+    """Per-class NMS over all classes of an image in one call.
+
+    On the GPU, boxes of different classes are shifted apart so a single
+    gpu_nms launch never lets them overlap; on the CPU, cpu_nms_multiclass
+    sorts once and runs the greedy pass class by class. The GPU is used
+    when select_backend picks it for the number of boxes. Soft-NMS runs on
+    the CPU and rescores the kept boxes; box voting moves them. The
+    max_per_image cap over all classes is applied to the survivors.
+
+    Arguments:
+        dets (ndarray): N x 5 (x1, y1, x2, y2, score)
+        classes (ndarray): N class labels
+        thresh (float): NMS overlap threshold
+        max_per_image (int): keep only boxes scoring at least the
+            max_per_image-th best kept score (0 keeps all)
+        mode (str): one of NMS_MODES, cfg.TEST.NMS_MODE if None
+
+    Returns:
+        keep (ndarray): kept indices into dets, grouped by ascending class,
+            score-descending within a class
+        dets (ndarray): the input dets, or for 'linear', 'gaussian' and
+            'vote' a float32 copy with the kept rows rescored or moved
+    """
+    if mode is None:
+        mode = cfg.TEST.NMS_MODE
+    assert mode in NMS_MODES, 'unknown NMS mode {}'.format(mode)
+    if dets.shape[0] == 0:
+        return np.zeros(0, dtype=np.int), dets
+    classes = classes.astype(np.int, copy=False)
+    if mode in SOFT_NMS_METHODS:
+        dets = dets.astype(np.float32)
+        keep = cpu_soft_nms_multiclass(dets, classes, thresh,
+                                       SOFT_NMS_METHODS[mode],
+                                       cfg.TEST.SOFT_NMS_SIGMA,
+                                       cfg.TEST.SOFT_NMS_MIN_SCORE)
+    elif select_backend(dets.shape[0], force_cpu) == 'gpu':
+        lo = dets[:, :4].min()
+        offsets = (classes - classes.min()) * \
+            (dets[:, :4].max() - lo + 2) - lo
+        shifted = dets.astype(np.float32)
+        shifted[:, :4] += offsets[:, np.newaxis]
+        keep = np.asarray(gpu_nms(shifted, thresh, device_id=cfg.GPU_ID),
+                          dtype=np.int)
+        keep = keep[np.lexsort((-dets[keep, 4], classes[keep]))]
     else:
-        return cpu_nms(dets, thresh)
+        keep = cpu_nms_multiclass(dets.astype(np.float32, copy=False),
+                                  classes, thresh)
+    if mode == 'vote':
+        dets = dets.astype(np.float32)
+        dets[keep, :4] = cpu_box_voting(dets, classes, keep,
+                                        cfg.TEST.BBOX_VOTE_THRESH)
+
+    if max_per_image > 0 and keep.shape[0] > max_per_image:
+        image_scores = dets[keep, 4]
+        image_thresh = np.sort(image_scores)[-max_per_image]
+        keep = keep[image_scores >= image_thresh]
+    return keep, dets
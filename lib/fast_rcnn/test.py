@@ -8,27 +8,30 @@
 """Test a Fast R-CNN network on an imdb (image database)."""
 
 from fast_rcnn.config import cfg, get_output_dir
-from fast_rcnn.bbox_transform import clip_boxes, bbox_transform_inv
+from fast_rcnn.bbox_transform import clip_boxes
+from utils.cython_bbox import bbox_transform_inv_clip
 import argparse
 from utils.timer import Timer
 import numpy as np
 import cv2
 import caffe
-from fast_rcnn.nms_wrapper import nms
+from fast_rcnn.nms_wrapper import multiclass_nms
 import cPickle
 from utils.blob import im_list_to_blob
+from utils.image_cache import image_cache, imread
+from roi_data_layer.region_bucketizer import get_bucketizer
+from roi_data_layer.box_prediction_layer import box_prediction
 import os
 
-def _get_image_blob(im):
-    """Converts an image into a network input.
+def _get_processed_ims(im):
+    """Mean subtracted copies of an image at every cfg.TEST.SCALES scale.
 
     Arguments:
         im (ndarray): a color image in BGR order
 
     Returns:
-        blob (ndarray): a data blob holding an image pyramid
-        im_scale_factors (list): list of image scales (relative to im) used
-            in the image pyramid
+        processed_ims (list): resized images, one per scale
+        im_scale_factors (list): list of image scales (relative to im)
     """
     im_orig = im.astype(np.float32, copy=True)
     im_orig -= cfg.PIXEL_MEANS
@@ -50,6 +53,21 @@ def _get_image_blob(im):
         im_scale_factors.append(im_scale)
         processed_ims.append(im)
 
+    return processed_ims, im_scale_factors
+
+def _get_image_blob(im):
+    """Converts an image into a network input.
+
+    Arguments:
+        im (ndarray): a color image in BGR order
+
+    Returns:
+        blob (ndarray): a data blob holding an image pyramid
+        im_scale_factors (list): list of image scales (relative to im) used
+            in the image pyramid
+    """
+    processed_ims, im_scale_factors = _get_processed_ims(im)
+
     # Create a blob to hold the input images
     blob = im_list_to_blob(processed_ims)
 
@@ -105,6 +123,38 @@ def _get_blobs(im, rois):
         blobs['rois'] = _get_rois_blob(rois, im_scale_factors)
     return blobs, im_scale_factors
 
+def _scores_and_boxes(net, blobs_out, boxes, im_shape, rows=slice(None)):
+    """Class scores and regressed boxes of the RoIs in rows of the output.
+
+    Arguments:
+        net (caffe.Net): network after its forward
+        blobs_out (dict): output blobs of the forward
+        boxes (ndarray): R x 4 RoIs of the rows, in image coordinates
+        im_shape (tuple): shape of the image the boxes are clipped to
+        rows: index of the rows in the RoI dimension of the output
+
+    Returns:
+        scores (ndarray): R x K array of object class scores
+        pred_boxes (ndarray): R x (4*K) array of predicted bounding boxes
+    """
+    if cfg.TEST.SVM:
+        # use the raw scores before softmax under the assumption they
+        # were trained as linear SVMs
+        scores = net.blobs['cls_score'].data[rows]
+    else:
+        # use softmax estimated probabilities
+        scores = blobs_out['cls_prob'][rows]
+
+    if cfg.TEST.BBOX_REG:
+        # Apply bounding-box regression deltas
+        box_deltas = blobs_out['bbox_pred'][rows]
+        pred_boxes = bbox_transform_inv_clip(
+            boxes.astype(box_deltas.dtype, copy=False), box_deltas, im_shape)
+    else:
+        # Simply repeat the boxes, once for each class
+        pred_boxes = np.tile(boxes, (1, scores.shape[1]))
+    return scores, pred_boxes
+
 def im_detect(net, im, boxes=None):
     """Detect object classes in an image given object proposals.
 
@@ -154,27 +204,12 @@ def im_detect(net, im, boxes=None):
     blobs_out = net.forward(**forward_kwargs)
 
     if cfg.TEST.HAS_RPN:
-        assert len(im_scales) == 1, "Only single-image batch implemented"
+        assert len(im_scales) == 1, "RPN testing supports a single test scale"
         rois = net.blobs['rois'].data.copy()
         # unscale back to raw image space
         boxes = rois[:, 1:5] / im_scales[0]
 
-    if cfg.TEST.SVM:
-        # use the raw scores before softmax under the assumption they
-        # were trained as linear SVMs
-        scores = net.blobs['cls_score'].data
-    else:
-        # use softmax estimated probabilities
-        scores = blobs_out['cls_prob']
-
-    if cfg.TEST.BBOX_REG:
-        # Apply bounding-box regression deltas
-        box_deltas = blobs_out['bbox_pred']
-        pred_boxes = bbox_transform_inv(boxes, box_deltas)
-        pred_boxes = clip_boxes(pred_boxes, im.shape)
-    else:
-        # Simply repeat the boxes, once for each class
-        pred_boxes = np.tile(boxes, (1, scores.shape[1]))
+    scores, pred_boxes = _scores_and_boxes(net, blobs_out, boxes, im.shape)
 
     if cfg.DEDUP_BOXES > 0 and not cfg.TEST.HAS_RPN:
         # Map scores and predictions back to the original set of boxes
@@ -183,6 +218,111 @@ def im_detect(net, im, boxes=None):
 
     return scores, pred_boxes
 
+def im_detect_batch(net, ims, boxes=None):
+    """Detect object classes in several images with a single forward.
+
+    The images are padded to a common size; im_info (with RPN) carries the
+    size of every image before padding, so proposals stay inside their own
+    image, and the RoIs of image i have batch index i. Images of similar
+    aspect ratio waste the least padding (see test_net). Only one test scale
+    is supported and RoIs are not deduplicated.
+
+    Arguments:
+        net (caffe.Net): Fast R-CNN network to use
+        ims (list): color images to test (in BGR order)
+        boxes (list): R_i x 4 arrays of object proposals per image, or None
+            (for RPN)
+
+    Returns:
+        detections (list): (scores, boxes) per image, as from im_detect
+    """
+    assert len(cfg.TEST.SCALES) == 1, \
+        'Batched testing supports a single test scale'
+    processed_ims = []
+    im_scales = []
+    for im in ims:
+        im_list, im_scale_factors = _get_processed_ims(im)
+        processed_ims.extend(im_list)
+        im_scales.extend(im_scale_factors)
+    blobs = {'data': im_list_to_blob(processed_ims)}
+    if cfg.TEST.HAS_RPN:
+        blobs['im_info'] = np.array(
+            [[im.shape[0], im.shape[1], im_scale]
+             for im, im_scale in zip(processed_ims, im_scales)],
+            dtype=np.float32)
+    else:
+        rois = [np.hstack((np.full((im_boxes.shape[0], 1), i),
+                           im_boxes * im_scale))
+                for i, (im_boxes, im_scale) in enumerate(zip(boxes, im_scales))]
+        blobs['rois'] = np.vstack(rois).astype(np.float32, copy=False)
+
+    # reshape network inputs and do forward
+    forward_kwargs = {}
+    for name, blob in blobs.iteritems():
+        net.blobs[name].reshape(*(blob.shape))
+        forward_kwargs[name] = blob.astype(np.float32, copy=False)
+    blobs_out = net.forward(**forward_kwargs)
+
+    if cfg.TEST.HAS_RPN:
+        rois = net.blobs['rois'].data
+    else:
+        rois = blobs['rois']
+    batch_inds = rois[:, 0].astype(np.int)
+    detections = []
+    for i, im in enumerate(ims):
+        rows = np.where(batch_inds == i)[0]
+        # unscale back to raw image space
+        im_boxes = rois[rows, 1:5] / im_scales[i]
+        detections.append(_scores_and_boxes(net, blobs_out, im_boxes,
+                                            im.shape, rows))
+    return detections
+
+def im_detect_boxcls(net, im, bucketizer, timers=None):
+    """Detect objects in an image with a seed-based box_cls_reg network.
+
+    The net runs once; every seed of its class score map is decoded into a
+    box by box_prediction.
+
+    Arguments:
+        net (caffe.Net): box_cls_reg network to use
+        im (ndarray): color image to test (in BGR order)
+        bucketizer (RegionBucketizer): region bounds used in training
+        timers (dict): optional 'forward' and 'decode' Timers
+
+    Returns:
+        scores (ndarray): N seed scores
+        boxes (ndarray): N x 4 predicted boxes in image coordinates
+        classes (ndarray): N predicted classes
+    """
+    if timers is not None:
+        timers['forward'].tic()
+    # the net takes no RoIs, whatever cfg.TEST.HAS_RPN says
+    blobs = {'data' : None}
+    blobs['data'], im_scales = _get_image_blob(im)
+    assert len(im_scales) == 1, "Only single-image batch implemented"
+    im_blob = blobs['data']
+    forward_kwargs = {'data': im_blob.astype(np.float32, copy=False)}
+    net.blobs['data'].reshape(*(im_blob.shape))
+    if 'im_info' in net.blobs:
+        forward_kwargs['im_info'] = np.array(
+            [[im_blob.shape[2], im_blob.shape[3], im_scales[0]]],
+            dtype=np.float32)
+        net.blobs['im_info'].reshape(*(forward_kwargs['im_info'].shape))
+    net.forward(**forward_kwargs)
+    if timers is not None:
+        timers['forward'].toc()
+        timers['decode'].tic()
+
+    cls_score, bbox_cls, bbox_reg = [net.blobs[name].data
+                                     for name in cfg.TEST.BOXCLS_BLOBS]
+    pred_boxes, classes = box_prediction(cls_score, bbox_cls, bbox_reg,
+                                         bucketizer)
+    # unscale back to raw image space
+    boxes = clip_boxes(pred_boxes[:, 1:5] / im_scales[0], im.shape)
+    if timers is not None:
+        timers['decode'].toc()
+    return pred_boxes[:, 0], boxes, classes
+
 def vis_detections(im, class_name, dets, thresh=0.3):
     """Visual debugging of detections."""
     import matplotlib.pyplot as plt
@@ -202,6 +342,12 @@ def vis_detections(im, class_name, dets, thresh=0.3):
             plt.title('{}  {:.3f}'.format(class_name, score))
             plt.show()
 
+def _split_by_class(dets, classes, keep, num_classes):
+    """Kept dets per class, from keep indices grouped by ascending class."""
+    bounds = np.searchsorted(classes[keep], np.arange(num_classes + 1))
+    return [dets[keep[bounds[j]:bounds[j + 1]], :]
+            for j in xrange(num_classes)]
+
 def apply_nms(all_boxes, thresh):
     """Apply non-maximum suppression to all predicted boxes output by the
     test_net method.
@@ -210,22 +356,45 @@ def apply_nms(all_boxes, thresh):
     num_images = len(all_boxes[0])
     nms_boxes = [[[] for _ in xrange(num_images)]
                  for _ in xrange(num_classes)]
-    for cls_ind in xrange(num_classes):
-        for im_ind in xrange(num_images):
-            dets = all_boxes[cls_ind][im_ind]
-            if dets == []:
-                continue
-            # CPU NMS is much faster than GPU NMS when the number of boxes
-            # is relative small (e.g., < 10k)
-            # TODO(rbg): autotune NMS dispatch
-            keep = nms(dets, thresh, force_cpu=True)
-            if len(keep) == 0:
-                continue
-            nms_boxes[cls_ind][im_ind] = dets[keep, :].copy()
+    for im_ind in xrange(num_images):
+        cls_inds = [cls_ind for cls_ind in xrange(num_classes)
+                    if len(all_boxes[cls_ind][im_ind]) > 0]
+        if len(cls_inds) == 0:
+            continue
+        dets = np.vstack([all_boxes[cls_ind][im_ind] for cls_ind in cls_inds])
+        classes = np.repeat(cls_inds, [len(all_boxes[cls_ind][im_ind])
+                                       for cls_ind in cls_inds])
+        keep, dets = multiclass_nms(dets, classes, thresh)
+        cls_dets = _split_by_class(dets, classes, keep, num_classes)
+        for cls_ind in cls_inds:
+            if cls_dets[cls_ind].shape[0] > 0:
+                nms_boxes[cls_ind][im_ind] = cls_dets[cls_ind].copy()
     return nms_boxes
 
-def test_net(net, imdb, max_per_image=400, thresh=-np.inf, vis=False):
-    """Test a Fast R-CNN network on an image database."""
+def _test_batches(imdb, mode):
+    """Image indices of the test batches of cfg.TEST.IMS_PER_BATCH images.
+
+    Batches hold images of similar aspect ratio, so that padding them to a
+    common size wastes little; 'boxcls' mode tests one image at a time.
+    """
+    num_images = len(imdb.image_index)
+    ims_per_batch = cfg.TEST.IMS_PER_BATCH if mode == 'rcnn' else 1
+    if ims_per_batch <= 1:
+        return [[i] for i in xrange(num_images)]
+    # sizes from the roidb or annotations, without opening the images
+    ratios = np.array([float(w) / h for w, h in imdb.image_sizes()])
+    order = np.argsort(ratios, kind='mergesort')
+    return [order[start:start + ims_per_batch].tolist()
+            for start in xrange(0, num_images, ims_per_batch)]
+
+def test_net(net, imdb, max_per_image=400, thresh=-np.inf, vis=False,
+             mode='rcnn'):
+    """Test a Fast R-CNN network on an image database.
+
+    mode 'rcnn' scores proposals with im_detect; mode 'boxcls' decodes the
+    seeds of a box_cls_reg network with im_detect_boxcls.
+    """
+    assert mode in ('rcnn', 'boxcls'), 'unknown test mode: {}'.format(mode)
     num_images = len(imdb.image_index)
     # all detections are collected into:
     #    all_boxes[cls][image] = N x 5 array of detections in
@@ -236,59 +405,87 @@ def test_net(net, imdb, max_per_image=400, thresh=-np.inf, vis=False):
     output_dir = get_output_dir(imdb, net)
 
     # timers
-    _t = {'im_detect' : Timer(), 'misc' : Timer()}
-
-    if not cfg.TEST.HAS_RPN:
+    _t = {'im_detect' : Timer(), 'misc' : Timer(),
+          'forward' : Timer(), 'decode' : Timer()}
+
+    if mode == 'boxcls':
+        S = int(np.sqrt(cfg.TRAIN.num_regions))
+        bucketizer = get_bucketizer(
+            S, cfg.TRAIN.num_classes if cfg.TRAIN.class_bounds else None)
+    elif not cfg.TEST.HAS_RPN:
         roidb = imdb.roidb
 
-    for i in xrange(num_images):
-        # filter out any ground truth boxes
-        if cfg.TEST.HAS_RPN:
-            box_proposals = None
-        else:
-            # The roidb may contain ground-truth rois (for example, if the roidb
-            # comes from the training or val split). We only want to evaluate
-            # detection on the *non*-ground-truth rois. We select those the rois
-            # that have the gt_classes field set to 0, which means there's no
-            # ground truth.
-            box_proposals = roidb[i]['boxes'][roidb[i]['gt_classes'] == 0]
-
-        im = cv2.imread(imdb.image_path_at(i))
+    num_done = 0
+    for batch in _test_batches(imdb, mode):
+        ims = [imread(imdb.image_path_at(i)) for i in batch]
         _t['im_detect'].tic()
-        scores, boxes = im_detect(net, im, box_proposals)
+        if mode == 'boxcls':
+            detections = [im_detect_boxcls(net, ims[0], bucketizer, _t)]
+        else:
+            if cfg.TEST.HAS_RPN:
+                box_proposals = [None] * len(batch)
+            else:
+                # The roidb may contain ground-truth rois (for example, if
+                # the roidb comes from the training or val split). We only
+                # want to evaluate detection on the *non*-ground-truth rois.
+                # We select those the rois that have the gt_classes field set
+                # to 0, which means there's no ground truth.
+                box_proposals = [roidb[i]['boxes'][roidb[i]['gt_classes'] == 0]
+                                 for i in batch]
+            if len(batch) > 1:
+                detections = im_detect_batch(net, ims, box_proposals)
+            else:
+                detections = [im_detect(net, ims[0], box_proposals[0])]
         _t['im_detect'].toc()
-
-        _t['misc'].tic()
-        # skip j = 0, because it's the background class
-        for j in xrange(1, imdb.num_classes):
-            inds = np.where(scores[:, j] > thresh)[0]
-            cls_scores = scores[inds, j]
-            if cfg.TEST.AGNOSTIC:
-                cls_boxes = boxes[inds, 4:8]
+        for i, im, detection in zip(batch, ims, detections):
+            num_done += 1
+            _t['misc'].tic()
+            # all classes but the background (j = 0) go through one NMS call,
+            # capped at max_per_image detections *over all classes*
+            if mode == 'boxcls':
+                seed_scores, seed_boxes, seed_classes = detection
+                inds = np.where((seed_classes > 0) &
+                                (seed_scores > thresh))[0]
+                classes = seed_classes[inds]
+                cls_scores = seed_scores[inds]
+                cls_boxes = seed_boxes[inds]
             else:
-                cls_boxes = boxes[inds, j*4:(j+1)*4]
-            cls_dets = np.hstack((cls_boxes, cls_scores[:, np.newaxis])) \
+                scores, boxes = detection
+                inds, classes = np.where(scores[:, 1:] > thresh)
+                classes += 1
+                cls_scores = scores[inds, classes]
+                if cfg.TEST.AGNOSTIC:
+                    cls_boxes = boxes[inds, 4:8]
+                else:
+                    cls_boxes = boxes[inds[:, np.newaxis],
+                                      classes[:, np.newaxis] * 4 +
+                                      np.arange(4)]
+            dets = np.hstack((cls_boxes, cls_scores[:, np.newaxis])) \
                 .astype(np.float32, copy=False)
-            keep = nms(cls_dets, cfg.TEST.NMS)
-            cls_dets = cls_dets[keep, :]
-            if vis:
-                vis_detections(im, imdb.classes[j], cls_dets)
-            all_boxes[j][i] = cls_dets
-
-        # Limit to max_per_image detections *over all classes*
-        if max_per_image > 0:
-            image_scores = np.hstack([all_boxes[j][i][:, -1]
-                                      for j in xrange(1, imdb.num_classes)])
-            if len(image_scores) > max_per_image:
-                image_thresh = np.sort(image_scores)[-max_per_image]
-                for j in xrange(1, imdb.num_classes):
-                    keep = np.where(all_boxes[j][i][:, -1] >= image_thresh)[0]
-                    all_boxes[j][i] = all_boxes[j][i][keep, :]
-        _t['misc'].toc()
-
-        print 'im_detect: {:d}/{:d} {:.3f}s {:.3f}s' \
-              .format(i + 1, num_images, _t['im_detect'].average_time,
-                      _t['misc'].average_time)
+            keep, dets = multiclass_nms(dets, classes, cfg.TEST.NMS,
+                                        max_per_image)
+            cls_dets = _split_by_class(dets, classes, keep, imdb.num_classes)
+            for j in xrange(1, imdb.num_classes):
+                if vis:
+                    vis_detections(im, imdb.classes[j], cls_dets[j])
+                all_boxes[j][i] = cls_dets[j]
+            _t['misc'].toc()
+
+            if mode == 'boxcls':
+                print 'im_detect: {:d}/{:d} forward {:.3f}s decode {:.3f}s ' \
+                      'nms {:.3f}s'.format(num_done, num_images,
+                                           _t['forward'].average_time,
+                                           _t['decode'].average_time,
+                                           _t['misc'].average_time)
+            else:
+                # im_detect time per image, also when batched
+                print 'im_detect: {:d}/{:d} {:.3f}s {:.3f}s' \
+                      .format(num_done, num_images,
+                              _t['im_detect'].total_time / num_done,
+                              _t['misc'].average_time)
+
+    if image_cache.enabled():
+        print image_cache.summary()
 
     det_file = os.path.join(output_dir, 'detections.pkl')
     with open(det_file, 'wb') as f:
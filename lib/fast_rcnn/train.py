@@ -11,6 +11,9 @@ import caffe
 from fast_rcnn.config import cfg
 import roi_data_layer.roidb as rdl_roidb
 from utils.timer import Timer
+from utils.top_blobs import allocation_counter
+from rpn.anchor_grid import anchor_grids
+from utils.image_cache import image_cache
 import numpy as np
 import os
 import scipy.io as sio
@@ -200,7 +203,9 @@ class SolverWrapper(object):
         while self.solver.iter < max_iters:
             # Make one SGD update
             timer.tic()
+            allocation_counter.tic()
             self.solver.step(1)
+            allocation_counter.toc()
             solver = self.solver
             net = solver.net
             keys = net.blobs.keys()
@@ -220,6 +225,23 @@ class SolverWrapper(object):
             timer.toc()
             if self.solver.iter % (10 * self.solver_param.display) == 0:
                 print 'speed: {:.3f}s / iter'.format(timer.average_time)
+                if image_cache.enabled():
+                    print image_cache.summary()
+                print 'top blobs: {:.1f} KB allocated / iter'.format(
+                    allocation_counter.average_bytes / 1024.)
+                print 'anchor cache hit rate: grids {:.1%}, inds_inside ' \
+                      '{:.1%}'.format(anchor_grids.stats()['anchors'],
+                                      anchor_grids.stats()['inds_inside'])
+                for name, layer in zip(net._layer_names, net.layers):
+                    if hasattr(layer, 'fill_ratio'):
+                        print '{}: {:.1%} of label map pixels written / ' \
+                              'iter'.format(name, layer.fill_ratio())
+                prefetch = self.solver.net.layers[0].prefetch_stats()
+                if prefetch is not None:
+                    print 'prefetch: waited for {} of {} minibatches, ' \
+                          '{:.3f}s in total'.format(prefetch['starved'],
+                                                    prefetch['batches'],
+                                                    prefetch['wait_time'])
 
             if self.solver.iter % cfg.TRAIN.SNAPSHOT_ITERS == 0:
                 last_snapshot_iter = self.solver.iter
@@ -227,6 +249,7 @@ class SolverWrapper(object):
 
         if last_snapshot_iter != self.solver.iter:
             model_paths.append(self.snapshot(model_name))
+        self.solver.net.layers[0].stop_prefetch()
         return model_paths
 
 def get_training_roidb(imdb):
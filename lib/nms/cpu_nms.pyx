@@ -7,6 +7,8 @@
 
 import numpy as np
 cimport numpy as np
+cimport cython
+from libc.math cimport exp
 
 cdef inline np.float32_t max(np.float32_t a, np.float32_t b):
     return a if a >= b else b
@@ -66,3 +68,300 @@ def cpu_nms(np.ndarray[np.float32_t, ndim=2] dets, np.float thresh):
                 suppressed[j] = 1
 
     return keep
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def cpu_nms_multiclass(np.ndarray[np.float32_t, ndim=2] dets,
+                       np.ndarray[np.int_t, ndim=1] classes, np.float thresh):
+    """Greedy NMS within every class, all classes in one call.
+
+    Returns kept indices grouped by ascending class, score-descending
+    within a class.
+    """
+    cdef np.ndarray[np.float32_t, ndim=1] x1 = dets[:, 0]
+    cdef np.ndarray[np.float32_t, ndim=1] y1 = dets[:, 1]
+    cdef np.ndarray[np.float32_t, ndim=1] x2 = dets[:, 2]
+    cdef np.ndarray[np.float32_t, ndim=1] y2 = dets[:, 3]
+    cdef np.ndarray[np.float32_t, ndim=1] scores = dets[:, 4]
+
+    cdef np.ndarray[np.float32_t, ndim=1] areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    # one sort for all classes: by class, then by decreasing score
+    cdef np.ndarray[np.int_t, ndim=1] order = np.lexsort((-scores, classes))
+
+    cdef int ndets = dets.shape[0]
+    cdef np.ndarray[np.int_t, ndim=1] suppressed = \
+            np.zeros((ndets), dtype=np.int)
+    cdef np.ndarray[np.int_t, ndim=1] keep = \
+            np.zeros((ndets), dtype=np.int)
+    cdef int nkeep = 0
+
+    # nominal indices
+    cdef int _i, _j
+    # sorted indices
+    cdef int i, j
+    cdef np.int_t icls
+    # temp variables for box i's (the box currently under consideration)
+    cdef np.float32_t ix1, iy1, ix2, iy2, iarea
+    # variables for computing overlap with box j (lower scoring box)
+    cdef np.float32_t xx1, yy1, xx2, yy2
+    cdef np.float32_t w, h
+    cdef np.float32_t inter, ovr
+
+    for _i in range(ndets):
+        i = order[_i]
+        if suppressed[i] == 1:
+            continue
+        keep[nkeep] = i
+        nkeep += 1
+        icls = classes[i]
+        ix1 = x1[i]
+        iy1 = y1[i]
+        ix2 = x2[i]
+        iy2 = y2[i]
+        iarea = areas[i]
+        for _j in range(_i + 1, ndets):
+            j = order[_j]
+            # the rest of the boxes belong to later classes
+            if classes[j] != icls:
+                break
+            if suppressed[j] == 1:
+                continue
+            xx1 = max(ix1, x1[j])
+            yy1 = max(iy1, y1[j])
+            xx2 = min(ix2, x2[j])
+            yy2 = min(iy2, y2[j])
+            w = max(0.0, xx2 - xx1 + 1)
+            h = max(0.0, yy2 - yy1 + 1)
+            inter = w * h
+            ovr = inter / (iarea + areas[j] - inter)
+            if ovr >= thresh:
+                suppressed[j] = 1
+
+    return keep[:nkeep]
+
+# count trailing zeros, to walk the set bits of a mask word (gcc/clang)
+cdef extern from *:
+    int __builtin_ctzll(unsigned long long)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def cpu_nms_bitmask(np.ndarray[np.float32_t, ndim=2] dets, np.float thresh):
+    """Block-bitmask NMS modeled on nms_kernel.cu, run on the CPU.
+
+    Boxes are sorted once and stored contiguously. As in the CUDA kernel,
+    each box's overlaps with the boxes after it are packed into 64-bit
+    words, and a sequential sweep ORs the words of kept boxes into the
+    removed mask. Words are built only for kept boxes, and only over the
+    bits still live in the mask, so removed boxes cost nothing. Same
+    suppression rule as cpu_nms (IoU >= thresh); returns the same keep list.
+    """
+    cdef np.ndarray[np.int_t, ndim=1] order = dets[:, 4].argsort()[::-1]
+    cdef np.float32_t[:, ::1] boxes = \
+            np.ascontiguousarray(dets[order, :4], dtype=np.float32)
+    cdef int ndets = boxes.shape[0]
+    cdef int col_blocks = (ndets + 63) // 64
+    cdef np.float32_t[::1] areas = np.empty(ndets, dtype=np.float32)
+    cdef np.uint64_t[::1] remv = np.zeros(col_blocks, dtype=np.uint64)
+    cdef np.ndarray[np.int_t, ndim=1] keep = np.zeros(ndets, dtype=np.int)
+    cdef int nkeep = 0
+
+    cdef int i, j, b, nblock
+    cdef np.uint64_t t, live
+    cdef np.float32_t ix1, iy1, ix2, iy2, iarea
+    cdef np.float32_t w, h, inter, ovr
+    cdef np.float32_t zero = 0, one = 1
+
+    for i in range(ndets):
+        areas[i] = (boxes[i, 2] - boxes[i, 0] + one) * \
+            (boxes[i, 3] - boxes[i, 1] + one)
+
+    for i in range(ndets):
+        if remv[i // 64] & (<np.uint64_t>1 << (i % 64)):
+            continue
+        keep[nkeep] = i
+        nkeep += 1
+        ix1 = boxes[i, 0]
+        iy1 = boxes[i, 1]
+        ix2 = boxes[i, 2]
+        iy2 = boxes[i, 3]
+        iarea = areas[i]
+        for nblock in range(i // 64, col_blocks):
+            # only boxes of this word that are not removed yet
+            live = ~remv[nblock]
+            if nblock == i // 64:
+                live &= ~((<np.uint64_t>2 << (i % 64)) - 1)
+            t = 0
+            while live:
+                b = __builtin_ctzll(live)
+                live &= live - 1
+                j = nblock * 64 + b
+                if j >= ndets:
+                    break
+                w = max(zero, min(ix2, boxes[j, 2]) - max(ix1, boxes[j, 0]) + one)
+                h = max(zero, min(iy2, boxes[j, 3]) - max(iy1, boxes[j, 1]) + one)
+                inter = w * h
+                ovr = inter / (iarea + areas[j] - inter)
+                if ovr >= thresh:
+                    t |= <np.uint64_t>1 << b
+            remv[nblock] |= t
+
+    return list(order[keep[:nkeep]])
+
+cdef inline void _swap(np.float32_t[:, ::1] boxes, np.float32_t[::1] scores,
+                       np.float32_t[::1] areas, np.int_t[::1] inds,
+                       int a, int b):
+    cdef int k
+    for k in range(4):
+        boxes[a, k], boxes[b, k] = boxes[b, k], boxes[a, k]
+    scores[a], scores[b] = scores[b], scores[a]
+    areas[a], areas[b] = areas[b], areas[a]
+    inds[a], inds[b] = inds[b], inds[a]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def cpu_soft_nms_multiclass(np.ndarray[np.float32_t, ndim=2] dets,
+                            np.ndarray[np.int_t, ndim=1] classes,
+                            np.float thresh, int method=1,
+                            np.float sigma=0.5, np.float min_score=0.001):
+    """Soft-NMS within every class, all classes in one call.
+
+    Instead of removing the boxes that overlap a kept box, their scores are
+    decayed: by (1 - IoU) when IoU > thresh (method 1, linear), or by
+    exp(-IoU^2 / sigma) (method 2, Gaussian). Boxes decayed below min_score
+    are dropped. The decayed scores of kept boxes are written to dets[:, 4].
+
+    Returns kept indices grouped by ascending class, score-descending
+    within a class.
+    """
+    cdef np.ndarray[np.int_t, ndim=1] order = np.lexsort((-dets[:, 4], classes))
+    cdef np.float32_t[:, ::1] boxes = \
+            np.ascontiguousarray(dets[order, :4], dtype=np.float32)
+    cdef np.float32_t[::1] scores = dets[order, 4]
+    cdef np.int_t[::1] cls = classes[order]
+    cdef np.int_t[::1] inds = order.copy()
+    cdef int ndets = dets.shape[0]
+    cdef np.float32_t[::1] areas = np.empty(ndets, dtype=np.float32)
+    cdef np.ndarray[np.int_t, ndim=1] keep = np.zeros(ndets, dtype=np.int)
+    cdef int nkeep = 0
+
+    # [start, stop) is the current class, [i, end) its boxes still alive
+    cdef int start, stop, end, i, j, m
+    cdef np.float32_t ix1, iy1, ix2, iy2, iarea
+    cdef np.float32_t w, h, inter, ovr
+
+    for i in range(ndets):
+        areas[i] = (boxes[i, 2] - boxes[i, 0] + 1) * \
+            (boxes[i, 3] - boxes[i, 1] + 1)
+
+    start = 0
+    while start < ndets:
+        stop = start + 1
+        while stop < ndets and cls[stop] == cls[start]:
+            stop += 1
+        end = stop
+        i = start
+        while i < end:
+            # bring the highest remaining score to i
+            m = i
+            for j in range(i + 1, end):
+                if scores[j] > scores[m]:
+                    m = j
+            if scores[m] < min_score:
+                break
+            _swap(boxes, scores, areas, inds, i, m)
+            keep[nkeep] = inds[i]
+            nkeep += 1
+            dets[inds[i], 4] = scores[i]
+
+            ix1 = boxes[i, 0]
+            iy1 = boxes[i, 1]
+            ix2 = boxes[i, 2]
+            iy2 = boxes[i, 3]
+            iarea = areas[i]
+            j = i + 1
+            while j < end:
+                w = max(0.0, min(ix2, boxes[j, 2]) - max(ix1, boxes[j, 0]) + 1)
+                h = max(0.0, min(iy2, boxes[j, 3]) - max(iy1, boxes[j, 1]) + 1)
+                inter = w * h
+                ovr = inter / (iarea + areas[j] - inter)
+                if method == 1:
+                    if ovr > thresh:
+                        scores[j] *= 1 - ovr
+                else:
+                    scores[j] *= exp(-ovr * ovr / sigma)
+                if scores[j] < min_score:
+                    # drop j: move the last live box into its place
+                    end -= 1
+                    _swap(boxes, scores, areas, inds, j, end)
+                else:
+                    j += 1
+            i += 1
+        start = stop
+
+    return keep[:nkeep]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def cpu_box_voting(np.ndarray[np.float32_t, ndim=2] dets,
+                   np.ndarray[np.int_t, ndim=1] classes,
+                   np.ndarray[np.int_t, ndim=1] keep, np.float thresh):
+    """Box voting after NMS.
+
+    Every kept box is replaced by the score-weighted average of the boxes of
+    its class (suppressed ones included) that overlap it by IoU >= thresh.
+
+    Returns len(keep) x 4 voted boxes.
+    """
+    cdef np.ndarray[np.float32_t, ndim=1] x1 = dets[:, 0]
+    cdef np.ndarray[np.float32_t, ndim=1] y1 = dets[:, 1]
+    cdef np.ndarray[np.float32_t, ndim=1] x2 = dets[:, 2]
+    cdef np.ndarray[np.float32_t, ndim=1] y2 = dets[:, 3]
+    cdef np.ndarray[np.float32_t, ndim=1] scores = dets[:, 4]
+    cdef np.ndarray[np.float32_t, ndim=1] areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    # boxes grouped by class, and each kept box's class segment
+    cdef np.ndarray[np.int_t, ndim=1] order = \
+            np.argsort(classes, kind='mergesort')
+    sorted_classes = classes[order]
+    cdef np.ndarray[np.int_t, ndim=1] starts = \
+            np.searchsorted(sorted_classes, classes[keep], 'left')
+    cdef np.ndarray[np.int_t, ndim=1] stops = \
+            np.searchsorted(sorted_classes, classes[keep], 'right')
+    cdef int nkeep = keep.shape[0]
+    cdef np.ndarray[np.float32_t, ndim=2] voted = dets[keep, :4]
+
+    cdef int k, i, j, _j
+    cdef np.float32_t ix1, iy1, ix2, iy2, iarea
+    cdef np.float32_t w, h, inter, ovr
+    cdef double wsum, s0, s1, s2, s3
+
+    for k in range(nkeep):
+        i = keep[k]
+        ix1 = x1[i]
+        iy1 = y1[i]
+        ix2 = x2[i]
+        iy2 = y2[i]
+        iarea = areas[i]
+        wsum = s0 = s1 = s2 = s3 = 0
+        for _j in range(starts[k], stops[k]):
+            j = order[_j]
+            w = max(0.0, min(ix2, x2[j]) - max(ix1, x1[j]) + 1)
+            h = max(0.0, min(iy2, y2[j]) - max(iy1, y1[j]) + 1)
+            inter = w * h
+            ovr = inter / (iarea + areas[j] - inter)
+            if ovr >= thresh:
+                wsum += scores[j]
+                s0 += scores[j] * x1[j]
+                s1 += scores[j] * y1[j]
+                s2 += scores[j] * x2[j]
+                s3 += scores[j] * y2[j]
+        if wsum > 0:
+            voted[k, 0] = s0 / wsum
+            voted[k, 1] = s1 / wsum
+            voted[k, 2] = s2 / wsum
+            voted[k, 3] = s3 / wsum
+
+    return voted
@@ -36,3 +36,44 @@ def py_cpu_nms(dets, thresh):
         order = order[inds + 1]
 
     return keep
+
+def py_soft_nms(dets, thresh, method=1, sigma=0.5, min_score=0.001):
+    """Pure Python Soft-NMS baseline.
+
+    Returns the kept indices and their decayed scores, see
+    cpu_soft_nms_multiclass.
+    """
+    x1 = dets[:, 0]
+    y1 = dets[:, 1]
+    x2 = dets[:, 2]
+    y2 = dets[:, 3]
+    scores = dets[:, 4].copy()
+
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    alive = scores.argsort()[::-1]
+
+    keep = []
+    while alive.size > 0:
+        i = alive[np.argmax(scores[alive])]
+        if scores[i] < min_score:
+            break
+        keep.append(i)
+        alive = alive[alive != i]
+        xx1 = np.maximum(x1[i], x1[alive])
+        yy1 = np.maximum(y1[i], y1[alive])
+        xx2 = np.minimum(x2[i], x2[alive])
+        yy2 = np.minimum(y2[i], y2[alive])
+
+        w = np.maximum(0.0, xx2 - xx1 + 1)
+        h = np.maximum(0.0, yy2 - yy1 + 1)
+        inter = w * h
+        ovr = inter / (areas[i] + areas[alive] - inter)
+
+        if method == 1:
+            weight = np.where(ovr > thresh, 1 - ovr, 1)
+        else:
+            weight = np.exp(-ovr * ovr / sigma)
+        scores[alive] *= weight
+        alive = alive[scores[alive] >= min_score]
+
+    return keep, scores[keep]
@@ -0,0 +1,66 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""A ring of shared-memory slots for data blobs built by prefetch workers.
+
+The slots are allocated before the workers fork, so the worker and the data
+layer map the same memory. A worker takes a free slot, builds the data blob
+of a minibatch in it and queues only the slot index with the small blobs;
+the layer copies the data blob into its top and hands the slot back.
+"""
+
+from fast_rcnn.config import cfg
+import numpy as np
+from multiprocessing import Queue, RawArray
+from Queue import Empty
+
+def data_blob_size():
+    """Floats in the largest TRAIN data blob.
+
+    A scaled image has at most max(cfg.TRAIN.SCALES) x cfg.TRAIN.MAX_SIZE
+    pixels; a batch mixing horizontal and vertical images is padded to
+    MAX_SIZE x MAX_SIZE.
+    """
+    max_scale = max(cfg.TRAIN.SCALES)
+    if cfg.TRAIN.IMS_PER_BATCH == 1 or cfg.TRAIN.ASPECT_GROUPING:
+        pixels = max_scale * cfg.TRAIN.MAX_SIZE
+    else:
+        pixels = cfg.TRAIN.MAX_SIZE * cfg.TRAIN.MAX_SIZE
+    return cfg.TRAIN.IMS_PER_BATCH * 3 * pixels
+
+class BlobSlots(object):
+    """num_slots shared float32 buffers of slot_size elements each."""
+    def __init__(self, num_slots, slot_size):
+        self._slot_size = slot_size
+        self._memory = RawArray('f', num_slots * slot_size)
+        self._free = Queue()
+        for slot in xrange(num_slots):
+            self._free.put(slot)
+
+    def slot(self, index):
+        """The flat float32 array of slot index."""
+        start = index * self._slot_size
+        return np.frombuffer(self._memory, dtype=np.float32,
+                             count=self._slot_size,
+                             offset=start * np.dtype(np.float32).itemsize)
+
+    def view(self, index, shape):
+        """The blob of the given shape held in slot index."""
+        return self.slot(index)[:int(np.prod(shape))].reshape(shape)
+
+    def acquire(self, stop_event):
+        """Index of a free slot, or None once stop_event is set."""
+        while not stop_event.is_set():
+            try:
+                return self._free.get(timeout=1.)
+            except Empty:
+                pass
+        return None
+
+    def release(self, index):
+        """Hand slot index back for reuse."""
+        self._free.put(index)
@@ -17,6 +17,10 @@ import numpy as np
 import yaml
 from multiprocessing import Process, Queue
 import scipy.io as sio
+from roi_data_layer.region_bucketizer import get_bucketizer
+from utils.top_blobs import top_data
+from roi_data_layer.dense_labels import rasterize_rois, resolve_overlaps, \
+    overlap_priority, pixel_box_labels, scatter_channels, clear_pixels
 class RoIDataLayer(caffe.Layer):
     """Fast R-CNN data layer used for training."""
 
@@ -29,12 +33,19 @@ class RoIDataLayer(caffe.Layer):
         shape = bottom[0].data.shape #1, C, H, W
 
         self._num_region = layer_params['num_region']
-        self._num_region_one_side = np.sqrt(self._num_region )
+        self._num_region_one_side = int(np.sqrt(self._num_region ))
         self._num_classes = layer_params['num_classes']
         self._name_to_top_map = {}
         self._num_roi = bottom[1].data.shape[0]
         self._roi_scale = layer_params['roi_scale']
-        self._region_bound = sio.loadmat('region_boundary.mat')
+        # (feature map shape, xs, ys) of the pixels written by the last
+        # forward, the only nonzero ones of the box label maps
+        self._written = None
+        # fraction of label map pixels written, summed over forwards
+        self._fill_sum = 0.0
+        self._forwards = 0
+        self._bucketizer = get_bucketizer(self._num_region_one_side,
+                                          cfg.TRAIN.num_classes if cfg.TRAIN.class_bounds else None)
 
         
         # data blob: holds a batch of N images, each with 3 channels
@@ -64,109 +75,54 @@ class RoIDataLayer(caffe.Layer):
     def forward(self, bottom, top):
         """Get blobs and copy them into this layer's top blob vector."""
         rois = bottom[1].data
+        rois = rois.reshape((rois.shape[0], rois.shape[1]))
         # bottom[0] 
         #
         # bottom[0] cls_score map (1, (K+1), H, W)
         cls_score = bottom[0].data
-        catetory_cls_labels = np.zeros((cfg.TRAIN.IMS_PER_BATCH, self._num_classes + 1 , shape[2], shape[3]))
-        bbox_cls_labels = np.zeros((cfg.TRAIN.IMS_PER_BATCH, 1 , shape[2], shape[3]))
-        bbox_cls_inweights = np.zeros((cfg.TRAIN.IMS_PER_BATCH, self._num_classes * self._num_region , shape[2], shape[3]))
+        shape = cls_score.shape
+        # label maps are written in place in the top blobs
+        catetory_cls_labels = top_data(top[0], (cfg.TRAIN.IMS_PER_BATCH, self._num_classes + 1 , shape[2], shape[3]))
+        bbox_cls_labels = top_data(top[1], (cfg.TRAIN.IMS_PER_BATCH, self._num_classes * self._num_region , shape[2], shape[3]))
         
-        bbox_reg_labels = np.zeros((cfg.TRAIN.IMS_PER_BATCH, self._num_classes * self._num_region_one_side * 2 , shape[2], shape[3]))
-        bbox_inweights = np.zeros((cfg.TRAIN.IMS_PER_BATCH, self._num_classes * self._num_region_one_side * 2 , shape[2], shape[3]))
-        bbox_outweights = np.ones((cfg.TRAIN.IMS_PER_BATCH, self._num_classes * self._num_region_one_side * 2,shape[2], shape[3]))
-        
-        for nroi in xrange(self._num_roi):
-            count = 0
-            roi_x1 =  rois[nroi,1] * self._roi_scale
-            roi_y1 =  rois[nroi,2] * self._roi_scale
-            roi_x2 =  rois[nroi,3] * self._roi_scale
-            roi_y2 =  rois[nroi,4] * self._roi_scale
-            center_w = (roi_x1 + roi_x2)/2
-            center_h = (roi_y1 + roi_y2)/2
-            area = (rois[nroi,4] - rois[nroi,2] + 1 )*(rois[nroi,3] - rois[nroi,1] + 1)
-            score_in_roi = cls_score[0,1:,np.ceil(roi_y1):np.floor(roi_y2),np.ceil(roi_x1):np.floor(roi_x2)]
-            max_score_in_roi = score_in_roi.max(axis = 1).reshape((shape[2]* shape[3]))
-            sorted_score = np.sort(max_score_in_roi)
-            
-            for x in xrange(np.ceil(roi_x1),np.floor(roi_x2)):
-                for y in xrange(np.ceil(roi_y1),np.floor(roi_y2)):
-                    point2top = (y - roi_y1)/self._roi_scale
-                    point2left = (x - roi_x1)/self._roi_scale
-                    point2bottom =( - y + roi_y2)/self._roi_scale
-                    point2right = (- x + roi_x2)/self._roi_scale
-                    top_bound = 0
-                    catetory_cls_labels[0,rois[nroi, 0], y,x] = 1
-                    for i in xrange(self._num_region_one_side / 2 ): #bound begin from 0
-                        if self._region_bound_x[i] <  point2left and point2left < self._region_bound_x[1 + i]:
-                            x_ind = self._num_region_one_side / 2 - i - 1
-                            for j in xrange(self._num_region_one_side / 2 ): 
-                                if self._region_bound_y[j] <  point2top:
-                                    y_ind = self._num_region_one_side / 2 - j - 1
-                                    bbox_cls_labels[0,(rois[nroi, 0] - 1) * self._num_region + y_ind * self._num_region_one_side + x_ind ,y,x] = 1
-                                    count += 1
-                                if self._region_bound_y[j] <  point2bottom:
-                                    y_ind = self._num_region_one_side / 2 + j - 1
-                                    bbox_cls_labels[0,(rois[nroi, 0] - 1) * self._num_region + y_ind * self._num_region_one_side + x_ind ,y,x] = 1
-                                    count += 1
-                            bbox_reg_labels[0,(rois[nroi, 0] - 1) *self._num_region_one_side * 2 + x_ind   ,y,x] = (point2left - (self._region_bound_x[-1] -self._region_bound_x[1 + i] ))/(self._region_bound_x[1 + i] - self._region_bound_x[i]) - 0.5
-                            bbox_inweights[0,(rois[nroi, 0] - 1) *self._num_region_one_side * 2 + x_ind   ,y,x]= 1
-                        if self._region_bound_x[i] <  point2right and point2right < self._region_bound_x[1 + i]:
-                            x_ind = self._num_region_one_side / 2 + i - 1
-                            for j in xrange(self._num_region_one_side / 2 ): 
-                                if self._region_bound_x[j] <  point2top:
-                                    y_ind = self._num_region_one_side / 2 - j - 1
-                                    bbox_cls_labels[0,(rois[nroi, 0] - 1) * self._num_region + y_ind * self._num_region_one_side + x_ind ,y,x] = 1
-                                    count += 1
-                                if self._region_bound_x[j] <  point2bottom:
-                                    y_ind = self._num_region_one_side / 2 + j - 1
-                                    bbox_cls_labels[0,(rois[nroi, 0] - 1) * self._num_region + y_ind * self._num_region_one_side + x_ind ,y,x] = 1
-                                    count += 1
-                            bbox_reg_labels[0,(rois[nroi, 0] - 1) *self._num_region_one_side * 2 + x_ind   ,y,x] =(point2right -  (self._region_bound_x[-1] -self._region_bound_x[1 + i] ))/(self._region_bound_x[1 + i] - self._region_bound_x[i]) - 0.5
-                            bbox_inweights[0,(rois[nroi, 0] - 1) *self._num_region_one_side * 2 + x_ind   ,y,x]= 1
-                    
-                    for i in xrange(self._num_region_one_side / 2 ): #bound begin from 0
-                        if self._region_bound_y[i] <  point2top and point2top < self._region_bound_y[1 + i]:
-                            y_ind = self._num_region_one_side / 2 - i - 1
-                            for j in xrange(self._num_region_one_side / 2 ): 
-                                if self._region_bound_x[j] <  point2left:
-                                    x_ind = self._num_region_one_side / 2 - j - 1
-                                    bbox_cls_labels[0,(rois[nroi, 0] - 1) * self._num_region + y_ind * self._num_region_one_side + x_ind ,y,x] = 1
-                                    count += 1
-                                if self._region_bound_x[j] <  point2bright:
-                                    x_ind = self._num_region_one_side / 2 + j - 1
-                                    bbox_cls_labels[0,(rois[nroi, 0] - 1) * self._num_region + y_ind * self._num_region_one_side + x_ind ,y,x] = 1
-                                    count += 1
-                            bbox_reg_labels[0,(rois[nroi, 0] - 1) *self._num_region_one_side * 2 + self._num_region_one_side+ y_ind   ,y,x] = (point2top -  (self._region_bound_y[-1] -self._region_bound_y[1 + i] ))/(self._region_bound_y[1 + i] - self._region_bound_y[i]) - 0.5
-                            bbox_inweights[0,(rois[nroi, 0] - 1) *self._num_region_one_side * 2 + self._num_region_one_side+y_ind   ,y,x]= 
-                            
-                        if self._region_bound_y[i] <  point2bottom and point2bottom < self._region_bound_y[1 + i]:
-                            y_ind = self._num_region_one_side / 2 + i - 1
-                            for j in xrange(self._num_region_one_side / 2 ): 
-                                if self._region_bound_x[j] <  point2left:
-                                    x_ind = self._num_region_one_side / 2 - j - 1
-                                    bbox_cls_labels[0,(rois[nroi, 0] - 1) * self._num_region + y_ind * self._num_region_one_side + x_ind ,y,x] = 1
-                                    count += 1
-                                if self._region_bound_x[j] <  point2bright:
-                                    x_ind = self._num_region_one_side / 2 + j - 1
-                                    bbox_cls_labels[0,(rois[nroi, 0] - 1) * self._num_region + y_ind * self._num_region_one_side + x_ind ,y,x] = 1
-                                    count += 1
-                            bbox_reg_labels[0,(rois[nroi, 0] - 1) *self._num_region_one_side * 2 + self._num_region_one_side+ y_ind   ,y,x] = (point2bottom -  (self._region_bound_y[-1] -self._region_bound_y[1 + i] ))/(self._region_bound_y[1 + i] - self._region_bound_y[i]) - 0.5
-                            bbox_inweights[0,(rois[nroi, 0] - 1) *self._num_region_one_side * 2 + self._num_region_one_side+y_ind   ,y,x]= 1
-            count -= 4
-            
-        
-            top[0].reshape(*(catetory_cls_labels.shape))
-            top[1].reshape(*(bbox_cls_labels.shape))
-            top[2].reshape(*(bbox_reg_labels.shape))
-            top[3].reshape(*(bbox_inweights.shape))
-            top[4].reshape(*(bbox_outweights.shape))
-            # Copy data into net's input blobs
-            top[0].data[...] = catetory_cls_labels
-            top[1].data[...] = bbox_cls_labels
-            top[2].data[...] = bbox_reg_labels
-            top[3].data[...] = bbox_inweights
-            top[4].data[...] = bbox_outweights
+        bbox_reg_labels = top_data(top[2], (cfg.TRAIN.IMS_PER_BATCH, self._num_classes * self._num_region_one_side * 2 , shape[2], shape[3]))
+        bbox_inweights = top_data(top[3], (cfg.TRAIN.IMS_PER_BATCH, self._num_classes * self._num_region_one_side * 2 , shape[2], shape[3]))
+        bbox_outweights = top_data(top[4], (cfg.TRAIN.IMS_PER_BATCH, self._num_classes * self._num_region_one_side * 2,shape[2], shape[3]))
+        catetory_cls_labels[...] = 0
+        box_labels = (bbox_cls_labels, bbox_reg_labels, bbox_inweights)
+        if self._written is not None and self._written[0] == shape:
+            for labels in box_labels:
+                clear_pixels(labels, *self._written[1:])
+        else:
+            for labels in box_labels:
+                labels[...] = 0
+            bbox_outweights[...] = 1
+
+        # rois are (cls, x1, y1, x2, y2)
+        classes = rois[:, 0].astype(np.int)
+        boxes = rois[:, 1:5].astype(np.float64) * self._roi_scale
+        roi_inds, xs, ys = rasterize_rois(boxes, shape[2], shape[3])
+        # every roi marks its class, whoever owns the pixel
+        catetory_cls_labels[0, classes[roi_inds], ys, xs] = 1
+
+        scores = cls_score[0, classes[roi_inds], ys, xs]
+        keep = resolve_overlaps(roi_inds, xs, ys, shape[3],
+                                overlap_priority(cfg.TRAIN.box_anno_overlap, boxes, roi_inds, scores))
+        roi_inds, xs, ys = roi_inds[keep], xs[keep], ys[keep]
+        self._written = (shape, xs, ys)
+        self._fill_sum += keep.shape[0] / float(shape[2] * shape[3])
+        self._forwards += 1
+
+        cls_labels, reg_labels, reg_weights = pixel_box_labels(
+            boxes, roi_inds, xs, ys, self._roi_scale, self._bucketizer, classes[roi_inds])
+        c = classes[roi_inds] - 1
+        scatter_channels(bbox_cls_labels, c * self._num_region, xs, ys, cls_labels)
+        scatter_channels(bbox_reg_labels, c * self._num_region_one_side * 2, xs, ys, reg_labels)
+        scatter_channels(bbox_inweights, c * self._num_region_one_side * 2, xs, ys, reg_weights)
+
+    def fill_ratio(self):
+        """Mean fraction of label map pixels written per forward."""
+        return self._fill_sum / max(self._forwards, 1)
 
     def backward(self, top, propagate_down, bottom):
         """This layer does not propagate gradients."""
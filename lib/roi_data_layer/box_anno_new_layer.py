@@ -17,6 +17,11 @@ import numpy as np
 import yaml
 from multiprocessing import Process, Queue
 import scipy.io as sio
+from roi_data_layer.region_bucketizer import get_bucketizer
+from utils.top_blobs import top_data
+from roi_data_layer.dense_labels import rasterize_rois, rank_in_roi, \
+    resolve_overlaps, overlap_priority, pixel_box_labels, scatter_channels, \
+    clear_pixels
 class RoIDataLayer(caffe.Layer):
     """Fast R-CNN data layer used for training."""
 
@@ -29,7 +34,7 @@ class RoIDataLayer(caffe.Layer):
         shape = bottom[0].data.shape #1, C, H, W
 
         self._num_region = layer_params['num_region']
-        self._num_region_one_side = np.sqrt(self._num_region )
+        self._num_region_one_side = int(np.sqrt(self._num_region ))
         self._num_classes = layer_params['num_classes']
         self._agnostic_box = layer_params['agnostic_box']
         if self._agnostic_box :
@@ -39,7 +44,15 @@ class RoIDataLayer(caffe.Layer):
         self._name_to_top_map = {}
         self._num_roi = bottom[1].data.shape[0]
         self._roi_scale = layer_params['roi_scale']
-        self._region_bound = sio.loadmat('region_boundary.mat')
+        self._mini_point = layer_params.get('mini_point', cfg.TRAIN.M)
+        # (feature map shape, xs, ys) of the pixels written by the last
+        # forward, the only nonzero ones of the box label maps
+        self._written = None
+        # fraction of label map pixels written, summed over forwards
+        self._fill_sum = 0.0
+        self._forwards = 0
+        self._bucketizer = get_bucketizer(self._num_region_one_side,
+                                          cfg.TRAIN.num_classes if cfg.TRAIN.class_bounds else None)
 
         
         # data blob: holds a batch of N images, each with 3 channels
@@ -77,144 +90,83 @@ class RoIDataLayer(caffe.Layer):
     def forward(self, bottom, top):
         """Get blobs and copy them into this layer's top blob vector."""
         rois = bottom[1].data
+        rois = rois.reshape((rois.shape[0], rois.shape[1]))
         # bottom[0] 
         #
         # bottom[0] cls_score map (1, (K+1), H, W)
         cls_score = bottom[0].data
-        catetory_cls_labels = -np.ones((cfg.TRAIN.IMS_PER_BATCH, self._num_classes + 1 , shape[2], shape[3]))
-        bbox_cls_labels = np.zeros((cfg.TRAIN.IMS_PER_BATCH, 1 , shape[2], shape[3]))
+        shape = cls_score.shape
+        # label maps are written in place in the top blobs
+        catetory_cls_labels = top_data(top[0], (cfg.TRAIN.IMS_PER_BATCH, self._num_classes + 1 , shape[2], shape[3]))
+        bbox_cls_labels = top_data(top[1], (cfg.TRAIN.IMS_PER_BATCH, self._num_classes_box * self._num_region , shape[2], shape[3]))
         
-        bbox_cls_inweights = np.zeros((cfg.TRAIN.IMS_PER_BATCH, self._num_classes_box * self._num_region , shape[2], shape[3]))
-        bbox_cls_outweights = np.ones((cfg.TRAIN.IMS_PER_BATCH, self._num_classes_box * self._num_region , shape[2], shape[3]))
+        bbox_cls_inweights = top_data(top[3], (cfg.TRAIN.IMS_PER_BATCH, self._num_classes_box * self._num_region , shape[2], shape[3]))
+        bbox_cls_outweights = top_data(top[4], (cfg.TRAIN.IMS_PER_BATCH, self._num_classes_box * self._num_region , shape[2], shape[3]))
         
-        bbox_reg_labels = np.zeros((cfg.TRAIN.IMS_PER_BATCH, self._num_classes_box * self._num_region_one_side * 2 , shape[2], shape[3]))
-        bbox_inweights = np.zeros((cfg.TRAIN.IMS_PER_BATCH, self._num_classes_box * self._num_region_one_side * 2 , shape[2], shape[3]))
-        bbox_outweights = np.ones((cfg.TRAIN.IMS_PER_BATCH, self._num_classes_box * self._num_region_one_side * 2,shape[2], shape[3]))
-        
-        for nroi in xrange(self._num_roi):
-            count = 0
-            roi_x1 =  rois[nroi,1] * self._roi_scale
-            roi_y1 =  rois[nroi,2] * self._roi_scale
-            roi_x2 =  rois[nroi,3] * self._roi_scale
-            roi_y2 =  rois[nroi,4] * self._roi_scale
-            center_w = (roi_x1 + roi_x2)/2
-            center_h = (roi_y1 + roi_y2)/2
-
-            extend_roi_x1 = np.maximize(0, np.floor(center_w - (roi_x2 - roi_x1)*0.7))
-            extend_roi_x2 = np.minimize(shape[3], np.floor(center_w + (roi_x2 - roi_x1)*0.7))
-            extend_roi_y1 = np.maximize(0, np.floor(center_w - (roi_y2 - roi_y1)*0.7))
-            extend_roi_y2 = np.minimize(shape[2], np.floor(center_w + (roi_y2 - roi_y1)*0.7))
-            catetory_cls_labels[0,:,extend_roi_y1:extend_roi_y2,extend_roi_x1:extend_roi_x1] = 0
-            catetory_cls_labels[0,0,extend_roi_y1:extend_roi_y2,extend_roi_x1:extend_roi_x1] = 1
-            catetory_cls_labels[0,rois[nroi, 0],np.ceil(roi_y1):np.floor(roi_y2),np.ceil(roi_x1):np.floor(roi_x2)] = 1
-            catetory_cls_labels[0,0,np.ceil(roi_y1):np.floor(roi_y2),np.ceil(roi_x1):np.floor(roi_x2)] = 0
-            
-
-            
-            #area = (rois[nroi,4] - rois[nroi,2] + 1 )*(rois[nroi,3] - rois[nroi,1] + 1)
-            score_in_roi = cls_score[0,:,np.ceil(roi_y1):np.floor(roi_y2),np.ceil(roi_x1):np.floor(roi_x2)]
-            max_score_in_roi = score_in_roi[0,rois[nroi,0],:,:].reshape((score_in_roi.shape[2]* score_in_roi.shape[3]))
-            area = max_score_in_roi.shape[0]
-            sorted_score = np.sort(max_score_in_roi)
-            arg_sorted_score = np.argsort(max_score_in_roi)
-
-            num_conf_point_in_roi = np.minimize(self._mini_point, area)
-            nnn = len(np.where(sorted_score > 0.8)[0])
-            num_conf_point_in_roi = np.maximize(nnn,num_conf_point_in_roi)
-            if self._agnostic_box:
-                box_category_label = np.minimize(0,rois[nroi,0])
-            else:
-                box_category_label = rois[nroi,0] - 1
-            
-
-            for conf_i in xrange(num_conf_point_in_roi):
-                ind = arg_sorted_score[conf_i]
-                x = ind % (np.ceil(roi_x2) - np.floor(roi_x2)  + 1)
-                y = ind / (np.ceil(roi_x2) - np.floor(roi_x2)  + 1)
-                point2top = (y - roi_y1)/self._roi_scale
-                point2left = (x - roi_x1)/self._roi_scale
-                point2bottom =( - y + roi_y2)/self._roi_scale
-                point2right = (- x + roi_x2)/self._roi_scale
-                top_bound = 0
-
-                
-                bbox_cls_inweights[0,box_category_label * self._num_region: (box_category_label+1) * self._num_region,y,x] = 1/num_conf_point_in_roi
-
-                for i in xrange(self._num_region_one_side / 2 ): #bound begin from 0
-                    if self._region_bound_x[i] <  point2left and point2left < self._region_bound_x[1 + i]:
-                        x_ind = self._num_region_one_side / 2 - i - 1
-                        for j in xrange(self._num_region_one_side / 2 ): 
-                            if self._region_bound_y[j] <  point2top:
-                                y_ind = self._num_region_one_side / 2 - j - 1
-                                bbox_cls_labels[0,(box_category_label) * self._num_region + y_ind * self._num_region_one_side + x_ind ,y,x] = 1
-                                count += 1
-                            if self._region_bound_y[j] <  point2bottom:
-                                y_ind = self._num_region_one_side / 2 + j - 1
-                                bbox_cls_labels[0,(box_category_label) * self._num_region + y_ind * self._num_region_one_side + x_ind ,y,x] = 1
-                                count += 1
-                        bbox_reg_labels[0,(box_category_label) *self._num_region_one_side * 2 + x_ind   ,y,x] = ( self._region_bound_x[1 + i] - point2left))/(self._region_bound_x[1 + i] - self._region_bound_x[i]) - 0.5
-                        bbox_inweights[0,(box_category_label) *self._num_region_one_side * 2 + x_ind   ,y,x]= 1
-                    if self._region_bound_x[i] <  point2right and point2right < self._region_bound_x[1 + i]:
-                        x_ind = self._num_region_one_side / 2 + i - 1
-                        for j in xrange(self._num_region_one_side / 2 ): 
-                            if self._region_bound_x[j] <  point2top:
-                                y_ind = self._num_region_one_side / 2 - j - 1
-                                bbox_cls_labels[0,(box_category_label) * self._num_region + y_ind * self._num_region_one_side + x_ind ,y,x] = 1
-                                count += 1
-                            if self._region_bound_x[j] <  point2bottom:
-                                y_ind = self._num_region_one_side / 2 + j - 1
-                                bbox_cls_labels[0,(box_category_label) * self._num_region + y_ind * self._num_region_one_side + x_ind ,y,x] = 1
-                                count += 1
-                        bbox_reg_labels[0,(box_category_label) *self._num_region_one_side * 2 + x_ind   ,y,x] = ( self._region_bound_x[1 + i] - point2right))/(self._region_bound_x[1 + i] - self._region_bound_x[i]) - 0.5
-                        bbox_inweights[0,(box_category_label) *self._num_region_one_side * 2 + x_ind   ,y,x]= 1
-                
-                for i in xrange(self._num_region_one_side / 2 ): #bound begin from 0
-                    if self._region_bound_y[i] <  point2top and point2top < self._region_bound_y[1 + i]:
-                        y_ind = self._num_region_one_side / 2 - i - 1
-                        for j in xrange(self._num_region_one_side / 2 ): 
-                            if self._region_bound_x[j] <  point2left:
-                                x_ind = self._num_region_one_side / 2 - j - 1
-                                bbox_cls_labels[0,(box_category_label) * self._num_region + y_ind * self._num_region_one_side + x_ind ,y,x] = 1
-                                count += 1
-                            if self._region_bound_x[j] <  point2bright:
-                                x_ind = self._num_region_one_side / 2 + j - 1
-                                bbox_cls_labels[0,box_category_label * self._num_region + y_ind * self._num_region_one_side + x_ind ,y,x] = 1
-                                count += 1
-                        bbox_reg_labels[0,box_category_label*self._num_region_one_side * 2 + self._num_region_one_side+ y_ind   ,y,x] = ( self._region_bound_y[1 + i] - point2top )/(self._region_bound_y[1 + i] - self._region_bound_y[i]) - 0.5
-                        bbox_inweights[0,box_category_label *self._num_region_one_side * 2 + self._num_region_one_side+y_ind   ,y,x]= 
-                            
-                    if self._region_bound_y[i] <  point2bottom and point2bottom < self._region_bound_y[1 + i]:
-                        y_ind = self._num_region_one_side / 2 + i - 1
-                        for j in xrange(self._num_region_one_side / 2 ): 
-                            if self._region_bound_x[j] <  point2left:
-                                x_ind = self._num_region_one_side / 2 - j - 1
-                                bbox_cls_labels[0,box_category_label * self._num_region + y_ind * self._num_region_one_side + x_ind ,y,x] = 1
-                                count += 1
-                            if self._region_bound_x[j] <  point2bright:
-                                x_ind = self._num_region_one_side / 2 + j - 1
-                                bbox_cls_labels[0,box_category_label* self._num_region + y_ind * self._num_region_one_side + x_ind ,y,x] = 1
-                                count += 1
-                        bbox_reg_labels[0,box_category_label*self._num_region_one_side * 2 + self._num_region_one_side+ y_ind   ,y,x] = ( self._region_bound_y[1 + i] -point2bottom )/(self._region_bound_y[1 + i] - self._region_bound_y[i]) - 0.5
-                        bbox_inweights[0,box_category_label*self._num_region_one_side * 2 + self._num_region_one_side+y_ind   ,y,x]= 1
-                count -= 4
-            
-        
-            top[0].reshape(*(catetory_cls_labels.shape))
-            top[1].reshape(*(bbox_cls_labels.shape))
-            top[2].reshape(*(bbox_reg_labels.shape))
-            top[3].reshape(*(bbox_cls_inweights.shape))
-            top[4].reshape(*(bbox_cls_outweights.shape))
-            top[5].reshape(*(bbox_inweights.shape))
-            top[6].reshape(*(bbox_outweights.shape))
-            # Copy data into net's input blobs
-            top[0].data[...] = catetory_cls_labels
-            top[1].data[...] = bbox_cls_labels
-            top[2].data[...] = bbox_reg_labels
-            top[3].data[...] = bbox_cls_inweights
-            top[4].data[...] = bbox_cls_outweights
-            top[5].data[...] = bbox_inweights
-            top[6].data[...] = bbox_outweights
-
+        bbox_reg_labels = top_data(top[2], (cfg.TRAIN.IMS_PER_BATCH, self._num_classes_box * self._num_region_one_side * 2 , shape[2], shape[3]))
+        bbox_inweights = top_data(top[5], (cfg.TRAIN.IMS_PER_BATCH, self._num_classes_box * self._num_region_one_side * 2 , shape[2], shape[3]))
+        bbox_outweights = top_data(top[6], (cfg.TRAIN.IMS_PER_BATCH, self._num_classes_box * self._num_region_one_side * 2,shape[2], shape[3]))
+        catetory_cls_labels[...] = -1
+        box_labels = (bbox_cls_labels, bbox_cls_inweights, bbox_reg_labels, bbox_inweights)
+        if self._written is not None and self._written[0] == shape:
+            for labels in box_labels:
+                clear_pixels(labels, *self._written[1:])
+        else:
+            for labels in box_labels:
+                labels[...] = 0
+            bbox_cls_outweights[...] = 1
+            bbox_outweights[...] = 1
+
+        # rois are (cls, x1, y1, x2, y2)
+        classes = rois[:, 0].astype(np.int)
+        boxes = rois[:, 1:5].astype(np.float64) * self._roi_scale
+
+        # background around every roi (0.7 x its size from the center) is
+        # labelled, the rest of the map is ignored (-1)
+        centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+        sizes = boxes[:, 2:] - boxes[:, :2]
+        extend_lo = np.maximum(0, np.floor(centers - sizes * 0.7)).astype(np.int)
+        extend_hi = np.minimum((shape[3], shape[2]), np.floor(centers + sizes * 0.7)).astype(np.int)
+        for nroi in xrange(rois.shape[0]):
+            extend = catetory_cls_labels[0, :, extend_lo[nroi, 1]:extend_hi[nroi, 1], extend_lo[nroi, 0]:extend_hi[nroi, 0]]
+            extend[...] = 0
+            extend[0] = 1
+        roi_inds, xs, ys = rasterize_rois(boxes, shape[2], shape[3])
+        catetory_cls_labels[0, classes[roi_inds], ys, xs] = 1
+        catetory_cls_labels[0, 0, ys, xs] = 0
+
+        # seed points: the mini_point most confident pixels of every roi, or
+        # all pixels scoring above 0.8 if there are more of those
+        scores = cls_score[0, classes[roi_inds], ys, xs]
+        areas = np.bincount(roi_inds, minlength=rois.shape[0])
+        num_confident = np.bincount(roi_inds, weights=scores > 0.8, minlength=rois.shape[0]).astype(np.int)
+        num_conf_point_in_roi = np.maximum(num_confident, np.minimum(self._mini_point, areas))
+        seeds = np.where(rank_in_roi(roi_inds, scores) < num_conf_point_in_roi[roi_inds])[0]
+        roi_inds, xs, ys, scores = roi_inds[seeds], xs[seeds], ys[seeds], scores[seeds]
+
+        keep = resolve_overlaps(roi_inds, xs, ys, shape[3],
+                                overlap_priority(cfg.TRAIN.box_anno_overlap, boxes, roi_inds, scores))
+        roi_inds, xs, ys = roi_inds[keep], xs[keep], ys[keep]
+        self._written = (shape, xs, ys)
+        self._fill_sum += keep.shape[0] / float(shape[2] * shape[3])
+        self._forwards += 1
+
+        if self._agnostic_box:
+            box_category_label = 0 - np.minimum(0, classes[roi_inds])
+        else:
+            box_category_label = classes[roi_inds] - 1
+        cls_labels, reg_labels, reg_weights = pixel_box_labels(
+            boxes, roi_inds, xs, ys, self._roi_scale, self._bucketizer, classes[roi_inds])
+        inweights = np.tile(1.0 / num_conf_point_in_roi[roi_inds][:, np.newaxis], (1, self._num_region))
+        scatter_channels(bbox_cls_inweights, box_category_label * self._num_region, xs, ys, inweights)
+        scatter_channels(bbox_cls_labels, box_category_label * self._num_region, xs, ys, cls_labels)
+        scatter_channels(bbox_reg_labels, box_category_label * self._num_region_one_side * 2, xs, ys, reg_labels)
+        scatter_channels(bbox_inweights, box_category_label * self._num_region_one_side * 2, xs, ys, reg_weights)
+
+
+    def fill_ratio(self):
+        """Mean fraction of label map pixels written per forward."""
+        return self._fill_sum / max(self._forwards, 1)
 
     def backward(self, top, propagate_down, bottom):
         """This layer does not propagate gradients."""
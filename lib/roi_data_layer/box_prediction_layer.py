@@ -5,340 +5,109 @@
 # Written by Ross Girshick
 # --------------------------------------------------------
 
-"""Test a Fast R-CNN network on an imdb (image database)."""
+"""Decode seed-point box predictions into boxes at test time.
 
-from fast_rcnn.config import cfg, get_output_dir
-from fast_rcnn.bbox_transform import clip_boxes, bbox_transform_inv
-import argparse
-from utils.timer import Timer
-import numpy as np
-import cv2
-import caffe
-from fast_rcnn.nms_wrapper import nms
-import cPickle
-from utils.blob import im_list_to_blob
-import os
-
-
-
-def box_prediction(ori_cls_score, bbox_cls, bbox_reg):
-    # on 600 scale
-    cls_score = np.max(ori_cls_score[0,:,:,1:,:,:],axis = [0,1])
-
-    max_score = cls_score.max(axis = 1).reshape((cls_score.shape[2]*cls_score.shape[3]))
-    seed_point_ind = np.where(max_score > 0.7)[0]
-    num_regions_one_side= np.sqrt(cfg.TRAIN.num_regions)
-    pred_boxes = np.zeros((len(seed_point_ind),5))
-    for i in xrange(len(seed_point_ind)):
-        ww = seed_point_ind % cls_score.shape[3]
-        hh = seed_point_ind / cls_score.shape[3]
-
-        seed_cls = np.argmax(cls_score[0,:,hh,ww])
-        if cfg.TRAIN.agnostic_box:
-            seed_bbox_cls = bbox_cls[0,:,hh,ww ]
-            seed_bbox_reg = bbox_reg[0,:,hh,ww ]
-        else:
-            seed_bbox_cls = bbox_cls[0,seed_cls*cfg.TRAIN.num_regions,hh,ww ]
-            seed_bbox_reg = bbox_reg[0,seed_cls*np.sqrt(cfg.TRAIN.num_regions)*2:(seed_cls+1)*np.sqrt(cfg.TRAIN.num_regions)*2,hh,ww ]
-            #(num_region)
-        seed_bbox_cls = seed_bbox_cls.reshape((np.sqrt(cfg.TRAIN.num_regions),np.sqrt(cfg.TRAIN.num_regions)))
-        seed_bbox_reg = seed_bbox_reg.reshape((np.sqrt(cfg.TRAIN.num_regions)*2,2))
-        hori_pool = seed_bbox_cls.mean(axis = 1)
-        vert_pool = seed_bbox_cls.mean(axis = 1)
-        line_x1 = np.argmax(hori_pool[0:num_regions_one_side/2 ])
-        line_x2 = np.argmax(hori_pool[num_regions_one_side/2: ]) 
-        line_y1 = np.argmax(vert_pool[0:num_regions_one_side/2 ])
-        line_y2 = np.argmax(vert_pool[num_regions_one_side/2: ])
-        
-        box_x1 = （seed_bbox_reg[line_x1]  + 0.5 ）* (cfg.TRAIN.bound_x[num_regions_one_side - line_x1 + 1]-cfg.TRAIN.bound_x[num_regions_one_side - line_x1 ]) + ( ww*cfg.TRAIN.feat_stride - cfg.TRAIN.bound_x[num_regions_one_side - line_x1 + 1] ) 
-        box_x2 = -（seed_bbox_reg[line_x2+ num_regions_one_side/2 ]  + 0.5 ）* (cfg.TRAIN.bound_x[ line_x2 + 1] - cfg.TRAIN.bound_x[ line_x2 ]) + ww*cfg.TRAIN.feat_stride + cfg.TRAIN.bound_x[line_x2 + 1]) 
-        box_y1 = (seed_bbox_reg[line_y1+num_regions_one_side]  + 0.5 ）* (cfg.TRAIN.bound_y[num_regions_one_side - line_y1 + 1]-cfg.TRAIN.bound_y[num_regions_one_side - line_y1 ]) + ( ww*cfg.TRAIN.feat_stride - cfg.TRAIN.bound_y[num_regions_one_side - line_y1 + 1] ) 
-        box_y2 = -（seed_bbox_reg[line_y2+ num_regions_one_side*3/2 ]  + 0.5 ）* (cfg.TRAIN.bound_y[ line_y2 + 1] - cfg.TRAIN.bound_y[ line_y2 ]) + ww*cfg.TRAIN.feat_stride + cfg.TRAIN.bound_y[line_y2 + 1]) 
-        pred_boxes[i,0] = max_score[hh,ww]
-        pred_boxes[i,1] = box_x1
-        pred_boxes[i,2] = box_y1
-        pred_boxes[i,3] = box_x2
-        pred_boxes[i,4] = box_y2
-    return cls_score,pred_boxes
-
-
-
-        
-        
-def _get_image_blob(im):
-    """Converts an image into a network input.
-
-    Arguments:
-        im (ndarray): a color image in BGR order
-
-    Returns:
-        blob (ndarray): a data blob holding an image pyramid
-        im_scale_factors (list): list of image scales (relative to im) used
-            in the image pyramid
-    """
-    im_orig = im.astype(np.float32, copy=True)
-    im_orig -= cfg.PIXEL_MEANS
-
-    im_shape = im_orig.shape
-    im_size_min = np.min(im_shape[0:2])
-    im_size_max = np.max(im_shape[0:2])
+Every feature map pixel whose best foreground score passes a threshold is a
+seed. Its bbox_cls scores over the num_regions_one_side x num_regions_one_side
+region grid say which column (row) each RoI side falls in, and its bbox_reg
+output says where the side sits inside that region -- the inverse of the
+labelling done by roi_data_layer.seed_labels. All seeds are decoded at once.
+"""
 
-    processed_ims = []
-    im_scale_factors = []
-
-    for target_size in cfg.TEST.SCALES:
-        im_scale = float(target_size) / float(im_size_min)
-        # Prevent the biggest axis from being more than MAX_SIZE
-        if np.round(im_scale * im_size_max) > cfg.TEST.MAX_SIZE:
-            im_scale = float(cfg.TEST.MAX_SIZE) / float(im_size_max)
-        im = cv2.resize(im_orig, None, None, fx=im_scale, fy=im_scale,
-                        interpolation=cv2.INTER_LINEAR)
-        im_scale_factors.append(im_scale)
-        processed_ims.append(im)
-
-    # Create a blob to hold the input images
-    blob = im_list_to_blob(processed_ims)
+import numpy as np
+from fast_rcnn.config import cfg
 
-    return blob, np.array(im_scale_factors)
 
-def _get_rois_blob(im_rois, im_scale_factors):
-    """Converts RoIs into network inputs.
+def select_box_seeds(cls_score, thresh, top_k=0):
+    """Seed pixels of a class score map, highest score first.
 
     Arguments:
-        im_rois (ndarray): R x 4 matrix of RoIs in original image coordinates
-        im_scale_factors (list): scale factors as returned by _get_image_blob
+        cls_score (ndarray): 1 x (C + 1) x H x W class scores, background first
+        thresh (float): keep pixels whose best foreground score is > thresh
+        top_k (int): keep at most this many seeds (0 keeps all)
 
     Returns:
-        blob (ndarray): R x 5 matrix of RoIs in the image pyramid
+        xs, ys (ndarray): seed positions on the feature map
+        scores (ndarray): best foreground score per seed
+        classes (ndarray): best foreground class per seed (1 .. C)
     """
-    rois, levels = _project_im_rois(im_rois, im_scale_factors)
-    rois_blob = np.hstack((levels, rois))
-    return rois_blob.astype(np.float32, copy=False)
-
-def _project_im_rois(im_rois, scales):
-    """Project image RoIs into the image pyramid built by _get_image_blob.
+    fg_score = cls_score[0, 1:].reshape((cls_score.shape[1] - 1, -1))
+    max_score = fg_score.max(axis=0)
+    inds = np.where(max_score > thresh)[0]
+    if top_k > 0 and inds.shape[0] > top_k:
+        inds = inds[np.argpartition(-max_score[inds], top_k - 1)[:top_k]]
+    # stable, so ties keep raster order
+    inds = inds[np.argsort(-max_score[inds], kind='mergesort')]
+    width = cls_score.shape[3]
+    return inds % width, inds // width, max_score[inds], \
+        fg_score[:, inds].argmax(axis=0) + 1
+
+
+def box_prediction(cls_score, bbox_cls, bbox_reg, bucketizer,
+                   thresh=None, top_k=None, spatial_scale=None):
+    """Boxes predicted by every seed of one image.
+
+    The head is class agnostic when bbox_cls has S * S channels, otherwise
+    it has S * S channels per foreground class, as the annotation layers
+    lay out their labels.
 
     Arguments:
-        im_rois (ndarray): R x 4 matrix of RoIs in original image coordinates
-        scales (list): scale factors as returned by _get_image_blob
+        cls_score (ndarray): 1 x (C + 1) x H x W class scores
+        bbox_cls (ndarray): 1 x (S * S or C * S * S) x H x W region scores
+        bbox_reg (ndarray): 1 x (2S or C * 2S) x H x W region offsets
+        bucketizer (RegionBucketizer): region bounds used in training
+        thresh (float): seed score threshold (cfg.TEST.SEED_THRESH)
+        top_k (int): keep at most this many seeds, 0 keeps all
+            (cfg.TEST.SEED_TOP_K)
+        spatial_scale (float): image -> feature map scale
+            (cfg.TRAIN.spatial_scale by default)
 
     Returns:
-        rois (ndarray): R x 4 matrix of projected RoI coordinates
-        levels (list): image pyramid levels used by each projected RoI
+        pred_boxes (ndarray): N x 5 (score, x1, y1, x2, y2) in network input
+            coordinates, highest score first
+        pred_classes (ndarray): N predicted classes
     """
-    im_rois = im_rois.astype(np.float, copy=False)
-
-    if len(scales) > 1:
-        widths = im_rois[:, 2] - im_rois[:, 0] + 1
-        heights = im_rois[:, 3] - im_rois[:, 1] + 1
-
-        areas = widths * heights
-        scaled_areas = areas[:, np.newaxis] * (scales[np.newaxis, :] ** 2)
-        diff_areas = np.abs(scaled_areas - 224 * 224)
-        levels = diff_areas.argmin(axis=1)[:, np.newaxis]
+    if thresh is None:
+        thresh = cfg.TEST.SEED_THRESH
+    if top_k is None:
+        top_k = cfg.TEST.SEED_TOP_K
+    if spatial_scale is None:
+        spatial_scale = cfg.TRAIN.spatial_scale
+    S = bucketizer.num_regions_one_side
+    half = bucketizer.half
+    xs, ys, scores, classes = select_box_seeds(cls_score, thresh, top_k)
+    num = xs.shape[0]
+
+    if bbox_cls.shape[1] == S * S:
+        c = np.zeros(num, dtype=np.int)
     else:
-        levels = np.zeros((im_rois.shape[0], 1), dtype=np.int)
-
-    rois = im_rois * scales[levels]
-
-    return rois, levels
-
-def _get_blobs(im, rois):
-    """Convert an image and RoIs within that image into network inputs."""
-    blobs = {'data' : None, 'rois' : None}
-    blobs['data'], im_scale_factors = _get_image_blob(im)
-    if not cfg.TEST.HAS_RPN:
-        blobs['rois'] = _get_rois_blob(rois, im_scale_factors)
-    return blobs, im_scale_factors
-
-def im_detect(net, im, boxes=None):
-    """Detect object classes in an image given object proposals.
-
-    Arguments:
-        net (caffe.Net): Fast R-CNN network to use
-        im (ndarray): color image to test (in BGR order)
-        boxes (ndarray): R x 4 array of object proposals or None (for RPN)
-
-    Returns:
-        scores (ndarray): R x K array of object class scores (K includes
-            background as object category 0)
-        boxes (ndarray): R x (4*K) array of predicted bounding boxes
-    """
-    blobs, im_scales = _get_blobs(im, boxes)
-
-    # When mapping from image ROIs to feature map ROIs, there's some aliasing
-    # (some distinct image ROIs get mapped to the same feature ROI).
-    # Here, we identify duplicate feature ROIs, so we only compute features
-    # on the unique subset.
-    if cfg.DEDUP_BOXES > 0 and not cfg.TEST.HAS_RPN:
-        v = np.array([1, 1e3, 1e6, 1e9, 1e12])
-        hashes = np.round(blobs['rois'] * cfg.DEDUP_BOXES).dot(v)
-        _, index, inv_index = np.unique(hashes, return_index=True,
-                                        return_inverse=True)
-        blobs['rois'] = blobs['rois'][index, :]
-        boxes = boxes[index, :]
-
-    if cfg.TEST.HAS_RPN:
-        im_blob = blobs['data']
-        blobs['im_info'] = np.array(
-            [[im_blob.shape[2], im_blob.shape[3], im_scales[0]]],
-            dtype=np.float32)
-
-    # reshape network inputs
-    net.blobs['data'].reshape(*(blobs['data'].shape))
-    if cfg.TEST.HAS_RPN:
-        net.blobs['im_info'].reshape(*(blobs['im_info'].shape))
-    else:
-        net.blobs['rois'].reshape(*(blobs['rois'].shape))
-
-    # do forward
-    forward_kwargs = {'data': blobs['data'].astype(np.float32, copy=False)}
-    if cfg.TEST.HAS_RPN:
-        forward_kwargs['im_info'] = blobs['im_info'].astype(np.float32, copy=False)
-    else:
-        forward_kwargs['rois'] = blobs['rois'].astype(np.float32, copy=False)
-    blobs_out = net.forward(**forward_kwargs)
-
-    if cfg.TEST.HAS_RPN:
-        assert len(im_scales) == 1, "Only single-image batch implemented"
-        rois = net.blobs['rois'].data.copy()
-        # unscale back to raw image space
-        boxes = rois[:, 1:5] / im_scales[0]
-
-    if cfg.TEST.SVM:
-        # use the raw scores before softmax under the assumption they
-        # were trained as linear SVMs
-        scores = net.blobs['cls_score'].data
-    else:
-        # use softmax estimated probabilities
-        scores = blobs_out['cls_prob']
-
-    if cfg.TEST.BBOX_REG:
-        # Apply bounding-box regression deltas
-        box_deltas = blobs_out['bbox_pred']
-        pred_boxes = bbox_transform_inv(boxes, box_deltas)
-        pred_boxes = clip_boxes(pred_boxes, im.shape)
-    else:
-        # Simply repeat the boxes, once for each class
-        pred_boxes = np.tile(boxes, (1, scores.shape[1]))
-
-    if cfg.DEDUP_BOXES > 0 and not cfg.TEST.HAS_RPN:
-        # Map scores and predictions back to the original set of boxes
-        scores = scores[inv_index, :]
-        pred_boxes = pred_boxes[inv_index, :]
-
-    return scores, pred_boxes
-
-def vis_detections(im, class_name, dets, thresh=0.3):
-    """Visual debugging of detections."""
-    import matplotlib.pyplot as plt
-    im = im[:, :, (2, 1, 0)]
-    for i in xrange(np.minimum(10, dets.shape[0])):
-        bbox = dets[i, :4]
-        score = dets[i, -1]
-        if score > thresh:
-            plt.cla()
-            plt.imshow(im)
-            plt.gca().add_patch(
-                plt.Rectangle((bbox[0], bbox[1]),
-                              bbox[2] - bbox[0],
-                              bbox[3] - bbox[1], fill=False,
-                              edgecolor='g', linewidth=3)
-                )
-            plt.title('{}  {:.3f}'.format(class_name, score))
-            plt.show()
-
-def apply_nms(all_boxes, thresh):
-    """Apply non-maximum suppression to all predicted boxes output by the
-    test_net method.
-    """
-    num_classes = len(all_boxes)
-    num_images = len(all_boxes[0])
-    nms_boxes = [[[] for _ in xrange(num_images)]
-                 for _ in xrange(num_classes)]
-    for cls_ind in xrange(num_classes):
-        for im_ind in xrange(num_images):
-            dets = all_boxes[cls_ind][im_ind]
-            if dets == []:
-                continue
-            # CPU NMS is much faster than GPU NMS when the number of boxes
-            # is relative small (e.g., < 10k)
-            # TODO(rbg): autotune NMS dispatch
-            keep = nms(dets, thresh, force_cpu=True)
-            if len(keep) == 0:
-                continue
-            nms_boxes[cls_ind][im_ind] = dets[keep, :].copy()
-    return nms_boxes
-
-def test_net(net, imdb, max_per_image=400, thresh=-np.inf, vis=False):
-    """Test a Fast R-CNN network on an image database."""
-    num_images = len(imdb.image_index)
-    # all detections are collected into:
-    #    all_boxes[cls][image] = N x 5 array of detections in
-    #    (x1, y1, x2, y2, score)
-    all_boxes = [[[] for _ in xrange(num_images)]
-                 for _ in xrange(imdb.num_classes)]
-
-    output_dir = get_output_dir(imdb, net)
-
-    # timers
-    _t = {'im_detect' : Timer(), 'misc' : Timer()}
-
-    if not cfg.TEST.HAS_RPN:
-        roidb = imdb.roidb
-
-    for i in xrange(num_images):
-        # filter out any ground truth boxes
-        if cfg.TEST.HAS_RPN:
-            box_proposals = None
-        else:
-            # The roidb may contain ground-truth rois (for example, if the roidb
-            # comes from the training or val split). We only want to evaluate
-            # detection on the *non*-ground-truth rois. We select those the rois
-            # that have the gt_classes field set to 0, which means there's no
-            # ground truth.
-            box_proposals = roidb[i]['boxes'][roidb[i]['gt_classes'] == 0]
-
-        im = cv2.imread(imdb.image_path_at(i))
-        _t['im_detect'].tic()
-        scores, boxes = im_detect(net, im, box_proposals)
-        _t['im_detect'].toc()
-
-        _t['misc'].tic()
-        # skip j = 0, because it's the background class
-        for j in xrange(1, imdb.num_classes):
-            inds = np.where(scores[:, j] > thresh)[0]
-            cls_scores = scores[inds, j]
-            if cfg.TEST.AGNOSTIC:
-                cls_boxes = boxes[inds, 4:8]
-            else:
-                cls_boxes = boxes[inds, j*4:(j+1)*4]
-            cls_dets = np.hstack((cls_boxes, cls_scores[:, np.newaxis])) \
-                .astype(np.float32, copy=False)
-            keep = nms(cls_dets, cfg.TEST.NMS)
-            cls_dets = cls_dets[keep, :]
-            if vis:
-                vis_detections(im, imdb.classes[j], cls_dets)
-            all_boxes[j][i] = cls_dets
-
-        # Limit to max_per_image detections *over all classes*
-        if max_per_image > 0:
-            image_scores = np.hstack([all_boxes[j][i][:, -1]
-                                      for j in xrange(1, imdb.num_classes)])
-            if len(image_scores) > max_per_image:
-                image_thresh = np.sort(image_scores)[-max_per_image]
-                for j in xrange(1, imdb.num_classes):
-                    keep = np.where(all_boxes[j][i][:, -1] >= image_thresh)[0]
-                    all_boxes[j][i] = all_boxes[j][i][keep, :]
-        _t['misc'].toc()
-
-        print 'im_detect: {:d}/{:d} {:.3f}s {:.3f}s' \
-              .format(i + 1, num_images, _t['im_detect'].average_time,
-                      _t['misc'].average_time)
-
-    det_file = os.path.join(output_dir, 'detections.pkl')
-    with open(det_file, 'wb') as f:
-        cPickle.dump(all_boxes, f, cPickle.HIGHEST_PROTOCOL)
-
-    print 'Evaluating detections'
-    imdb.evaluate_detections(all_boxes, output_dir)
+        c = classes - 1
+    ys_col = ys[:, np.newaxis]
+    xs_col = xs[:, np.newaxis]
+    grid = bbox_cls[0, c[:, np.newaxis] * S * S + np.arange(S * S),
+                    ys_col, xs_col].reshape((num, S, S))
+    reg = bbox_reg[0, c[:, np.newaxis] * S * 2 + np.arange(S * 2),
+                   ys_col, xs_col]
+
+    # rows are y, columns are x; a side is the best line on its half
+    col_score = grid.mean(axis=1)
+    row_score = grid.mean(axis=2)
+    left_col = col_score[:, :half].argmax(axis=1)
+    right_col = half + col_score[:, half:].argmax(axis=1)
+    top_row = row_score[:, :half].argmax(axis=1)
+    bottom_row = half + row_score[:, half:].argmax(axis=1)
+
+    n = np.arange(num)
+    cls = classes if bucketizer.per_class else None
+    left = bucketizer.distance(reg[n, left_col], half - 1 - left_col, 'x', cls)
+    right = bucketizer.distance(reg[n, right_col], right_col - half, 'x', cls)
+    top = bucketizer.distance(reg[n, S + top_row], half - 1 - top_row,
+                              'y', cls)
+    bottom = bucketizer.distance(reg[n, S + bottom_row], bottom_row - half,
+                                 'y', cls)
+
+    cx = xs / spatial_scale
+    cy = ys / spatial_scale
+    pred_boxes = np.vstack((scores, cx - left, cy - top,
+                            cx + right, cy + bottom)).transpose()
+    return pred_boxes, classes
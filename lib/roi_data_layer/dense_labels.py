@@ -0,0 +1,120 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""Dense per-pixel box labels for the box annotation layers.
+
+Every feature map pixel inside a RoI is treated as a seed and labelled with
+seed_box_labels. RoIs are rasterized onto the H x W grid all at once; where
+RoIs overlap, one RoI owns the pixel according to an overlap policy. Only the
+touched pixels are written, and only those are cleared on the next forward.
+"""
+
+import numpy as np
+from roi_data_layer.seed_labels import seed_box_labels
+
+
+def rasterize_rois(boxes, height, width):
+    """All feature map pixels covered by each box.
+
+    Pixel (x, y) is covered by a box when ceil(x1) <= x < floor(x2) and
+    ceil(y1) <= y < floor(y2), clipped to the map.
+
+    Arguments:
+        boxes (ndarray): R x 4 (x1, y1, x2, y2) on the feature map
+        height, width (int): feature map size
+
+    Returns:
+        roi_inds, xs, ys (ndarray): one entry per (RoI, covered pixel) pair
+    """
+    x0 = np.clip(np.ceil(boxes[:, 0]), 0, width).astype(np.int)
+    x1 = np.clip(np.floor(boxes[:, 2]), 0, width).astype(np.int)
+    y0 = np.clip(np.ceil(boxes[:, 1]), 0, height).astype(np.int)
+    y1 = np.clip(np.floor(boxes[:, 3]), 0, height).astype(np.int)
+    widths = np.maximum(x1 - x0, 0)
+    counts = widths * np.maximum(y1 - y0, 0)
+
+    roi_inds = np.repeat(np.arange(boxes.shape[0]), counts)
+    offsets = np.arange(roi_inds.shape[0]) - \
+        np.repeat(np.cumsum(counts) - counts, counts)
+    xs = x0[roi_inds] + offsets % widths[roi_inds]
+    ys = y0[roi_inds] + offsets // widths[roi_inds]
+    return roi_inds, xs, ys
+
+
+def rank_in_roi(roi_inds, scores):
+    """Rank of every pair among the pairs of its RoI, highest score first."""
+    order = np.lexsort((-scores, roi_inds))
+    counts = np.bincount(roi_inds)
+    starts = np.cumsum(counts) - counts
+    ranks = np.empty(roi_inds.shape[0], dtype=np.int)
+    ranks[order] = np.arange(order.shape[0]) - starts[roi_inds[order]]
+    return ranks
+
+
+def resolve_overlaps(roi_inds, xs, ys, width, priority):
+    """Keep one pair per touched pixel.
+
+    Arguments:
+        priority (ndarray): per pair; the lowest value owns the pixel, ties
+            go to the lower RoI index
+
+    Returns:
+        keep (ndarray): indices of the owning pairs
+    """
+    pixels = ys * width + xs
+    order = np.lexsort((roi_inds, priority, pixels))
+    pixels = pixels[order]
+    first = np.ones(order.shape[0], dtype=np.bool)
+    first[1:] = pixels[1:] != pixels[:-1]
+    return order[first]
+
+
+def overlap_priority(policy, boxes, roi_inds, scores=None):
+    """Per-pair priority for resolve_overlaps.
+
+    'area': the smallest RoI owns a pixel; 'score': the highest score does.
+    """
+    if policy == 'area':
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        return areas[roi_inds]
+    elif policy == 'score':
+        assert scores is not None, 'score overlap policy needs scores'
+        return -scores
+    raise ValueError('unknown overlap policy: {}'.format(policy))
+
+
+def pixel_box_labels(boxes, roi_inds, xs, ys, roi_scale, bucketizer,
+                     classes=None):
+    """Box labels of every pixel, as seeds of the RoI that owns it.
+
+    Arguments:
+        boxes (ndarray): R x 4 RoIs on the feature map
+        roi_inds, xs, ys (ndarray): owning RoI and position per pixel
+        roi_scale (float): image -> feature map scale
+        bucketizer (RegionBucketizer): region bounds
+        classes (ndarray): class per pixel, for per-class bounds
+
+    Returns:
+        see seed_box_labels
+    """
+    b = boxes[roi_inds]
+    return seed_box_labels((xs - b[:, 0]) / roi_scale,
+                           (ys - b[:, 1]) / roi_scale,
+                           (b[:, 2] - xs) / roi_scale,
+                           (b[:, 3] - ys) / roi_scale,
+                           bucketizer, classes)
+
+
+def scatter_channels(out, first_channel, xs, ys, values):
+    """out[0, first_channel + k, y, x] = values[:, k] for the given pixels."""
+    channels = first_channel[:, np.newaxis] + np.arange(values.shape[1])
+    out[0, channels, ys[:, np.newaxis], xs[:, np.newaxis]] = values
+
+
+def clear_pixels(out, xs, ys):
+    """out[0, :, y, x] = 0 for the given pixels."""
+    out[0, :, ys, xs] = 0
@@ -8,37 +8,63 @@
 """The data layer used during training to train a Fast R-CNN network.
 
 RoIDataLayer implements a Caffe Python layer.
+
+With cfg.TRAIN.USE_PREFETCH, minibatches are built by
+cfg.TRAIN.PREFETCH_WORKERS BlobFetcher processes. Every worker walks the
+same sequence of roidb permutations (seeded with cfg.RNG_SEED) and builds
+every PREFETCH_WORKERS-th minibatch of it, so the workers cover disjoint
+index streams. Each one puts its minibatches on its own bounded queue,
+which the layer reads round robin, so the minibatch sequence does not
+depend on worker timing. Worker w seeds the sampling in get_minibatch
+with cfg.RNG_SEED + 1 + w.
+
+With cfg.TRAIN.PREFETCH_SHARED_BLOBS, every worker also owns a ring of
+shared memory slots (roi_data_layer.blob_slots) large enough for any data
+blob. The worker builds the data blob in a free slot and queues only the
+slot index with the other, small, blobs; forward copies the data blob from
+the slot into top[0] and hands the slot back.
 """
 
 import caffe
 from fast_rcnn.config import cfg
 from roi_data_layer.minibatch import get_minibatch
+from roi_data_layer.blob_slots import BlobSlots, data_blob_size
+from utils.top_blobs import copy_to_top
+import atexit
 import numpy as np
+import time
 import yaml
 import scipy.io as sio
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, Event
+from Queue import Empty, Full
+
+def _shuffled_roidb_inds(roidb, rng):
+    """A permutation of the roidb indices, drawn from rng.
+
+    With cfg.TRAIN.ASPECT_GROUPING, consecutive pairs of indices are both
+    horizontal or both vertical images.
+    """
+    if cfg.TRAIN.ASPECT_GROUPING:
+        widths = np.array([r['width'] for r in roidb])
+        heights = np.array([r['height'] for r in roidb])
+        horz = (widths >= heights)
+        vert = np.logical_not(horz)
+        horz_inds = np.where(horz)[0]
+        vert_inds = np.where(vert)[0]
+        inds = np.hstack((
+            rng.permutation(horz_inds),
+            rng.permutation(vert_inds)))
+        inds = np.reshape(inds, (-1, 2))
+        row_perm = rng.permutation(np.arange(inds.shape[0]))
+        return np.reshape(inds[row_perm, :], (-1,))
+    return rng.permutation(np.arange(len(roidb)))
 
 class RoIDataLayer(caffe.Layer):
     """Fast R-CNN data layer used for training."""
 
     def _shuffle_roidb_inds(self):
         """Randomly permute the training roidb."""
-        if cfg.TRAIN.ASPECT_GROUPING:
-            widths = np.array([r['width'] for r in self._roidb])
-            heights = np.array([r['height'] for r in self._roidb])
-            horz = (widths >= heights)
-            vert = np.logical_not(horz)
-            horz_inds = np.where(horz)[0]
-            vert_inds = np.where(vert)[0]
-            inds = np.hstack((
-                np.random.permutation(horz_inds),
-                np.random.permutation(vert_inds)))
-            inds = np.reshape(inds, (-1, 2))
-            row_perm = np.random.permutation(np.arange(inds.shape[0]))
-            inds = np.reshape(inds[row_perm, :], (-1,))
-            self._perm = inds
-        else:
-            self._perm = np.random.permutation(np.arange(len(self._roidb)))
+        self._perm = _shuffled_roidb_inds(self._roidb, np.random)
         self._cur = 0
 
     def _get_next_minibatch_inds(self):
@@ -53,11 +79,11 @@ class RoIDataLayer(caffe.Layer):
     def _get_next_minibatch(self):
         """Return the blobs to be used for the next minibatch.
 
-        If cfg.TRAIN.USE_PREFETCH is True, then blobs will be computed in a
-        separate process and made available through self._blob_queue.
+        If cfg.TRAIN.USE_PREFETCH is True, then blobs will be computed in
+        BlobFetcher processes and made available through self._blob_queues.
         """
         if cfg.TRAIN.USE_PREFETCH:
-            return self._blob_queue.get()
+            return self._get_prefetched_minibatch()
         else:
             db_inds = self._get_next_minibatch_inds()
             minibatch_db = [self._roidb[i] for i in db_inds]
@@ -70,7 +96,109 @@ class RoIDataLayer(caffe.Layer):
         num_samples = cfg.TRAIN.num_samples
         self._roidb = roidb
         self._shuffle_roidb_inds()
-        
+        if cfg.TRAIN.USE_PREFETCH:
+            self._start_prefetch()
+
+    def _start_prefetch(self):
+        """Start the BlobFetcher workers."""
+        num_workers = max(cfg.TRAIN.PREFETCH_WORKERS, 1)
+        # split the queue depth over the workers, at least one each
+        depth = max(-(-cfg.TRAIN.PREFETCH_DEPTH // num_workers), 1)
+        self._stop_event = Event()
+        self._blob_queues = [Queue(depth) for _ in xrange(num_workers)]
+        if cfg.TRAIN.PREFETCH_SHARED_BLOBS:
+            # a slot for every queued minibatch, the one being built and the
+            # one being copied into the top
+            self._blob_slots = [BlobSlots(depth + 2, data_blob_size())
+                                for _ in xrange(num_workers)]
+        else:
+            self._blob_slots = [None] * num_workers
+        self._held_slot = None
+        self._prefetch_processes = [
+            BlobFetcher(queue, self._roidb, self._num_classes, worker_id,
+                        num_workers, self._stop_event, slots)
+            for worker_id, (queue, slots) in
+            enumerate(zip(self._blob_queues, self._blob_slots))]
+        for process in self._prefetch_processes:
+            process.start()
+        self._next_worker = 0
+        # minibatches taken from the queues, how many of them were not
+        # ready yet, and the time spent waiting for those
+        self.prefetch_batches = 0
+        self.prefetch_starved = 0
+        self.prefetch_wait_time = 0.
+        atexit.register(self.stop_prefetch)
+
+    def stop_prefetch(self):
+        """Stop and join the BlobFetcher workers."""
+        if getattr(self, '_prefetch_processes', None) is None:
+            return
+        print 'Terminating BlobFetcher'
+        self._stop_event.set()
+        for process, queue, slots in zip(self._prefetch_processes,
+                                         self._blob_queues,
+                                         self._blob_slots):
+            # a worker blocked on a full queue or waiting for a slot checks
+            # the stop event every second; drain the queue so it gets there
+            # sooner
+            while process.is_alive():
+                try:
+                    slot, _ = queue.get(timeout=0.1)
+                    if slot is not None:
+                        slots.release(slot)
+                except Empty:
+                    pass
+                process.join(0.1)
+        self._prefetch_processes = None
+        self._blob_slots = None
+
+    def _get_prefetched_minibatch(self):
+        """The next minibatch, in order, counting waits on empty queues.
+
+        A data blob held in a shared memory slot is returned as a view of
+        the slot, which stays taken until _release_slot.
+        """
+        worker = self._next_worker
+        process = self._prefetch_processes[worker]
+        queue = self._blob_queues[worker]
+        self._next_worker = (worker + 1) % len(self._blob_queues)
+        self.prefetch_batches += 1
+        try:
+            slot, blobs = queue.get_nowait()
+        except Empty:
+            self.prefetch_starved += 1
+            start = time.time()
+            while True:
+                try:
+                    slot, blobs = queue.get(timeout=1.)
+                    break
+                except Empty:
+                    if not process.is_alive():
+                        raise RuntimeError(
+                            'BlobFetcher {} exited with code {}'
+                            .format(process.worker_id, process.exitcode))
+            self.prefetch_wait_time += time.time() - start
+        if slot is not None:
+            blobs['data'] = self._blob_slots[worker].view(slot, blobs['data'])
+            self._held_slot = (worker, slot)
+        return blobs
+
+    def _release_slot(self):
+        """Hand back the slot of the last prefetched data blob, if any."""
+        if getattr(self, '_held_slot', None) is None:
+            return
+        worker, slot = self._held_slot
+        self._blob_slots[worker].release(slot)
+        self._held_slot = None
+
+    def prefetch_stats(self):
+        """'batches', 'starved' and 'wait_time' (s) of the prefetch queues,
+        or None without prefetching."""
+        if getattr(self, '_prefetch_processes', None) is None:
+            return None
+        return {'batches': self.prefetch_batches,
+                'starved': self.prefetch_starved,
+                'wait_time': self.prefetch_wait_time}
 
 
     def setup(self, bottom, top):
@@ -149,10 +277,9 @@ class RoIDataLayer(caffe.Layer):
                 blob = blob.reshape(blob.shape[0], 1, 1, 1)
             if len(shape) == 2 and blob_name != 'im_info':
                 blob = blob.reshape(blob.shape[0], blob.shape[1], 1, 1)
-            top[top_ind].reshape(*(blob.shape))
             # Copy data into net's input blobs
-            top[top_ind].data[...] = blob.astype(np.float32, copy=False)
-        
+            copy_to_top(top[top_ind], blob.astype(np.float32, copy=False))
+        self._release_slot()
 
     def backward(self, top, propagate_down, bottom):
         """This layer does not propagate gradients."""
@@ -163,22 +290,28 @@ class RoIDataLayer(caffe.Layer):
         pass
 
 class BlobFetcher(Process):
-    """Experimental class for prefetching blobs in a separate process."""
-    def __init__(self, queue, roidb, num_classes):
+    """Worker process building every num_workers-th minibatch."""
+    def __init__(self, queue, roidb, num_classes, worker_id=0, num_workers=1,
+                 stop_event=None, slots=None):
         super(BlobFetcher, self).__init__()
         self._queue = queue
         self._roidb = roidb
         self._num_classes = num_classes
+        self.worker_id = worker_id
+        self._num_workers = num_workers
+        self._stop_event = stop_event if stop_event is not None else Event()
+        self._slots = slots
+        # the permutations are drawn from the same stream in every worker
+        self._perm_rng = np.random.RandomState(cfg.RNG_SEED)
         self._perm = None
         self._cur = 0
         self._shuffle_roidb_inds()
-        # fix the random seed for reproducibility
-        np.random.seed(cfg.RNG_SEED)
+        # exit with the parent if it dies without stopping the workers
+        self.daemon = True
 
     def _shuffle_roidb_inds(self):
         """Randomly permute the training roidb."""
-        # TODO(rbg): remove duplicated code
-        self._perm = np.random.permutation(np.arange(len(self._roidb)))
+        self._perm = _shuffled_roidb_inds(self._roidb, self._perm_rng)
         self._cur = 0
 
     def _get_next_minibatch_inds(self):
@@ -191,10 +324,45 @@ class BlobFetcher(Process):
         self._cur += cfg.TRAIN.IMS_PER_BATCH
         return db_inds
 
+    def _build_minibatch(self, minibatch_db):
+        """(slot, blobs) to queue for minibatch_db, or None if stopped.
+
+        With a slot, the data blob is held in it and blobs['data'] is its
+        shape; otherwise slot is None and blobs['data'] the blob itself.
+        """
+        if self._slots is None:
+            return None, get_minibatch(minibatch_db, self._num_classes)
+        slot = self._slots.acquire(self._stop_event)
+        if slot is None:
+            return None
+        slot_data = self._slots.slot(slot)
+        blobs = get_minibatch(minibatch_db, self._num_classes, slot_data)
+        if not np.may_share_memory(blobs['data'], slot_data):
+            # too large for a slot, send it through the queue
+            self._slots.release(slot)
+            return None, blobs
+        blobs['data'] = blobs['data'].shape
+        return slot, blobs
+
     def run(self):
-        print 'BlobFetcher started'
-        while True:
+        print 'BlobFetcher {} started'.format(self.worker_id)
+        # fix the random seed for reproducibility
+        np.random.seed(cfg.RNG_SEED + 1 + self.worker_id)
+        # skip to this worker's first minibatch
+        for _ in xrange(self.worker_id):
+            self._get_next_minibatch_inds()
+        while not self._stop_event.is_set():
             db_inds = self._get_next_minibatch_inds()
+            # the other workers' minibatches
+            for _ in xrange(self._num_workers - 1):
+                self._get_next_minibatch_inds()
             minibatch_db = [self._roidb[i] for i in db_inds]
-            blobs = get_minibatch(minibatch_db, self._num_classes)
-            self._queue.put(blobs)
+            message = self._build_minibatch(minibatch_db)
+            if message is None:
+                break
+            while not self._stop_event.is_set():
+                try:
+                    self._queue.put(message, timeout=1.)
+                    break
+                except Full:
+                    pass
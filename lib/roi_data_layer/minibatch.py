@@ -9,12 +9,18 @@
 
 import numpy as np
 import numpy.random as npr
-import cv2
 from fast_rcnn.config import cfg
-from utils.blob import prep_im_for_blob, im_list_to_blob
+from fast_rcnn.bbox_transform import expand_bbox_targets
+from utils.blob import im_list_to_blob
+from utils.image_cache import load_im_for_blob
+from rpn.image_batch import batch_gt_boxes
 
-def get_minibatch(roidb, num_classes):
-    """Given a roidb, construct a minibatch sampled from it."""
+def get_minibatch(roidb, num_classes, data_out=None):
+    """Given a roidb, construct a minibatch sampled from it.
+
+    If data_out (a flat float32 array) can hold it, the data blob is built
+    in place in data_out.
+    """
     num_images = len(roidb)
     num_reg_class = 2 if cfg.TRAIN.AGNOSTIC else num_classes
     # Sample random scales to use for each image in this batch
@@ -27,21 +33,27 @@ def get_minibatch(roidb, num_classes):
     fg_rois_per_image = np.round(cfg.TRAIN.FG_FRACTION * rois_per_image)
 
     # Get the input image blob, formatted for caffe
-    im_blob, im_scales = _get_image_blob(roidb, random_scale_inds)
+    im_blob, im_scales, im_shapes = _get_image_blob(roidb, random_scale_inds,
+                                                    data_out)
 
     blobs = {'data': im_blob}
 
     if cfg.TRAIN.HAS_RPN:
-        assert len(im_scales) == 1, "Single batch only"
-        assert len(roidb) == 1, "Single batch only"
-        # gt boxes: (x1, y1, x2, y2, cls)
-        gt_inds = np.where(roidb[0]['gt_classes'] != 0)[0]
-        gt_boxes = np.empty((len(gt_inds), 5), dtype=np.float32)
-        gt_boxes[:, 0:4] = roidb[0]['boxes'][gt_inds, :] * im_scales[0]
-        gt_boxes[:, 4] = roidb[0]['gt_classes'][gt_inds]
-        blobs['gt_boxes'] = gt_boxes
+        # gt boxes: (x1, y1, x2, y2, cls), plus the image index when there
+        # are several images (see rpn.image_batch)
+        gt_boxes = []
+        for im_i in xrange(num_images):
+            gt_inds = np.where(roidb[im_i]['gt_classes'] != 0)[0]
+            im_gt_boxes = np.empty((len(gt_inds), 5), dtype=np.float32)
+            im_gt_boxes[:, 0:4] = \
+                roidb[im_i]['boxes'][gt_inds, :] * im_scales[im_i]
+            im_gt_boxes[:, 4] = roidb[im_i]['gt_classes'][gt_inds]
+            gt_boxes.append(im_gt_boxes)
+        blobs['gt_boxes'] = batch_gt_boxes(gt_boxes)
+        # size of every image before padding to the blob size
         blobs['im_info'] = np.array(
-            [[im_blob.shape[2], im_blob.shape[3], im_scales[0]]],
+            [[h, w, im_scale]
+             for (h, w), im_scale in zip(im_shapes, im_scales)],
             dtype=np.float32)
     else: # not using RPN
         # Now, build the region of interest and label blobs
@@ -123,74 +135,45 @@ def _sample_rois(roidb, fg_rois_per_image, rois_per_image, num_classes):
     overlaps = overlaps[keep_inds]
     rois = rois[keep_inds]
 
-    bbox_targets, bbox_inside_weights = _get_bbox_regression_labels(
-            roidb['bbox_targets'][keep_inds, :], num_classes)
+    num_reg_class = 2 if cfg.TRAIN.AGNOSTIC else num_classes
+    bbox_targets, bbox_inside_weights = expand_bbox_targets(
+            roidb['bbox_targets'][keep_inds, :], num_reg_class,
+            cfg.TRAIN.AGNOSTIC, cfg.TRAIN.BBOX_INSIDE_WEIGHTS)
 
     return labels, overlaps, rois, bbox_targets, bbox_inside_weights
 
-def _get_image_blob(roidb, scale_inds):
+def _get_image_blob(roidb, scale_inds, out=None):
     """Builds an input blob from the images in the roidb at the specified
-    scales.
+    scales, in out if given (see im_list_to_blob).
     """
     num_images = len(roidb)
     processed_ims = []
     im_scales = []
     for i in xrange(num_images):
-        im = cv2.imread(roidb[i]['image'])
-        if roidb[i]['flipped']:
-            im = im[:, ::-1, :]
         target_size = cfg.TRAIN.SCALES[scale_inds[i]]
-        im, im_scale = prep_im_for_blob(im, cfg.PIXEL_MEANS, target_size,
-                                        cfg.TRAIN.MAX_SIZE)
+        if 'packed' in roidb[i]:
+            # see datasets.packed_dataset
+            packed_images, packed_ind = roidb[i]['packed']
+            im, im_scale = packed_images.im_for_blob(
+                packed_ind, roidb[i]['flipped'], target_size,
+                cfg.TRAIN.MAX_SIZE)
+        else:
+            im, im_scale = load_im_for_blob(roidb[i]['image'],
+                                            roidb[i]['flipped'], target_size,
+                                            cfg.TRAIN.MAX_SIZE)
         im_scales.append(im_scale)
         processed_ims.append(im)
 
     # Create a blob to hold the input images
-    blob = im_list_to_blob(processed_ims)
+    blob = im_list_to_blob(processed_ims, out)
 
-    return blob, im_scales
+    return blob, im_scales, [im.shape[:2] for im in processed_ims]
 
 def _project_im_rois(im_rois, im_scale_factor):
     """Project image RoIs into the rescaled training image."""
     rois = im_rois * im_scale_factor
     return rois
 
-def _get_bbox_regression_labels(bbox_target_data, num_classes):
-    """Bounding-box regression targets are stored in a compact form in the
-    roidb.
-
-    This function expands those targets into the 4-of-4*K representation used
-    by the network (i.e. only one class has non-zero targets). The loss weights
-    are similarly expanded.
-
-    Returns:
-        bbox_target_data (ndarray): N x 4K blob of regression targets
-        bbox_inside_weights (ndarray): N x 4K blob of loss weights
-    """
-    clss = bbox_target_data[:, 0]
-    num_reg_class = 2 if cfg.TRAIN.AGNOSTIC else num_classes
-    bbox_targets = np.zeros((clss.size, 4 * num_reg_class), dtype=np.float32)
-    bbox_inside_weights = np.zeros(bbox_targets.shape, dtype=np.float32)
-    inds = np.where(clss > 0)[0]
-
-    if cfg.TRAIN.AGNOSTIC:
-        for ind in inds:
-            cls = clss[ind]
-            start = 4 * (1 if cls > 0 else 0)
-            end = start + 4
-            bbox_targets[ind, start:end] = bbox_target_data[ind, 1:]
-            bbox_inside_weights[ind, start:end] = cfg.TRAIN.BBOX_INSIDE_WEIGHTS
-    else:
-        for ind in inds:
-            cls = clss[ind]
-            start = 4 * cls
-            end = start + 4
-            bbox_targets[ind, start:end] = bbox_target_data[ind, 1:]
-            bbox_inside_weights[ind, start:end] = cfg.TRAIN.BBOX_INSIDE_WEIGHTS
-
-    return bbox_targets, bbox_inside_weights
-
-
 def _vis_minibatch(im_blob, rois_blob, labels_blob, overlaps):
     """Visualize a mini-batch for debugging."""
     import matplotlib.pyplot as plt
@@ -9,9 +9,10 @@
 
 import numpy as np
 import numpy.random as npr
-import cv2
 from fast_rcnn.config import cfg
-from utils.blob import prep_im_for_blob, im_list_to_blob
+from fast_rcnn.bbox_transform import expand_bbox_targets
+from utils.blob import im_list_to_blob
+from utils.image_cache import load_im_for_blob
 
 def get_minibatch(roidb, num_classes):
     """Given a roidb, construct a minibatch sampled from it."""
@@ -87,8 +88,10 @@ def _sample_rois(roidb, fg_rois_per_image, rois_per_image, num_classes):
     overlaps = overlaps[keep_inds]
     rois = rois[keep_inds]
 
-    bbox_targets, bbox_inside_weights = _get_bbox_regression_labels(
-            roidb['bbox_targets'][keep_inds, :], num_classes)
+    num_reg_class = 2 if cfg.TRAIN.AGNOSTIC else num_classes
+    bbox_targets, bbox_inside_weights = expand_bbox_targets(
+            roidb['bbox_targets'][keep_inds, :], num_reg_class,
+            cfg.TRAIN.AGNOSTIC, cfg.TRAIN.BBOX_INSIDE_WEIGHTS)
 
     return labels, overlaps, rois, bbox_targets, bbox_inside_weights
 
@@ -100,12 +103,17 @@ def _get_image_blob(roidb, scale_inds):
     processed_ims = []
     im_scales = []
     for i in xrange(num_images):
-        im = cv2.imread(roidb[i]['image'])
-        if roidb[i]['flipped']:
-            im = im[:, ::-1, :]
         target_size = cfg.TRAIN.SCALES[scale_inds[i]]
-        im, im_scale = prep_im_for_blob(im, cfg.PIXEL_MEANS, target_size,
-                                        cfg.TRAIN.MAX_SIZE)
+        if 'packed' in roidb[i]:
+            # see datasets.packed_dataset
+            packed_images, packed_ind = roidb[i]['packed']
+            im, im_scale = packed_images.im_for_blob(
+                packed_ind, roidb[i]['flipped'], target_size,
+                cfg.TRAIN.MAX_SIZE)
+        else:
+            im, im_scale = load_im_for_blob(roidb[i]['image'],
+                                            roidb[i]['flipped'], target_size,
+                                            cfg.TRAIN.MAX_SIZE)
         im_scales.append(im_scale)
         processed_ims.append(im)
 
@@ -119,42 +127,6 @@ def _project_im_rois(im_rois, im_scale_factor):
     rois = im_rois * im_scale_factor
     return rois
 
-def _get_bbox_regression_labels(bbox_target_data, num_classes):
-    """Bounding-box regression targets are stored in a compact form in the
-    roidb.
-
-    This function expands those targets into the 4-of-4*K representation used
-    by the network (i.e. only one class has non-zero targets). The loss weights
-    are similarly expanded.
-
-    Returns:
-        bbox_target_data (ndarray): N x 4K blob of regression targets
-        bbox_inside_weights (ndarray): N x 4K blob of loss weights
-    """
-    clss = bbox_target_data[:, 0]
-    num_reg_class = 2 if cfg.TRAIN.AGNOSTIC else num_classes
-    bbox_targets = np.zeros((clss.size, 4 * num_reg_class), dtype=np.float32)
-    bbox_inside_weights = np.zeros(bbox_targets.shape, dtype=np.float32)
-    inds = np.where(clss > 0)[0]
-
-    if cfg.TRAIN.AGNOSTIC:
-        for ind in inds:
-            cls = clss[ind]
-            start = 4 * (1 if cls > 0 else 0)
-            end = start + 4
-            bbox_targets[ind, start:end] = bbox_target_data[ind, 1:]
-            bbox_inside_weights[ind, start:end] = cfg.TRAIN.BBOX_INSIDE_WEIGHTS
-    else:
-        for ind in inds:
-            cls = clss[ind]
-            start = 4 * cls
-            end = start + 4
-            bbox_targets[ind, start:end] = bbox_target_data[ind, 1:]
-            bbox_inside_weights[ind, start:end] = cfg.TRAIN.BBOX_INSIDE_WEIGHTS
-
-    return bbox_targets, bbox_inside_weights
-
-
 def _vis_minibatch(im_blob, rois_blob, labels_blob, overlaps):
     """Visualize a mini-batch for debugging."""
     import matplotlib.pyplot as plt
@@ -5,51 +5,61 @@
 # Written by Ross Girshick
 # --------------------------------------------------------
 
-"""The data layer used during training to train a Fast R-CNN network.
+"""PSROIPooling as a Caffe Python layer.
 
-RoIDataLayer implements a Caffe Python layer.
+A CPU replacement for the PSROIPooling layer, whose Forward_cpu and
+Backward_cpu are not implemented. Keep the bottoms and top and swap the layer
+type:
+
+    type: 'Python'
+    python_param {
+        module: 'roi_data_layer.psroi_layer'
+        layer: 'PSROIPoolingLayer'
+        param_str: "{'spatial_scale': 0.0625, 'output_dim': 21,
+                     'group_size': 7}"
+    }
 """
 
 import caffe
-from fast_rcnn.config import cfg
-from roi_data_layer.minibatch import get_minibatch
 import numpy as np
 import yaml
-from multiprocessing import Process, Queue
-import scipy.io as sio
-class RoIDataLayer(caffe.Layer):
-    """Fast R-CNN data layer used for training."""
+from utils.top_blobs import top_data
+from roi_data_layer.psroi_pooling import psroi_pooling_forward, \
+    psroi_pooling_backward
 
-    
-    def setup(self, bottom, top):
-        """Setup the RoIDataLayer."""
+class PSROIPoolingLayer(caffe.Layer):
+    """Position-sensitive RoI pooling with integral images."""
 
-        # parse the layer parameter string, which must be valid YAML
+    def setup(self, bottom, top):
+        """Setup the PSROIPoolingLayer."""
+        # bottom 0 score maps (N, output_dim * group_size^2, H, W)
+        # bottom 1 rois (R, 5)
         layer_params = yaml.load(self.param_str)
-        shape = bottom[0].data.shape #1, C, H, W
-
-        self._tiles = layer_params['tiles']
-        self._axis = layer_params['axis']
-
+        self._spatial_scale = layer_params['spatial_scale']
+        self._output_dim = layer_params['output_dim']
+        self._group_size = layer_params['group_size']
+        assert bottom[0].data.shape[1] == \
+            self._output_dim * self._group_size * self._group_size, \
+            'input channel number does not match layer parameters'
 
+        top[0].reshape(bottom[1].data.shape[0], self._output_dim,
+                       self._group_size, self._group_size)
 
     def forward(self, bottom, top):
-        """Get blobs and copy them into this layer's top blob vector."""
-        
-        data = bottom[0].data
-        data = data[:,,:,:]
-        data = np.transpose(data,self._order) 
-        top[0].reshape(*(data.shape))
-        top[0].data[...] = data
-
+        """Pool every RoI bin from the integral images of its channel."""
+        rois = bottom[1].data
+        top_data(top[0], (rois.shape[0], self._output_dim,
+                          self._group_size, self._group_size))[...] = \
+            psroi_pooling_forward(bottom[0].data, rois, self._spatial_scale,
+                                  self._output_dim, self._group_size)
 
     def backward(self, top, propagate_down, bottom):
-        """This layer does not propagate gradients."""
-        diff = top[0].diff
-        diff = np.transpose(diff, self._order_back)
-        bottom[0].reshape((*diff.shape))
-        bottom[0].diff = diff
-
+        """Propagate to the score maps only; rois get no gradient."""
+        if not propagate_down[0]:
+            return
+        bottom[0].diff[...] = psroi_pooling_backward(
+            top[0].diff, bottom[1].data, bottom[0].data.shape,
+            self._spatial_scale, self._output_dim, self._group_size)
 
     def reshape(self, bottom, top):
         """Reshaping happens during the call to forward."""
@@ -0,0 +1,131 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""Position-sensitive RoI pooling in NumPy, the CPU counterpart of
+psroi_pooling_layer.cu.
+
+Output (n, d, ph, pw) averages channel (d * G + ph) * G + pw of the score
+maps over bin (ph, pw) of RoI n, G = group_size. Bin edges are computed in
+float32 exactly as the CUDA kernel does. Every bin sum is read from an
+integral image of its channel in O(1), whatever the bin size; backward
+spreads each bin's gradient with four corner updates of a difference image
+followed by a 2-D cumulative sum, the transpose of the same operation.
+"""
+
+import numpy as np
+
+
+def psroi_bins(rois, spatial_scale, group_size, height, width):
+    """Bin edges of every RoI, clipped to the feature map.
+
+    Arguments:
+        rois (ndarray): R x 5 (batch index, x1, y1, x2, y2) in image space
+        spatial_scale (float): image -> feature map scale
+        group_size (int): bins per side
+        height, width (int): feature map size
+
+    Returns:
+        batch_inds (ndarray): R image indices
+        hstart, hend, wstart, wend (ndarray): R x group_size [start, end)
+            bin edges along each axis
+    """
+    rois = rois.reshape((rois.shape[0], -1)).astype(np.float32)
+    scale = np.float32(spatial_scale)
+    # np.round and C round differ on .5, so round half away from zero
+    corners = np.sign(rois[:, 1:5]) * np.floor(np.abs(rois[:, 1:5]) + 0.5)
+    start_w = corners[:, 0] * scale
+    start_h = corners[:, 1] * scale
+    end_w = (corners[:, 2] + 1) * scale
+    end_h = (corners[:, 3] + 1) * scale
+    # force too small RoIs to be 1 x 1
+    bin_w = np.maximum(end_w - start_w, np.float32(0.1)) / group_size
+    bin_h = np.maximum(end_h - start_h, np.float32(0.1)) / group_size
+
+    p = np.arange(group_size, dtype=np.float32)[np.newaxis, :]
+    hstart = np.floor(p * bin_h[:, np.newaxis] + start_h[:, np.newaxis])
+    hend = np.ceil((p + 1) * bin_h[:, np.newaxis] + start_h[:, np.newaxis])
+    wstart = np.floor(p * bin_w[:, np.newaxis] + start_w[:, np.newaxis])
+    wend = np.ceil((p + 1) * bin_w[:, np.newaxis] + start_w[:, np.newaxis])
+    return (rois[:, 0].astype(np.int),
+            np.clip(hstart, 0, height).astype(np.int),
+            np.clip(hend, 0, height).astype(np.int),
+            np.clip(wstart, 0, width).astype(np.int),
+            np.clip(wend, 0, width).astype(np.int))
+
+
+def _bin_index(bins, output_dim, group_size):
+    # broadcastable (R, D, G, G) indices into N x C x (H + 1) x (W + 1)
+    batch_inds, hstart, hend, wstart, wend = bins
+    g = np.arange(group_size)
+    channels = (np.arange(output_dim)[:, None, None] * group_size +
+                g[None, :, None]) * group_size + g[None, None, :]
+    n = batch_inds[:, None, None, None]
+    c = channels[np.newaxis]
+    hs, he = hstart[:, None, :, None], hend[:, None, :, None]
+    ws, we = wstart[:, None, None, :], wend[:, None, None, :]
+    area = (he - hs) * (we - ws)
+    return n, c, hs, he, ws, we, area
+
+
+def integral_images(data):
+    """N x C x (H + 1) x (W + 1) float64 running sums, zero first row/col."""
+    N, C, H, W = data.shape
+    integral = np.zeros((N, C, H + 1, W + 1))
+    np.cumsum(data, axis=2, out=integral[:, :, 1:, 1:])
+    np.cumsum(integral[:, :, 1:, 1:], axis=3, out=integral[:, :, 1:, 1:])
+    return integral
+
+
+def psroi_pooling_forward(data, rois, spatial_scale, output_dim, group_size,
+                          integral=None):
+    """Position-sensitive RoI pooling.
+
+    Arguments:
+        data (ndarray): N x (output_dim * G * G) x H x W score maps
+        rois (ndarray): R x 5 RoIs
+        spatial_scale (float): image -> feature map scale
+        output_dim (int): output channels
+        group_size (int): G
+        integral (ndarray): integral_images(data), if already computed
+
+    Returns:
+        pooled (ndarray): R x output_dim x G x G, float32
+    """
+    assert data.shape[1] == output_dim * group_size * group_size, \
+        'input channel number does not match layer parameters'
+    if integral is None:
+        integral = integral_images(data)
+    bins = psroi_bins(rois, spatial_scale, group_size, data.shape[2],
+                      data.shape[3])
+    n, c, hs, he, ws, we, area = _bin_index(bins, output_dim, group_size)
+    sums = integral[n, c, he, we] - integral[n, c, hs, we] - \
+        integral[n, c, he, ws] + integral[n, c, hs, ws]
+    pooled = np.where(area > 0, sums / np.maximum(area, 1), 0)
+    return pooled.astype(np.float32)
+
+
+def psroi_pooling_backward(top_diff, rois, data_shape, spatial_scale,
+                           output_dim, group_size):
+    """Gradient w.r.t. the score maps, data_shape float32."""
+    N, C, H, W = data_shape
+    bins = psroi_bins(rois, spatial_scale, group_size, H, W)
+    n, c, hs, he, ws, we, area = _bin_index(bins, output_dim, group_size)
+    grad = np.where(area > 0, top_diff / np.maximum(area, 1), 0)
+    shape = grad.shape
+    n, c, hs, he, ws, we = [np.broadcast_to(a, shape).ravel()
+                            for a in (n, c, hs, he, ws, we)]
+    grad = grad.ravel()
+
+    # corner updates of a difference image, integrated by two cumsums
+    diff = np.zeros(N * C * (H + 1) * (W + 1))
+    for h, w, sign in ((hs, ws, 1), (hs, we, -1), (he, ws, -1), (he, we, 1)):
+        flat = ((n * C + c) * (H + 1) + h) * (W + 1) + w
+        diff += sign * np.bincount(flat, weights=grad, minlength=diff.shape[0])
+    diff = diff.reshape((N, C, H + 1, W + 1))
+    np.cumsum(diff, axis=2, out=diff)
+    np.cumsum(diff, axis=3, out=diff)
+    return diff[:, :, :H, :W].astype(np.float32)
@@ -0,0 +1,127 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""Region bucketing for the box annotation layers.
+
+The regions around a point are delimited by the bound_w / bound_h arrays
+written by SolverWrapper (bound[0] == 0, sorted). RegionBucketizer answers,
+for whole arrays of distances, which region a distance falls in and where it
+sits inside that region. get_bucketizer caches one instance per set of bound
+files so every layer in a net shares it.
+"""
+
+import os
+import numpy as np
+import scipy.io as sio
+
+_bucketizers = {}
+
+
+class RegionBucketizer(object):
+    """Bucket distances into regions with np.searchsorted.
+
+    bound_x and bound_y are either one (half + 1,) array shared by all
+    classes, or a (num_classes, half + 1) table with one row per class, in
+    which case every query takes the class of each distance.
+    """
+
+    def __init__(self, bound_x, bound_y, num_regions_one_side):
+        self.num_regions_one_side = int(num_regions_one_side)
+        self.half = self.num_regions_one_side / 2
+        self._bounds = {}
+        for axis, bound in (('x', bound_x), ('y', bound_y)):
+            bound = np.atleast_2d(np.asarray(bound, dtype=np.float64))
+            assert bound.shape[1] >= self.half + 1, \
+                'need {} region bounds, got {}'.format(self.half + 1,
+                                                       bound.shape[1])
+            self._bounds[axis] = bound[:, :self.half + 1]
+        self.per_class = self._bounds['x'].shape[0] > 1
+
+    def bounds(self, axis, cls=0):
+        """The (half + 1,) bounds used for class cls along axis."""
+        return self._bounds[axis][cls if self.per_class else 0]
+
+    def _search(self, dist, axis, classes, upto):
+        dist = np.asarray(dist)
+        if not self.per_class:
+            return np.searchsorted(self._bounds[axis][0, :upto], dist,
+                                   side='left')
+        inds = np.zeros(dist.shape, dtype=np.int)
+        for cls in np.unique(classes):
+            keep = classes == cls
+            inds[keep] = np.searchsorted(self._bounds[axis][cls, :upto],
+                                         dist[keep], side='left')
+        return inds
+
+    def _lookup(self, axis, classes, inds):
+        table = self._bounds[axis]
+        if not self.per_class:
+            return table[0, inds]
+        return table[classes, inds]
+
+    def bucket(self, dist, axis, classes=None):
+        """Region index i with bounds[i] < dist < bounds[i + 1].
+
+        Returns:
+            inds (ndarray): bucket per distance, clipped to [0, half)
+            valid (ndarray): False where no bucket strictly contains dist
+        """
+        inds = self._search(dist, axis, classes, self.half + 1) - 1
+        inds = np.clip(inds, 0, self.half - 1)
+        lo = self._lookup(axis, classes, inds)
+        hi = self._lookup(axis, classes, inds + 1)
+        return inds, (lo < dist) & (dist < hi)
+
+    def offset(self, dist, inds, axis, classes=None):
+        """Position of dist inside bucket inds, normalized to [-0.5, 0.5]."""
+        lo = self._lookup(axis, classes, inds)
+        hi = self._lookup(axis, classes, inds + 1)
+        return (hi - dist) / (hi - lo) - 0.5
+
+    def distance(self, offset, inds, axis, classes=None):
+        """Inverse of offset: the distance at offset inside bucket inds."""
+        lo = self._lookup(axis, classes, inds)
+        hi = self._lookup(axis, classes, inds + 1)
+        return hi - (offset + 0.5) * (hi - lo)
+
+    def count_below(self, dist, axis, classes=None):
+        """Number of j < half with bounds[j] < dist."""
+        return self._search(dist, axis, classes, self.half)
+
+
+def _bound_files(num_classes):
+    if num_classes is None:
+        return ['bound.mat']
+    return ['bound_%d.mat' % i for i in xrange(1, num_classes)]
+
+
+def get_bucketizer(num_regions_one_side, num_classes=None):
+    """Shared RegionBucketizer for the bound files in the working directory.
+
+    Arguments:
+        num_regions_one_side (int): regions along one side of the grid
+        num_classes (int): if given, load the per-class bound_%d.mat files
+            written by SolverWrapper for classes 1 .. num_classes - 1;
+            otherwise load the shared bound.mat
+
+    Returns:
+        bucketizer (RegionBucketizer): cached until the files change
+    """
+    files = _bound_files(num_classes)
+    key = (int(num_regions_one_side),
+           tuple((f, os.path.getmtime(f)) for f in files))
+    if key not in _bucketizers:
+        bounds = [sio.loadmat(f) for f in files]
+        bound_x = np.vstack([b['bound_w'] for b in bounds])
+        bound_y = np.vstack([b['bound_h'] for b in bounds])
+        if num_classes is not None:
+            # row 0 (background) is never queried
+            bound_x = np.vstack((np.zeros_like(bound_x[:1]), bound_x))
+            bound_y = np.vstack((np.zeros_like(bound_y[:1]), bound_y))
+        _bucketizers[key] = RegionBucketizer(bound_x, bound_y,
+                                             num_regions_one_side)
+    return _bucketizers[key]
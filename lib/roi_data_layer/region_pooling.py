@@ -0,0 +1,92 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""RegionPooling in NumPy, the CPU counterpart of region_pooling_layer.cu.
+
+For every seed m, region r and sample s, RegionPooling reads the R-FCN
+features at seed + sampled_id[m, r * num_samples + s] and averages them over
+the num_rfcn_regions part groups, weighted by rfcn_region_weights:
+
+    top[m, r, s, f] = sum_p feat[p * F + f, y, x] * w[m, r, s, p] / P
+
+The op is linear in the features, so forward and backward share one sparse
+(seeds * regions * samples) x (P * H * W) pooling matrix. Samples that fall
+outside the feature map contribute nothing (the CUDA kernel reads them
+unchecked; the annotation layers give them zero weight anyway).
+"""
+
+import numpy as np
+import scipy.sparse as sp
+
+
+def pooling_matrix(seed_points, sampled_id, region_weights, height, width):
+    """Sparse matrix mapping P x H x W features to pooled samples.
+
+    Arguments:
+        seed_points (ndarray): M x 2 (x, y) seeds on the feature map
+        sampled_id (ndarray): M x K x 2 sample offsets, K = regions * samples
+        region_weights (ndarray): M x K x P (or M x regions x samples x P)
+            part weights
+        height, width (int): feature map size
+
+    Returns:
+        mat (csr_matrix): (M * K) x (P * H * W), already divided by P
+    """
+    num_seeds = seed_points.shape[0]
+    K = sampled_id.shape[1]
+    weights = region_weights.reshape((num_seeds * K, -1))
+    P = weights.shape[1]
+    # the kernel truncates the seed, then the shifted position, to int
+    seeds = np.trunc(seed_points[:, :2]).astype(np.float64)
+    x = np.trunc(sampled_id[:, :, 0] + seeds[:, 0:1]).astype(np.int).ravel()
+    y = np.trunc(sampled_id[:, :, 1] + seeds[:, 1:2]).astype(np.int).ravel()
+    inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+
+    n, p = np.where(inside[:, np.newaxis] & (weights != 0))
+    cols = p * (height * width) + y[n] * width + x[n]
+    data = weights[n, p].astype(np.float32) / P
+    return sp.csr_matrix((data, (n, cols)),
+                         shape=(num_seeds * K, P * height * width))
+
+
+def _features_by_location(features, num_rfcn_regions):
+    # (1, P * F, H, W) -> (P * H * W, F)
+    P = num_rfcn_regions
+    F = features.shape[1] / P
+    feat = features[0].reshape((P, F) + features.shape[2:])
+    return feat.transpose((0, 2, 3, 1)).reshape((-1, F))
+
+
+def region_pooling_forward(features, mat, num_rfcn_regions, out=None):
+    """Pooled features, (M * K) x F (written into out if given)."""
+    pooled = mat.dot(_features_by_location(features, num_rfcn_regions))
+    if out is None:
+        return pooled
+    out.reshape(pooled.shape)[...] = pooled
+    return out
+
+
+def region_pooling_backward(top_diff, mat, features_shape, num_rfcn_regions,
+                            out=None):
+    """Gradient w.r.t. the (1, P * F, H, W) features.
+
+    Arguments:
+        top_diff (ndarray): (M * K) x F, or any shape with that many elements
+        mat (csr_matrix): output of pooling_matrix
+        features_shape (tuple): shape of the features blob
+        num_rfcn_regions (int): P
+        out (ndarray): features-shaped array to write into
+    """
+    P = num_rfcn_regions
+    F = features_shape[1] / P
+    height, width = features_shape[2:]
+    grad = mat.transpose().dot(top_diff.reshape((-1, F)))
+    grad = grad.reshape((P, height, width, F)).transpose((0, 3, 1, 2))
+    if out is None:
+        return grad.reshape(features_shape)
+    out.reshape((P, F, height, width))[...] = grad
+    return out
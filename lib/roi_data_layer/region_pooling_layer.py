@@ -0,0 +1,82 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""RegionPooling as a Caffe Python layer.
+
+A drop-in CPU replacement for the RegionPooling layer, whose Forward_cpu and
+Backward_cpu are not implemented. Keep the bottoms and top and swap the layer
+type:
+
+    type: 'Python'
+    python_param {
+        module: 'roi_data_layer.region_pooling_layer'
+        layer: 'RegionPoolingLayer'
+        param_str: "{'num_features': 64, 'num_samples': 9,
+                     'num_rfcn_regions': 49, 'num_regions': 64}"
+    }
+
+Parameters left out default to the cfg.TRAIN values.
+"""
+
+import caffe
+from fast_rcnn.config import cfg
+import numpy as np
+import yaml
+from utils.top_blobs import top_data
+from roi_data_layer.region_pooling import pooling_matrix, \
+    region_pooling_forward, region_pooling_backward
+
+class RegionPoolingLayer(caffe.Layer):
+    """Weighted pooling of R-FCN features at every seed's sample points."""
+
+    def setup(self, bottom, top):
+        """Setup the RegionPoolingLayer."""
+        # bottom 0 rfcn_features (1, num_rfcn_regions * num_features, H, W)
+        # bottom 1 seed_points (m, 2)
+        # bottom 2 sampled_id (m, num_regions * num_samples, 2)
+        # bottom 3 rfcn_region_weights
+        #          (m, num_regions, num_samples, num_rfcn_regions)
+        layer_params = yaml.load(self.param_str) if self.param_str else {}
+        self._num_features = layer_params.get('num_features',
+                                              cfg.TRAIN.num_features)
+        self._num_samples = layer_params.get('num_samples',
+                                             cfg.TRAIN.num_samples)
+        self._num_rfcn_regions = layer_params.get('num_rfcn_regions',
+                                                  cfg.TRAIN.num_rfcn_regions)
+        self._num_regions = layer_params.get('num_regions',
+                                             cfg.TRAIN.num_regions)
+        assert bottom[0].data.shape[1] == \
+            self._num_features * self._num_rfcn_regions, \
+            'input channel number does not match layer parameters'
+        self._pooling = None
+
+        top[0].reshape(bottom[1].data.shape[0], self._num_regions,
+                       self._num_samples, self._num_features)
+
+    def forward(self, bottom, top):
+        """Pool the features and keep the pooling matrix for backward."""
+        features = bottom[0].data
+        self._pooling = pooling_matrix(bottom[1].data, bottom[2].data,
+                                       bottom[3].data, features.shape[2],
+                                       features.shape[3])
+        pooled = top_data(top[0], (bottom[1].data.shape[0],
+                                   self._num_regions, self._num_samples,
+                                   self._num_features))
+        region_pooling_forward(features, self._pooling,
+                               self._num_rfcn_regions, out=pooled)
+
+    def backward(self, top, propagate_down, bottom):
+        """Propagate to the features only, as the CUDA layer does."""
+        if not propagate_down[0]:
+            return
+        region_pooling_backward(top[0].diff, self._pooling,
+                                bottom[0].data.shape,
+                                self._num_rfcn_regions, out=bottom[0].diff)
+
+    def reshape(self, bottom, top):
+        """Reshaping happens during the call to forward."""
+        pass
@@ -16,6 +16,10 @@ import numpy as np
 import yaml
 from multiprocessing import Process, Queue
 import scipy.io as sio
+from roi_data_layer.region_bucketizer import get_bucketizer
+from utils.top_blobs import top_data
+from roi_data_layer.seed_labels import select_seeds, seed_distances, seed_box_labels, \
+    half_plane_masks, seed_region_weights, scatter_class_slices, scatter_class_axis
 class RoIDataLayer(caffe.Layer):
     """Fast R-CNN data layer used for training."""
 
@@ -45,9 +49,8 @@ class RoIDataLayer(caffe.Layer):
         self._name_to_top_map = {}
         self._num_rois = 1 #bottom[1].data.shape[0]
         self._roi_scale = layer_params['roi_scale']
-        self._region_bound = sio.loadmat('bound.mat')
-        self._region_bound_x = self._region_bound['bound_w'][0]
-        self._region_bound_y = self._region_bound['bound_h'][0]
+        self._bucketizer = get_bucketizer(self._num_regions_one_side,
+                                          cfg.TRAIN.num_classes if cfg.TRAIN.class_bounds else None)
 
         # data blob: holds a batch of N images, each with 3 channels
         idx = 0
@@ -95,6 +98,11 @@ class RoIDataLayer(caffe.Layer):
         self._sampled_id = {}
         for i in xrange(1, cfg.TRAIN.num_classes):
             self._sampled_id[str(i)] = sio.loadmat('sampled_id_%d.mat'%i)['sampled_id']
+        # (num_classes, num_regions * num_samples, 2) lookup for batched gathers
+        self._sampled_id_table = np.zeros((cfg.TRAIN.num_classes, cfg.TRAIN.num_samples*cfg.TRAIN.num_regions, 2))
+        for i in xrange(1, cfg.TRAIN.num_classes):
+            self._sampled_id_table[i] = self._sampled_id[str(i)]
+        self._half_plane_masks = half_plane_masks(np.sqrt(cfg.TRAIN.num_rfcn_regions))
 
 
 
@@ -114,166 +122,54 @@ class RoIDataLayer(caffe.Layer):
         # top 3 bbox_reg_labels (num_rois * M, num_classes * num_regions_one_side * 2)
         self._num_rois = bottom[1].data.shape[0]
         rfcn_conf = bottom[0].data
-        seed_points = np.zeros((self._num_rois * cfg.TRAIN.M, 2))
-        seed_points_feat = np.zeros((self._num_rois * cfg.TRAIN.M, cfg.TRAIN.num_features))
-        rfcn_region_weights = np.zeros((self._num_rois * cfg.TRAIN.M,cfg.TRAIN.num_regions*cfg.TRAIN.num_samples, cfg.TRAIN.num_rfcn_regions))
-        bbox_cls_labels = np.zeros((self._num_rois * cfg.TRAIN.M, self._num_classes_box * cfg.TRAIN.num_regions))
-        bbox_reg_labels = np.zeros((self._num_rois * cfg.TRAIN.M, self._num_classes_box * self._num_regions_one_side * 2))
-
-        
-        bbox_cls_inweights = np.zeros((self._num_rois * cfg.TRAIN.M, self._num_classes_box *  cfg.TRAIN.num_regions))
-        bbox_cls_outweights = np.ones((self._num_rois * cfg.TRAIN.M, self._num_classes_box *  cfg.TRAIN.num_regions))
-        
-        bbox_inweights = np.zeros((self._num_rois * cfg.TRAIN.M, self._num_classes_box * self._num_regions_one_side * 2 ))
-        bbox_outweights = np.ones((self._num_rois * cfg.TRAIN.M, self._num_classes_box * self._num_regions_one_side * 2))
-        sampled_id = np.zeros((self._num_rois * cfg.TRAIN.M, cfg.TRAIN.num_samples*cfg.TRAIN.num_regions , 2))
-
-
-        
-        for nroi in xrange(self._num_rois):
-            count = 0
-            roi_x1 =  rois[nroi,0,0,0] * self._roi_scale
-            roi_y1 =  rois[nroi,1,0,0] * self._roi_scale
-            roi_x2 =  rois[nroi,2,0,0] * self._roi_scale
-            roi_y2 =  rois[nroi,3,0,0] * self._roi_scale
-            center_w = (roi_x1 + roi_x2)/2
-            center_h = (roi_y1 + roi_y2)/2
-            #area = (rois[nroi,4] - rois[nroi,2] + 1 )*(rois[nroi,3] - rois[nroi,1] + 1)
-            roi_class = rois[nroi,4,0,0]
-            rfcn_conf_in_roi = rfcn_conf[0,np.ceil(roi_y1):np.floor(roi_y2) + 1,np.ceil(roi_x1):np.floor(roi_x2) + 1,:,:,roi_class]
-            rfcn_conf_in_roi = rfcn_conf_in_roi.reshape((rfcn_conf_in_roi.shape[0],rfcn_conf_in_roi.shape[1],cfg.TRAIN.num_rfcn_regions ))
-            #shape (49,h,w)
-            max_class_conf_in_roi = (np.max(rfcn_conf_in_roi,axis = 2)).reshape((rfcn_conf_in_roi.shape[0]*rfcn_conf_in_roi.shape[1]))
-            seed_points_inds = np.argsort(max_class_conf_in_roi)[ - cfg.TRAIN.M :]
-            for m in xrange(np.minimum(cfg.TRAIN.M, seed_points_inds.shape[0])):
-                sampled_id[nroi * cfg.TRAIN.M + m ,:,:] = self._sampled_id[str(int(roi_class))]
-                feat_ext_offsets = self._sampled_id[str(int(roi_class))]
-                seed_x_in_roi = seed_points_inds[m] % rfcn_conf_in_roi.shape[1]
-                seed_y_in_roi = seed_points_inds[m] / rfcn_conf_in_roi.shape[1]
-                seed_x = (seed_x_in_roi + np.ceil(roi_x1)) 
-                seed_y = (seed_y_in_roi + np.ceil(roi_y1)) 
-                seed_rfcn_region = np.argmax(rfcn_conf_in_roi[seed_y_in_roi,seed_x_in_roi ,:])
-                region_x = seed_rfcn_region % (int(np.sqrt(cfg.TRAIN.num_rfcn_regions)))
-                region_y = seed_rfcn_region / (int(np.sqrt(cfg.TRAIN.num_rfcn_regions)))
-                seed_points[nroi * cfg.TRAIN.M + m,0] = seed_x
-                seed_points[nroi * cfg.TRAIN.M + m,1] = seed_y
-                seed_points_feat[nroi * cfg.TRAIN.M + m,:] = rfcn_feat[0,seed_rfcn_region*cfg.TRAIN.num_features:(seed_rfcn_region+1)*cfg.TRAIN.num_features, seed_y,seed_x]
-                for idx in xrange(cfg.TRAIN.num_regions * cfg.TRAIN.num_samples):
-                    sampled_x = seed_x + feat_ext_offsets[idx , 0]
-                    sampled_y = seed_y + feat_ext_offsets[idx , 1]
-                    if sampled_x >=0 and sampled_x < rfcn_conf.shape[2] and sampled_y >= 0 and sampled_y < rfcn_conf.shape[1] :
-                        region_weights = rfcn_conf[0,sampled_y,sampled_x,:,:,roi_class]
-                        if feat_ext_offsets[idx , 0] > 0 : 
-                            region_weights[:,0:seed_x_in_roi] = 0.0
-                        else:
-                            region_weights[:,seed_x_in_roi + 1 : ] = 0.0
-                        if feat_ext_offsets[idx , 1] > 0 : 
-                            region_weights[0:seed_y_in_roi,:] = 0.0
-                        else:
-                            region_weights[seed_y_in_roi + 1:,:] = 0.0
-                        rfcn_region_weights[nroi * cfg.TRAIN.M + m, idx, :] =  region_weights.reshape((cfg.TRAIN.num_rfcn_regions)) #/ region_weights.sum() 
-
-                if self._agnostic_box:
-                    box_category_label = 0 - np.minimum(0,rois[nroi,4,0,0])
-                else:
-                    box_category_label = rois[nroi,4,0,0] - 1
-            
-                point2top = (seed_y - roi_y1)/self._roi_scale
-                point2left = (seed_x - roi_x1)/self._roi_scale
-                point2bottom =( - seed_y + roi_y2)/self._roi_scale
-                point2right = (- seed_x + roi_x2)/self._roi_scale
-
-                
-                bbox_cls_inweights[ nroi * cfg.TRAIN.M + m ,box_category_label * self._num_regions: (box_category_label+1) * self._num_regions] =  1.0 / np.minimum(cfg.TRAIN.M, seed_points_inds.shape[0])
-
-                for i in xrange(self._num_regions_one_side / 2 ): #bound begin from 0
-                    if self._region_bound_x[i] <  point2left and point2left < self._region_bound_x[1 + i]:
-                        x_ind = self._num_regions_one_side / 2 - i - 1
-                        for j in xrange(self._num_regions_one_side / 2 ): 
-                            if self._region_bound_y[j] <  point2top:
-                                y_ind = self._num_regions_one_side / 2 - j - 1
-                                bbox_cls_labels[nroi * cfg.TRAIN.M + m ,(box_category_label) * self._num_regions + y_ind * self._num_regions_one_side + x_ind] = 1
-                                count += 1
-                            if self._region_bound_y[j] <  point2bottom:
-                                y_ind = self._num_regions_one_side / 2 + j 
-                                bbox_cls_labels[nroi * cfg.TRAIN.M + m ,(box_category_label) * self._num_regions + y_ind * self._num_regions_one_side + x_ind ] = 1
-                                count += 1
-                        bbox_reg_labels[nroi * cfg.TRAIN.M + m ,(box_category_label) *self._num_regions_one_side * 2 + x_ind ] = ( self._region_bound_x[1 + i] - point2left)/(self._region_bound_x[1 + i] - self._region_bound_x[i]) - 0.5
-                        bbox_inweights[nroi * cfg.TRAIN.M + m ,(box_category_label) *self._num_regions_one_side * 2 + x_ind ]= 1
-                    if self._region_bound_x[i] <  point2right and point2right < self._region_bound_x[1 + i]:
-                        x_ind = self._num_regions_one_side / 2 + i 
-                        for j in xrange(self._num_regions_one_side / 2 ): 
-                            if self._region_bound_x[j] <  point2top:
-                                y_ind = self._num_regions_one_side / 2 - j - 1
-                                bbox_cls_labels[nroi * cfg.TRAIN.M + m ,(box_category_label) * self._num_regions + y_ind * self._num_regions_one_side + x_ind ] = 1
-                                count += 1
-                            if self._region_bound_x[j] <  point2bottom:
-                                y_ind = self._num_regions_one_side / 2 + j 
-                                bbox_cls_labels[nroi * cfg.TRAIN.M + m ,(box_category_label) * self._num_regions + y_ind * self._num_regions_one_side + x_ind ] = 1
-                                count += 1
-                        bbox_reg_labels[nroi * cfg.TRAIN.M + m ,(box_category_label) *self._num_regions_one_side * 2 + x_ind ] = ( self._region_bound_x[1 + i] - point2right)/(self._region_bound_x[1 + i] - self._region_bound_x[i]) - 0.5
-                        bbox_inweights[nroi * cfg.TRAIN.M + m ,(box_category_label) *self._num_regions_one_side * 2 + x_ind ]= 1
-                
-                for i in xrange(self._num_regions_one_side / 2 ): #bound begin from 0
-                    if self._region_bound_y[i] <  point2top and point2top < self._region_bound_y[1 + i]:
-                        y_ind = self._num_regions_one_side / 2 - i - 1
-                        for j in xrange(self._num_regions_one_side / 2 ): 
-                            if self._region_bound_x[j] <  point2left:
-                                x_ind = self._num_regions_one_side / 2 - j - 1
-                                bbox_cls_labels[nroi * cfg.TRAIN.M + m ,(box_category_label) * self._num_regions + y_ind * self._num_regions_one_side + x_ind ] = 1
-                                count += 1
-                            if self._region_bound_x[j] <  point2right:
-                                x_ind = self._num_regions_one_side / 2 + j 
-                                bbox_cls_labels[nroi * cfg.TRAIN.M + m ,box_category_label * self._num_regions + y_ind * self._num_regions_one_side + x_ind ] = 1
-                                count += 1
-                        bbox_reg_labels[nroi * cfg.TRAIN.M + m ,box_category_label*self._num_regions_one_side * 2 + self._num_regions_one_side+ y_ind ] = ( self._region_bound_y[1 + i] - point2top )/(self._region_bound_y[1 + i] - self._region_bound_y[i]) - 0.5
-                        bbox_inweights[nroi * cfg.TRAIN.M + m ,box_category_label *self._num_regions_one_side * 2 + self._num_regions_one_side+y_ind ]= 1
-                            
-                    if self._region_bound_y[i] <  point2bottom and point2bottom < self._region_bound_y[1 + i]:
-                        y_ind = self._num_regions_one_side / 2 + i 
-                        for j in xrange(self._num_regions_one_side / 2 ): 
-                            if self._region_bound_x[j] <  point2left:
-                                x_ind = self._num_regions_one_side / 2 - j - 1
-                                bbox_cls_labels[nroi * cfg.TRAIN.M + m ,box_category_label * self._num_regions + y_ind * self._num_regions_one_side + x_ind ] = 1
-                                count += 1
-                            if self._region_bound_x[j] <  point2right:
-                                x_ind = self._num_regions_one_side / 2 + j 
-                                bbox_cls_labels[nroi * cfg.TRAIN.M + m ,box_category_label* self._num_regions + y_ind * self._num_regions_one_side + x_ind ] = 1
-                                count += 1
-                        bbox_reg_labels[nroi * cfg.TRAIN.M + m ,box_category_label*self._num_regions_one_side * 2 + self._num_regions_one_side+ y_ind ] = ( self._region_bound_y[1 + i] -point2bottom )/(self._region_bound_y[1 + i] - self._region_bound_y[i]) - 0.5
-                        bbox_inweights[nroi * cfg.TRAIN.M + m ,box_category_label*self._num_regions_one_side * 2 + self._num_regions_one_side+y_ind ]= 1
-                count -= 4
-            
-        rfcn_region_weights = rfcn_region_weights.reshape((self._num_rois * cfg.TRAIN.M, self._num_regions , cfg.TRAIN.num_samples, cfg.TRAIN.num_rfcn_regions))
-        bbox_reg_labels = bbox_reg_labels.reshape((self._num_rois * cfg.TRAIN.M , self._num_classes , self._num_regions_one_side * 2, 1)).transpose([0,2,1,3])
-        bbox_inweights = bbox_inweights.reshape((self._num_rois * cfg.TRAIN.M , self._num_classes , self._num_regions_one_side * 2, 1)).transpose([0,2,1,3])
-        bbox_outweights = bbox_outweights.reshape((self._num_rois * cfg.TRAIN.M , self._num_classes , self._num_regions_one_side * 2, 1)).transpose([0,2,1,3])
-
-        top[0].reshape(*(seed_points.shape))
-        top[1].reshape(*(rfcn_region_weights.shape))
-        top[2].reshape(*(bbox_cls_labels.shape))
-        top[3].reshape(*(bbox_cls_inweights.shape))
-        top[4].reshape(*(bbox_cls_outweights.shape))
-        top[5].reshape(*(bbox_reg_labels.shape))
-        top[6].reshape(*(bbox_inweights.shape))
-        top[7].reshape(*(bbox_outweights.shape))
-        top[8].reshape(*(seed_points_feat.shape))
-        top[9].reshape(*(sampled_id.shape))
-            # Copy data into net's input blobs
-        top[0].data[...] = seed_points
-        top[1].data[...] = rfcn_region_weights
-        top[2].data[...] = bbox_cls_labels
-        top[3].data[...] = bbox_cls_inweights
-        top[4].data[...] = bbox_cls_outweights
-        top[5].data[...] = bbox_reg_labels
-        top[6].data[...] = bbox_inweights
-        top[7].data[...] = bbox_outweights
-        top[8].data[...] = seed_points_feat
-        top[9].data[...] = sampled_id
-
-        
-
-
+        num_seeds = self._num_rois * cfg.TRAIN.M
+        top_data(top[0], (num_seeds, 2))
+        top_data(top[1], (num_seeds, self._num_regions, cfg.TRAIN.num_samples, cfg.TRAIN.num_rfcn_regions))
+        top_data(top[2], (num_seeds, self._num_classes_box * self._num_regions))
+        top_data(top[3], (num_seeds, self._num_classes_box * self._num_regions))
+        top_data(top[4], (num_seeds, self._num_classes_box * self._num_regions))
+        top_data(top[5], (num_seeds, self._num_regions_one_side * 2, self._num_classes_box, 1))
+        top_data(top[6], (num_seeds, self._num_regions_one_side * 2, self._num_classes_box, 1))
+        top_data(top[7], (num_seeds, self._num_regions_one_side * 2, self._num_classes_box, 1))
+        top_data(top[8], (num_seeds, cfg.TRAIN.num_features))
+        top_data(top[9], (num_seeds, cfg.TRAIN.num_samples*cfg.TRAIN.num_regions, 2))
+        # labels are built per seed (one class slice each) and scattered
+        # straight into the top buffers
+        for blob in top:
+            blob.data[...] = 0
+        top[4].data[...] = 1
+        top[7].data[...] = 1
+
+        rois = rois.reshape((rois.shape[0], rois.shape[1]))
+        conf = rfcn_conf[0].reshape(rfcn_conf.shape[1:3] + (cfg.TRAIN.num_rfcn_regions, -1))
+        seeds = select_seeds(conf, rois, cfg.TRAIN.M, self._roi_scale)
+        rows = seeds['rows']
+        roi_classes = rois[seeds['roi_inds'], 4].astype(np.int)
+        seed_x = seeds['x'].astype(np.int)
+        seed_y = seeds['y'].astype(np.int)
+
+        top[0].data[rows, 0] = seeds['x']
+        top[0].data[rows, 1] = seeds['y']
+        rfcn_feat = rfcn_feat[0].reshape((cfg.TRAIN.num_rfcn_regions, cfg.TRAIN.num_features) + rfcn_feat.shape[2:])
+        top[8].data[rows, :] = rfcn_feat[seeds['regions'], :, seed_y, seed_x]
+        top[9].data[rows] = self._sampled_id_table[roi_classes]
+
+        seed_region_weights(conf, seeds, roi_classes, self._sampled_id_table,
+                            self._half_plane_masks, top[1].data, cfg.TRAIN.region_weights_chunk)
+
+        if self._agnostic_box:
+            box_category_label = 0 - np.minimum(0, roi_classes)
+        else:
+            box_category_label = roi_classes - 1
+        cls_labels, reg_labels, reg_weights = seed_box_labels(
+            *(seed_distances(seeds, self._roi_scale) +
+              (self._bucketizer, roi_classes)))
+        cls_inweights = np.repeat(1.0 / seeds['num_in_roi'][:, np.newaxis], self._num_regions, axis=1)
+
+        scatter_class_slices(top[2].data, rows, box_category_label, cls_labels)
+        scatter_class_slices(top[3].data, rows, box_category_label, cls_inweights)
+        scatter_class_axis(top[5].data, rows, box_category_label, reg_labels)
+        scatter_class_axis(top[6].data, rows, box_category_label, reg_weights)
 
     def backward(self, top, propagate_down, bottom):
         """This layer does not propagate gradients."""
@@ -5,37 +5,55 @@
 # Written by Ross Girshick
 # --------------------------------------------------------
 
-"""Transform a roidb into a trainable roidb by adding a bunch of metadata."""
+"""Transform a roidb into a trainable roidb by adding a bunch of metadata.
+
+prepare_roidb turns the entries into RoidbEntry dicts, which compute the
+derived fields ('width' / 'height' unless the annotations gave them,
+'max_overlaps', 'max_classes' and 'bbox_targets') on first access, so
+training starts without a pass over every image. Entries computed in a
+prefetch worker are cached in that worker.
+"""
 
 import numpy as np
 from fast_rcnn.config import cfg
 from fast_rcnn.bbox_transform import bbox_transform
-from utils.cython_bbox import bbox_overlaps
-import PIL
-
-
-def prepare_roidb(imdb):
-    """Enrich the imdb's roidb by adding some derived quantities that
-    are useful for training. This function precomputes the maximum
-    overlap, taken over ground-truth boxes, between each ROI and
-    each ground-truth box. The class with maximum overlap is also
-    recorded.
-    """
-    sizes = [PIL.Image.open(imdb.image_path_at(i)).size
-             for i in xrange(imdb.num_images)]
-    roidb = imdb.roidb
-    for i in xrange(len(imdb.image_index)):
-        roidb[i]['image'] = imdb.image_path_at(i)
-        roidb[i]['width'] = sizes[i][0]
-        roidb[i]['height'] = sizes[i][1]
+from utils.cython_overlaps import bbox_overlaps_max
+
+class BboxTargetStats(object):
+    """Means and stds the regression targets are normalized with."""
+    def __init__(self, means, stds):
+        self.means = means
+        self.stds = stds
+
+class RoidbEntry(dict):
+    """A roidb entry computing its derived fields on first access."""
+    def __init__(self, entry, imdb, index):
+        super(RoidbEntry, self).__init__(entry)
+        self._imdb = imdb
+        self._index = index
+        # set by add_bbox_regression_targets
+        self.target_stats = None
+        self.unnormalized_targets = None
+
+    def __missing__(self, key):
+        if key in ('width', 'height'):
+            self['width'], self['height'] = \
+                self._imdb.image_size_at(self._index)
+        elif key in ('max_overlaps', 'max_classes'):
+            self._set_max_overlaps()
+        elif key == 'bbox_targets' and self.target_stats is not None:
+            self['bbox_targets'] = self._normalized_targets()
+        else:
+            raise KeyError(key)
+        return self[key]
+
+    def _set_max_overlaps(self):
         # need gt_overlaps as a dense array for argmax
-        gt_overlaps = roidb[i]['gt_overlaps'].toarray()
+        gt_overlaps = self['gt_overlaps'].toarray()
         # max overlap with gt over classes (columns)
         max_overlaps = gt_overlaps.max(axis=1)
         # gt class that had the max overlap
         max_classes = gt_overlaps.argmax(axis=1)
-        roidb[i]['max_classes'] = max_classes
-        roidb[i]['max_overlaps'] = max_overlaps
         # sanity checks
         # max overlap of 0 => class should be zero (background)
         zero_inds = np.where(max_overlaps == 0)[0]
@@ -43,22 +61,59 @@ def prepare_roidb(imdb):
         # max overlap > 0 => class should not be zero (must be a fg class)
         nonzero_inds = np.where(max_overlaps > 0)[0]
         assert all(max_classes[nonzero_inds] != 0)
+        self['max_classes'] = max_classes
+        self['max_overlaps'] = max_overlaps
+
+    def compute_targets(self):
+        """(class, dx, dy, dw, dh) regression target rows, unnormalized."""
+        if self.unnormalized_targets is None:
+            self.unnormalized_targets = _compute_targets(
+                self['boxes'], self['max_overlaps'], self['max_classes'])
+        return self.unnormalized_targets
+
+    def _normalized_targets(self):
+        targets = self.compute_targets()
+        self.unnormalized_targets = None
+        if cfg.TRAIN.BBOX_NORMALIZE_TARGETS:
+            fg_inds, reg_classes = _reg_classes(targets)
+            targets[fg_inds, 1:] -= self.target_stats.means[reg_classes]
+            targets[fg_inds, 1:] /= self.target_stats.stds[reg_classes]
+        return targets
+
+def _reg_classes(targets):
+    """Indices of the foreground target rows and their regression class."""
+    fg_inds = np.where(targets[:, 0] > 0)[0]
+    if cfg.TRAIN.AGNOSTIC:
+        return fg_inds, np.ones(fg_inds.size, dtype=np.int)
+    return fg_inds, targets[fg_inds, 0].astype(np.int)
+
+def prepare_roidb(imdb):
+    """Make the imdb's roidb trainable: every entry gets the path of its
+    image, and computes on first access the maximum overlap, taken over
+    ground-truth boxes, between each ROI and each ground-truth box, the
+    class with maximum overlap and, if the annotations did not give it, the
+    size of the image.
+    """
+    roidb = imdb.roidb
+    for i in xrange(len(imdb.image_index)):
+        roidb[i] = RoidbEntry(roidb[i], imdb, i)
+        roidb[i]['image'] = imdb.image_path_at(i)
 
 
 def add_bbox_regression_targets(roidb):
-    """Add information needed to train bounding-box regressors."""
+    """Add information needed to train bounding-box regressors.
+
+    With cfg.TRAIN.BBOX_NORMALIZE_TARGETS_PRECOMPUTED the targets of an
+    entry are computed on first access. Otherwise one pass computes them
+    and accumulates their means and stds, and each entry is normalized on
+    first access.
+    """
     assert len(roidb) > 0
-    assert 'max_classes' in roidb[0], 'Did you call prepare_roidb first?'
+    assert isinstance(roidb[0], RoidbEntry), \
+        'Did you call prepare_roidb first?'
 
-    num_images = len(roidb)
     # Infer number of classes from the number of columns in gt_overlaps
     num_reg_classes = 2 if cfg.TRAIN.AGNOSTIC else roidb[0]['gt_overlaps'].shape[1]
-    for im_i in xrange(num_images):
-        rois = roidb[im_i]['boxes']
-        max_overlaps = roidb[im_i]['max_overlaps']
-        max_classes = roidb[im_i]['max_classes']
-        roidb[im_i]['bbox_targets'] = \
-            _compute_targets(rois, max_overlaps, max_classes)
 
     if cfg.TRAIN.BBOX_NORMALIZE_TARGETS_PRECOMPUTED:
         # Use fixed / precomputed "means" and "stds" instead of empirical values
@@ -72,16 +127,14 @@ def add_bbox_regression_targets(roidb):
         class_counts = np.zeros((num_reg_classes, 1)) + cfg.EPS
         sums = np.zeros((num_reg_classes, 4))
         squared_sums = np.zeros((num_reg_classes, 4))
-        for im_i in xrange(num_images):
-            targets = roidb[im_i]['bbox_targets']
-            for cls in xrange(1, num_reg_classes):
-                cls_inds = np.where(targets[:, 0] > 0)[0] if cfg.TRAIN.AGNOSTIC \
-                    else np.where(targets[:, 0] == cls)[0]
-                if cls_inds.size > 0:
-                    class_counts[cls] += cls_inds.size
-                    sums[cls, :] += targets[cls_inds, 1:].sum(axis=0)
-                    squared_sums[cls, :] += \
-                        (targets[cls_inds, 1:] ** 2).sum(axis=0)
+        for entry in roidb:
+            targets = entry.compute_targets()
+            fg_inds, reg_classes = _reg_classes(targets)
+            deltas = targets[fg_inds, 1:].astype(np.float64)
+            class_counts[:, 0] += np.bincount(reg_classes,
+                                              minlength=num_reg_classes)
+            np.add.at(sums, reg_classes, deltas)
+            np.add.at(squared_sums, reg_classes, deltas ** 2)
 
         means = sums / class_counts
         stds = np.sqrt(squared_sums / class_counts - means ** 2)
@@ -93,18 +146,13 @@ def add_bbox_regression_targets(roidb):
     print stds
     print stds[1:, :].mean(axis=0)  # ignore bg class
 
-    # Normalize targets
     if cfg.TRAIN.BBOX_NORMALIZE_TARGETS:
         print "Normalizing targets"
-        for im_i in xrange(num_images):
-            targets = roidb[im_i]['bbox_targets']
-            for cls in xrange(1, num_reg_classes):
-                cls_inds = np.where(targets[:, 0] > 0) if cfg.TRAIN.AGNOSTIC \
-                    else np.where(targets[:, 0] == cls)[0]
-                roidb[im_i]['bbox_targets'][cls_inds, 1:] -= means[cls, :]
-                roidb[im_i]['bbox_targets'][cls_inds, 1:] /= stds[cls, :]
     else:
         print "NOT normalizing targets"
+    stats = BboxTargetStats(means, stds)
+    for entry in roidb:
+        entry.target_stats = stats
 
     # These values will be needed for making predictions
     # (the predicts will need to be unnormalized and uncentered)
@@ -122,13 +170,13 @@ def _compute_targets(rois, overlaps, labels):
     ex_inds = np.where(overlaps >= cfg.TRAIN.BBOX_THRESH)[0]
 
     # Get IoU overlap between each ex ROI and gt ROI
-    ex_gt_overlaps = bbox_overlaps(
-        np.ascontiguousarray(rois[ex_inds, :], dtype=np.float),
-        np.ascontiguousarray(rois[gt_inds, :], dtype=np.float))
-
     # Find which gt ROI each ex ROI has max overlap with:
     # this will be the ex ROI's gt target
-    gt_assignment = ex_gt_overlaps.argmax(axis=1)
+    # one thread: entries are computed lazily, also in the forked prefetch
+    # workers, where an OpenMP team started by the parent would hang
+    gt_assignment = bbox_overlaps_max(
+        np.ascontiguousarray(rois[ex_inds, :], dtype=np.float),
+        rois[gt_inds, :], num_threads=1)[0]
     gt_rois = rois[gt_inds[gt_assignment], :]
     ex_rois = rois[ex_inds, :]
 
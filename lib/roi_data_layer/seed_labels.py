@@ -0,0 +1,266 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""Batched seed-point label engine for the box annotation layers.
+
+The annotation layers pick a few "seed" pixels inside every RoI and, for each
+seed, label which of the num_regions_one_side x num_regions_one_side regions
+around it are covered by the RoI (bbox_cls_labels) and how far each RoI side
+sits inside the region it falls in (bbox_reg_labels). This module computes
+those labels for all RoIs x seeds with array operations. It does not depend
+on caffe so it can be benchmarked and checked on its own.
+"""
+
+import numpy as np
+
+
+def select_seeds(rfcn_conf, rois, num_seeds, roi_scale):
+    """Pick the num_seeds most confident pixels inside every RoI.
+
+    Arguments:
+        rfcn_conf (ndarray): H x W x P x C part confidences (P = 7 * 7 parts)
+        rois (ndarray): R x 5 array of (x1, y1, x2, y2, cls) in image space
+        num_seeds (int): seeds per RoI (cfg.TRAIN.M)
+        roi_scale (float): image -> feature map scale
+
+    Returns:
+        seeds (dict): one entry per selected seed with keys
+            'rows': output row (roi * num_seeds + m)
+            'roi_inds': RoI the seed belongs to
+            'x_in_roi', 'y_in_roi': seed position relative to the RoI crop
+            'x', 'y': seed position on the feature map (float)
+            'regions': most confident part at the seed
+            'num_in_roi': number of seeds selected for the seed's RoI
+            'roi_boxes': R x 4 RoI boxes on the feature map (float64)
+    """
+    num_rois = rois.shape[0]
+    # float64 to match the scalar arithmetic of the per-RoI loop
+    roi_boxes = rois[:, :4].astype(np.float64) * roi_scale
+    classes = rois[:, 4].astype(np.int)
+    starts = np.ceil(roi_boxes[:, :2]).astype(np.int)
+    ends = np.floor(roi_boxes[:, 2:]).astype(np.int) + 1
+
+    inds = []
+    counts = np.zeros(num_rois, dtype=np.int)
+    widths = np.zeros(num_rois, dtype=np.int)
+    for nroi in xrange(num_rois):
+        conf_in_roi = rfcn_conf[starts[nroi, 1]:ends[nroi, 1],
+                                starts[nroi, 0]:ends[nroi, 0],
+                                :, classes[nroi]]
+        max_conf = conf_in_roi.max(axis=2).ravel()
+        # argsort (not argpartition) keeps tie-breaking identical to the
+        # original per-seed loop
+        seed_inds = np.argsort(max_conf)[-num_seeds:]
+        inds.append(seed_inds)
+        counts[nroi] = seed_inds.shape[0]
+        widths[nroi] = conf_in_roi.shape[1]
+
+    roi_inds = np.repeat(np.arange(num_rois), counts)
+    seed_inds = np.hstack(inds).astype(np.int) if num_rois > 0 \
+        else np.zeros(0, dtype=np.int)
+    offsets = np.cumsum(counts) - counts
+    m = np.arange(seed_inds.shape[0]) - np.repeat(offsets, counts)
+
+    x_in_roi = seed_inds % widths[roi_inds]
+    y_in_roi = seed_inds // widths[roi_inds]
+    x = x_in_roi + np.ceil(roi_boxes[roi_inds, 0])
+    y = y_in_roi + np.ceil(roi_boxes[roi_inds, 1])
+    regions = rfcn_conf[y.astype(np.int), x.astype(np.int), :,
+                        classes[roi_inds]].argmax(axis=1)
+
+    return {'rows': roi_inds * num_seeds + m,
+            'roi_inds': roi_inds,
+            'x_in_roi': x_in_roi,
+            'y_in_roi': y_in_roi,
+            'x': x,
+            'y': y,
+            'regions': regions,
+            'num_in_roi': counts[roi_inds],
+            'roi_boxes': roi_boxes}
+
+
+def seed_distances(seeds, roi_scale):
+    """Distances (in image pixels) from every seed to its RoI's four sides.
+
+    Returns:
+        left, top, right, bottom (ndarray): one value per seed
+    """
+    boxes = seeds['roi_boxes'][seeds['roi_inds']]
+    left = (seeds['x'] - boxes[:, 0]) / roi_scale
+    top = (seeds['y'] - boxes[:, 1]) / roi_scale
+    right = (-seeds['x'] + boxes[:, 2]) / roi_scale
+    bottom = (-seeds['y'] + boxes[:, 3]) / roi_scale
+    return left, top, right, bottom
+
+
+def seed_reg_labels(left, top, right, bottom, bucketizer, classes=None):
+    """Region regression labels for a batch of seeds.
+
+    Each RoI side that falls strictly inside a region gets the normalized
+    offset of that side within the region.
+
+    Arguments:
+        left, top, right, bottom (ndarray): N distances from each seed to the
+            RoI sides, in image pixels
+        bucketizer (RegionBucketizer): region bounds
+        classes (ndarray): class per seed, for per-class bounds
+
+    Returns:
+        reg_labels (ndarray): N x 2S regression targets (S for x, S for y),
+            S = num_regions_one_side
+        reg_weights (ndarray): N x 2S, 1 where reg_labels is defined
+    """
+    S = bucketizer.num_regions_one_side
+    half = bucketizer.half
+    reg_labels = np.zeros((left.shape[0], 2 * S))
+    reg_weights = np.zeros((left.shape[0], 2 * S))
+    for dist, axis, slot in ((left, 'x', lambda i: half - i - 1),
+                             (right, 'x', lambda i: half + i),
+                             (top, 'y', lambda i: S + half - i - 1),
+                             (bottom, 'y', lambda i: S + half + i)):
+        inds, valid = bucketizer.bucket(dist, axis, classes)
+        n = np.where(valid)[0]
+        cls = classes[n] if classes is not None else None
+        reg_labels[n, slot(inds[n])] = \
+            bucketizer.offset(dist[n], inds[n], axis, cls)
+        reg_weights[n, slot(inds[n])] = 1
+    return reg_labels, reg_weights
+
+
+def seed_box_labels(left, top, right, bottom, bucketizer, classes=None):
+    """Region classification and regression labels for a batch of seeds.
+
+    Arguments:
+        left, top, right, bottom (ndarray): N distances from each seed to the
+            RoI sides, in image pixels
+        bucketizer (RegionBucketizer): region bounds
+        classes (ndarray): class per seed, for per-class bounds
+
+    Returns:
+        cls_labels (ndarray): N x (S * S) region labels, S = num_regions_one_side
+        reg_labels (ndarray): N x 2S regression targets (S for x, S for y)
+        reg_weights (ndarray): N x 2S, 1 where reg_labels is defined
+    """
+    S = bucketizer.num_regions_one_side
+    half = bucketizer.half
+    num = left.shape[0]
+
+    left_i, left_ok = bucketizer.bucket(left, 'x', classes)
+    right_i, right_ok = bucketizer.bucket(right, 'x', classes)
+    top_i, top_ok = bucketizer.bucket(top, 'y', classes)
+    bottom_i, bottom_ok = bucketizer.bucket(bottom, 'y', classes)
+
+    # A seed that falls in a column (row) bucket labels a contiguous run of
+    # rows (columns) in it. The right column compares top/bottom against
+    # the x bounds, as the original labelling does.
+    rows = np.arange(S)[np.newaxis, :, np.newaxis]
+    cols = np.arange(S)[np.newaxis, np.newaxis, :]
+
+    def _col_run(ok, col, up, down):
+        return (ok[:, None, None] & (cols == col[:, None, None]) &
+                (rows >= (half - up)[:, None, None]) &
+                (rows < (half + down)[:, None, None]))
+
+    def _row_run(ok, row, lft, rgt):
+        return (ok[:, None, None] & (rows == row[:, None, None]) &
+                (cols >= (half - lft)[:, None, None]) &
+                (cols < (half + rgt)[:, None, None]))
+
+    count_left = bucketizer.count_below(left, 'x', classes)
+    count_right = bucketizer.count_below(right, 'x', classes)
+    grid = _col_run(left_ok, half - left_i - 1,
+                    bucketizer.count_below(top, 'y', classes),
+                    bucketizer.count_below(bottom, 'y', classes))
+    grid |= _col_run(right_ok, half + right_i,
+                     bucketizer.count_below(top, 'x', classes),
+                     bucketizer.count_below(bottom, 'x', classes))
+    grid |= _row_run(top_ok, half - top_i - 1, count_left, count_right)
+    grid |= _row_run(bottom_ok, half + bottom_i, count_left, count_right)
+    cls_labels = grid.reshape((num, S * S)).astype(np.float64)
+
+    reg_labels, reg_weights = seed_reg_labels(left, top, right, bottom,
+                                              bucketizer, classes)
+    return cls_labels, reg_labels, reg_weights
+
+
+def half_plane_masks(grid_size):
+    """Keep-masks for zeroing one side of the R-FCN part grid.
+
+    Returns:
+        masks (ndarray): 2 x (grid_size + 1) x grid_size bool array.
+            masks[1, s] keeps parts >= s (positive sample offset) and
+            masks[0, s] keeps parts <= s; s is clipped to grid_size.
+    """
+    G = int(grid_size)
+    s = np.arange(G + 1)[:, np.newaxis]
+    parts = np.arange(G)[np.newaxis, :]
+    return np.stack((parts <= s, parts >= s))
+
+
+def seed_region_weights(rfcn_conf, seeds, classes, offsets, masks, out,
+                        chunk_size):
+    """Gather the masked part confidences at every seed's sample offsets.
+
+    Arguments:
+        rfcn_conf (ndarray): H x W x P x C part confidences
+        seeds (dict): output of select_seeds
+        classes (ndarray): class index into rfcn_conf and offsets, per seed
+        offsets (ndarray): C x K x 2 sample offsets (sampled_id) per class
+        masks (ndarray): output of half_plane_masks
+        out (ndarray): rows x K x P array, written in place
+        chunk_size (int): (seed, offset) pairs gathered at a time
+    """
+    height, width = rfcn_conf.shape[:2]
+    num_parts = rfcn_conf.shape[2]
+    G = masks.shape[2]
+    K = offsets.shape[1]
+    # assigning .shape raises instead of silently copying
+    out = out.view()
+    out.shape = (-1, num_parts)
+    num_pairs = seeds['rows'].shape[0] * K
+    for start in xrange(0, num_pairs, chunk_size):
+        pairs = np.arange(start, min(start + chunk_size, num_pairs))
+        n = pairs // K
+        k = pairs % K
+        off = offsets[classes[n], k]
+        x = seeds['x'][n] + off[:, 0]
+        y = seeds['y'][n] + off[:, 1]
+        keep = np.where((x >= 0) & (x < width) & (y >= 0) & (y < height))[0]
+        n, k, off = n[keep], k[keep], off[keep]
+        weights = rfcn_conf[y[keep].astype(np.int), x[keep].astype(np.int),
+                            :, classes[n]]
+        cols = masks[(off[:, 0] > 0).astype(np.int),
+                     np.minimum(seeds['x_in_roi'][n], G)]
+        rows = masks[(off[:, 1] > 0).astype(np.int),
+                     np.minimum(seeds['y_in_roi'][n], G)]
+        mask = rows[:, :, np.newaxis] & cols[:, np.newaxis, :]
+        out[seeds['rows'][n] * K + k] = \
+            weights * mask.reshape((keep.shape[0], num_parts))
+
+
+def scatter_class_slices(out, rows, classes, values):
+    """out[row, cls * K + k] = values[:, k] for every seed.
+
+    Arguments:
+        out (ndarray): seeds x (num_classes * K) top, written in place
+        rows, classes (ndarray): output row and class slice per seed
+        values (ndarray): N x K compact per-seed values
+    """
+    cols = classes[:, np.newaxis] * values.shape[1] + np.arange(values.shape[1])
+    out[rows[:, np.newaxis], cols] = values
+
+
+def scatter_class_axis(out, rows, classes, values):
+    """out[row, k, cls, 0] = values[:, k] for every seed.
+
+    Arguments:
+        out (ndarray): seeds x K x num_classes x 1 top, written in place
+        rows, classes (ndarray): output row and class per seed
+        values (ndarray): N x K compact per-seed values
+    """
+    out[rows[:, np.newaxis], np.arange(values.shape[1]),
+        classes[:, np.newaxis], 0] = values
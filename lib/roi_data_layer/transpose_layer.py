@@ -17,6 +17,7 @@ import numpy as np
 import yaml
 from multiprocessing import Process, Queue
 import scipy.io as sio
+from utils.top_blobs import top_data
 class RoIDataLayer(caffe.Layer):
     """Fast R-CNN data layer used for training."""
 
@@ -31,12 +32,11 @@ class RoIDataLayer(caffe.Layer):
         self._order_str = layer_params['order']
         self._order_str = self._order_str.split(',')
         self._order = [int(order_item) for order_item in self._order_str ]
-        self._order_back = np.zeros((len(self._order_str)))
-        tmp = np.zeros(shape).transpose(self._order)
+        self._order_back = np.zeros((len(self._order_str)), dtype=np.int)
 
-        top[0].reshape(*(tmp.shape))
+        top[0].reshape(*[shape[i] for i in self._order])
         for i in xrange(len(self._order_str)):
-            self._order_back[self._order_str[i]] = i
+            self._order_back[self._order[i]] = i
 
 
 
@@ -44,18 +44,14 @@ class RoIDataLayer(caffe.Layer):
     def forward(self, bottom, top):
         """Get blobs and copy them into this layer's top blob vector."""
         
-        data = bottom[0].data
-        data = np.transpose(data,self._order) 
-        top[0].reshape(*(data.shape))
-        top[0].data[...] = data
+        data = np.transpose(bottom[0].data, self._order)
+        # transpose is a view; the copy happens straight into the top blob
+        top_data(top[0], data.shape)[...] = data
 
 
     def backward(self, top, propagate_down, bottom):
         """This layer does not propagate gradients."""
-        diff = top[0].diff
-        diff = np.transpose(diff, self._order_back)
-        bottom[0].reshape(*(diff.shape))
-        bottom[0].diff[...] = diff
+        bottom[0].diff[...] = np.transpose(top[0].diff, self._order_back)
 
 
     def reshape(self, bottom, top):
@@ -0,0 +1,112 @@
+# --------------------------------------------------------
+# Faster R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick and Sean Bell
+# --------------------------------------------------------
+
+"""Shifted anchor grids, cached across forwards.
+
+Feature map sizes only take a few values (cfg.TRAIN.SCALES / MAX_SIZE), so
+the (K * A, 4) grid of anchors shifted over every cell, and the indices of
+the anchors inside an image, are built once per size and kept in LRU caches
+of cfg.ANCHOR_CACHE_SIZE entries. Cached arrays are shared between callers:
+index them (which copies) before modifying anything. anchor_grids is shared
+by ProposalLayer, AnchorTargetLayer and generate.imdb_rpn_compute_stats.
+"""
+
+import numpy as np
+from collections import OrderedDict
+from fast_rcnn.config import cfg
+from generate_anchors import generate_anchors
+
+class LRUCache(object):
+    """A dict holding the most recently used entries, with hit counters."""
+    def __init__(self):
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        """The entry for key, built by build() on a miss."""
+        if key in self._entries:
+            self.hits += 1
+            value = self._entries.pop(key)
+        else:
+            self.misses += 1
+            value = build()
+        self._entries[key] = value
+        while len(self._entries) > max(cfg.ANCHOR_CACHE_SIZE, 1):
+            self._entries.popitem(last=False)
+        return value
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups > 0 else 0.
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+class AnchorGridCache(object):
+    """Anchor grids and inside-image indices, keyed on their parameters."""
+    def __init__(self):
+        self._grids = LRUCache()
+        self._inside = LRUCache()
+
+    def anchors(self, height, width, feat_stride, scales=(8, 16, 32),
+                ratios=(0.5, 1, 2)):
+        """(height * width * A, 4) anchors, rows ordered by (h, w, a)."""
+        key = (int(height), int(width), feat_stride, tuple(scales),
+               tuple(ratios))
+        return self._grids.get(key, lambda: _shifted_anchors(
+            height, width, feat_stride, scales, ratios))
+
+    def inds_inside(self, height, width, feat_stride, im_height, im_width,
+                    allowed_border=0, scales=(8, 16, 32),
+                    ratios=(0.5, 1, 2)):
+        """Indices of the anchors lying inside a im_height x im_width image,
+        give or take allowed_border."""
+        key = (int(height), int(width), feat_stride, tuple(scales),
+               tuple(ratios), float(im_height), float(im_width),
+               allowed_border)
+        def build():
+            all_anchors = self.anchors(height, width, feat_stride, scales,
+                                       ratios)
+            return np.where(
+                (all_anchors[:, 0] >= -allowed_border) &
+                (all_anchors[:, 1] >= -allowed_border) &
+                (all_anchors[:, 2] < im_width + allowed_border) &  # width
+                (all_anchors[:, 3] < im_height + allowed_border)   # height
+            )[0]
+        return self._inside.get(key, build)
+
+    def stats(self):
+        """'anchors' and 'inds_inside' hit rates, in [0, 1]."""
+        return {'anchors': self._grids.hit_rate(),
+                'inds_inside': self._inside.hit_rate()}
+
+    def clear(self):
+        self._grids.clear()
+        self._inside.clear()
+
+def _shifted_anchors(height, width, feat_stride, scales, ratios):
+    anchors = generate_anchors(ratios=list(ratios), scales=np.array(scales))
+    # Enumerate all shifts
+    shift_x = np.arange(0, width) * feat_stride
+    shift_y = np.arange(0, height) * feat_stride
+    shift_x, shift_y = np.meshgrid(shift_x, shift_y)
+    shifts = np.vstack((shift_x.ravel(), shift_y.ravel(),
+                        shift_x.ravel(), shift_y.ravel())).transpose()
+    # add A anchors (1, A, 4) to
+    # cell K shifts (K, 1, 4) to get
+    # shift anchors (K, A, 4)
+    # reshape to (K*A, 4) shifted anchors
+    A = anchors.shape[0]
+    K = shifts.shape[0]
+    all_anchors = (anchors.reshape((1, A, 4)) +
+                   shifts.reshape((1, K, 4)).transpose((1, 0, 2)))
+    return all_anchors.reshape((K * A, 4))
+
+anchor_grids = AnchorGridCache()
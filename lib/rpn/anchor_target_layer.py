@@ -12,8 +12,11 @@ from fast_rcnn.config import cfg
 import numpy as np
 import numpy.random as npr
 from generate_anchors import generate_anchors
-from utils.cython_bbox import bbox_overlaps
+from anchor_grid import anchor_grids
+from image_batch import split_gt_boxes
+from utils.cython_overlaps import bbox_overlaps_max
 from fast_rcnn.bbox_transform import bbox_transform
+from utils.top_blobs import top_data, ScratchBuffers
 
 DEBUG = False
 
@@ -25,8 +28,8 @@ class AnchorTargetLayer(caffe.Layer):
 
     def setup(self, bottom, top):
         layer_params = yaml.load(self.param_str)
-        anchor_scales = layer_params.get('scales', (8, 16, 32))
-        self._anchors = generate_anchors(scales=np.array(anchor_scales))
+        self._anchor_scales = tuple(layer_params.get('scales', (8, 16, 32)))
+        self._anchors = generate_anchors(scales=np.array(self._anchor_scales))
         self._num_anchors = self._anchors.shape[0]
         self._feat_stride = layer_params['feat_stride']
 
@@ -47,6 +50,8 @@ class AnchorTargetLayer(caffe.Layer):
 
         # allow boxes to sit over the edge by a small amount
         self._allowed_border = layer_params.get('allowed_border', 0)
+        # full-size (all anchors) label arrays, reused across forwards
+        self._buffers = ScratchBuffers()
 
         height, width = bottom[0].data.shape[-2:]
         if DEBUG:
@@ -68,19 +73,59 @@ class AnchorTargetLayer(caffe.Layer):
         # for each (H, W) location i
         #   generate 9 anchor boxes centered on cell i
         #   apply predicted bbox deltas at cell i to each of the 9 anchors
-        # filter out-of-image anchors
-        # measure GT overlap
+        # for each image n of the batch
+        #   filter anchors outside image n (im_info row n)
+        #   measure overlap with the GT boxes of image n
 
-        assert bottom[0].data.shape[0] == 1, \
-            'Only single item batches are supported'
+        num_images = bottom[0].data.shape[0]
+        assert bottom[2].data.shape[0] == num_images, \
+            'im_info needs one row per image'
 
         # map of shape (..., H, W)
         height, width = bottom[0].data.shape[-2:]
-        # GT boxes (x1, y1, x2, y2, label)
-        gt_boxes = bottom[1].data
-        # im_info
-        im_info = bottom[2].data[0, :]
+        # GT boxes (x1, y1, x2, y2, label) of every image
+        gt_boxes = split_gt_boxes(bottom[1].data, num_images)
 
+        # 1. Generate proposals from bbox deltas and shifted anchors
+        # (K*A, 4) anchors shifted over every cell, cached per map size;
+        # images are padded to one size, so they share the anchors
+        all_anchors = anchor_grids.anchors(height, width, self._feat_stride,
+                                           self._anchor_scales)
+        A = self._num_anchors
+
+        labels = top_data(top[0], (num_images, 1, A * height, width))
+        bbox_targets = top_data(top[1], (num_images, A * 4, height, width))
+        bbox_inside_weights = top_data(top[2],
+                                       (num_images, A * 4, height, width))
+        bbox_outside_weights = top_data(top[3],
+                                        (num_images, A * 4, height, width))
+        for n in xrange(num_images):
+            targets = self._image_targets(all_anchors, gt_boxes[n],
+                                          bottom[2].data[n, :], height, width)
+            # labels
+            labels[n:n + 1].reshape((1, A, height, width))[...] = \
+                targets[0].reshape((1, height, width, A)).transpose(0, 3, 1, 2)
+            # bbox_targets, bbox_inside_weights, bbox_outside_weights
+            for blob, data in zip((bbox_targets, bbox_inside_weights,
+                                   bbox_outside_weights), targets[1:]):
+                blob[n:n + 1] = data.reshape((1, height, width, A * 4)) \
+                    .transpose(0, 3, 1, 2)
+
+    def _image_targets(self, all_anchors, gt_boxes, im_info, height, width):
+        """Anchor labels and regression targets of one image.
+
+        Arguments:
+            all_anchors (ndarray): (K*A) x 4 shifted anchors
+            gt_boxes (ndarray): G x 5 (x1, y1, x2, y2, label) of the image
+            im_info (ndarray): (height, width, scale) of the image
+            height, width (int): feature map size
+
+        Returns:
+            labels (ndarray): K*A labels (1 fg, 0 bg, -1 don't care)
+            bbox_targets (ndarray): (K*A) x 4 regression targets
+            bbox_inside_weights (ndarray): (K*A) x 4
+            bbox_outside_weights (ndarray): (K*A) x 4
+        """
         if DEBUG:
             print ''
             print 'im_size: ({}, {})'.format(im_info[0], im_info[1])
@@ -89,30 +134,12 @@ class AnchorTargetLayer(caffe.Layer):
             print 'rpn: gt_boxes.shape', gt_boxes.shape
             print 'rpn: gt_boxes', gt_boxes
 
-        # 1. Generate proposals from bbox deltas and shifted anchors
-        shift_x = np.arange(0, width) * self._feat_stride
-        shift_y = np.arange(0, height) * self._feat_stride
-        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-        shifts = np.vstack((shift_x.ravel(), shift_y.ravel(),
-                            shift_x.ravel(), shift_y.ravel())).transpose()
-        # add A anchors (1, A, 4) to
-        # cell K shifts (K, 1, 4) to get
-        # shift anchors (K, A, 4)
-        # reshape to (K*A, 4) shifted anchors
-        A = self._num_anchors
-        K = shifts.shape[0]
-        all_anchors = (self._anchors.reshape((1, A, 4)) +
-                       shifts.reshape((1, K, 4)).transpose((1, 0, 2)))
-        all_anchors = all_anchors.reshape((K * A, 4))
-        total_anchors = int(K * A)
+        total_anchors = all_anchors.shape[0]
 
         # only keep anchors inside the image
-        inds_inside = np.where(
-            (all_anchors[:, 0] >= -self._allowed_border) &
-            (all_anchors[:, 1] >= -self._allowed_border) &
-            (all_anchors[:, 2] < im_info[1] + self._allowed_border) &  # width
-            (all_anchors[:, 3] < im_info[0] + self._allowed_border)    # height
-        )[0]
+        inds_inside = anchor_grids.inds_inside(
+            height, width, self._feat_stride, im_info[0], im_info[1],
+            self._allowed_border, self._anchor_scales)
 
         if DEBUG:
             print 'total_anchors', total_anchors
@@ -129,16 +156,11 @@ class AnchorTargetLayer(caffe.Layer):
 
         # overlaps between the anchors and the gt boxes
         # overlaps (ex, gt)
-        gt_boxes = gt_boxes.reshape(gt_boxes.shape[0], gt_boxes.shape[1])
-        overlaps = bbox_overlaps(
-            np.ascontiguousarray(anchors, dtype=np.float),
-            np.ascontiguousarray(gt_boxes, dtype=np.float))
-        argmax_overlaps = overlaps.argmax(axis=1)
-        max_overlaps = overlaps[np.arange(len(inds_inside)), argmax_overlaps]
-        gt_argmax_overlaps = overlaps.argmax(axis=0)
-        gt_max_overlaps = overlaps[gt_argmax_overlaps,
-                                   np.arange(overlaps.shape[1])]
-        gt_argmax_overlaps = np.where(overlaps == gt_max_overlaps)[0]
+        # only the maxima are needed, not the (ex, gt) matrix itself;
+        # gt_argmax_overlaps holds every anchor tying a gt's best overlap
+        argmax_overlaps, max_overlaps, _, _, gt_argmax_overlaps = \
+            bbox_overlaps_max(np.ascontiguousarray(anchors, dtype=np.float),
+                              gt_boxes[:, :4], return_ties=True)
 
         if not cfg.TRAIN.RPN_CLOBBER_POSITIVES:
             # assign bg labels first so that positive labels can clobber them
@@ -206,10 +228,14 @@ class AnchorTargetLayer(caffe.Layer):
             print stds
 
         # map up to original set of anchors
-        labels = _unmap(labels, total_anchors, inds_inside, fill=-1)
-        bbox_targets = _unmap(bbox_targets, total_anchors, inds_inside, fill=0)
-        bbox_inside_weights = _unmap(bbox_inside_weights, total_anchors, inds_inside, fill=0)
-        bbox_outside_weights = _unmap(bbox_outside_weights, total_anchors, inds_inside, fill=0)
+        labels = _unmap(labels, total_anchors, inds_inside, fill=-1,
+                        out=self._buffers.get('labels', (total_anchors,)))
+        bbox_targets = _unmap(bbox_targets, total_anchors, inds_inside, fill=0,
+                              out=self._buffers.get('bbox_targets', (total_anchors, 4)))
+        bbox_inside_weights = _unmap(bbox_inside_weights, total_anchors, inds_inside, fill=0,
+                                     out=self._buffers.get('bbox_inside_weights', (total_anchors, 4)))
+        bbox_outside_weights = _unmap(bbox_outside_weights, total_anchors, inds_inside, fill=0,
+                                      out=self._buffers.get('bbox_outside_weights', (total_anchors, 4)))
 
         if DEBUG:
             print 'rpn: max max_overlap', np.max(max_overlaps)
@@ -221,33 +247,7 @@ class AnchorTargetLayer(caffe.Layer):
             print 'rpn: num_positive avg', self._fg_sum / self._count
             print 'rpn: num_negative avg', self._bg_sum / self._count
 
-        # labels
-        labels = labels.reshape((1, height, width, A)).transpose(0, 3, 1, 2)
-        labels = labels.reshape((1, 1, A * height, width))
-        top[0].reshape(*labels.shape)
-        top[0].data[...] = labels
-
-        # bbox_targets
-        bbox_targets = bbox_targets \
-            .reshape((1, height, width, A * 4)).transpose(0, 3, 1, 2)
-        top[1].reshape(*bbox_targets.shape)
-        top[1].data[...] = bbox_targets
-
-        # bbox_inside_weights
-        bbox_inside_weights = bbox_inside_weights \
-            .reshape((1, height, width, A * 4)).transpose(0, 3, 1, 2)
-        assert bbox_inside_weights.shape[2] == height
-        assert bbox_inside_weights.shape[3] == width
-        top[2].reshape(*bbox_inside_weights.shape)
-        top[2].data[...] = bbox_inside_weights
-
-        # bbox_outside_weights
-        bbox_outside_weights = bbox_outside_weights \
-            .reshape((1, height, width, A * 4)).transpose(0, 3, 1, 2)
-        assert bbox_outside_weights.shape[2] == height
-        assert bbox_outside_weights.shape[3] == width
-        top[3].reshape(*bbox_outside_weights.shape)
-        top[3].data[...] = bbox_outside_weights
+        return labels, bbox_targets, bbox_inside_weights, bbox_outside_weights
 
     def backward(self, top, propagate_down, bottom):
         """This layer does not propagate gradients."""
@@ -258,15 +258,16 @@ class AnchorTargetLayer(caffe.Layer):
         pass
 
 
-def _unmap(data, count, inds, fill=0):
+def _unmap(data, count, inds, fill=0, out=None):
     """ Unmap a subset of item (data) back to the original set of items (of
-    size count) """
+    size count), into out if given """
     if len(data.shape) == 1:
-        ret = np.empty((count, ), dtype=np.float32)
+        ret = np.empty((count, ), dtype=np.float32) if out is None else out
         ret.fill(fill)
         ret[inds] = data
     else:
-        ret = np.empty((count, ) + data.shape[1:], dtype=np.float32)
+        ret = np.empty((count, ) + data.shape[1:], dtype=np.float32) \
+            if out is None else out
         ret.fill(fill)
         ret[inds, :] = data
     return ret
@@ -8,9 +8,11 @@
 from fast_rcnn.config import cfg
 from fast_rcnn.train import filter_roidb
 from utils.blob import im_list_to_blob
+from utils.image_cache import image_cache, imread
 from utils.timer import Timer
 from generate_anchors import generate_anchors
-from utils.cython_bbox import bbox_overlaps
+from anchor_grid import anchor_grids
+from utils.cython_overlaps import bbox_overlaps_max
 from fast_rcnn.bbox_transform import bbox_transform
 import numpy as np
 import cv2
@@ -95,8 +97,10 @@ def im_proposals(net, im):
             data=blobs['data'].astype(np.float32, copy=False),
             im_info=blobs['im_info'].astype(np.float32, copy=False))
 
+    # the rois are decoded, clipped and filtered by the net's ProposalLayer
+    # (bbox_transform_inv_clip_filter); only the rescale is left here
     scale = blobs['im_info'][0, 2]
-    boxes = blobs_out['rois'][:, 1:].copy() / scale
+    boxes = blobs_out['rois'][:, 1:] / scale
     scores = blobs_out['scores'].copy()
     return boxes, scores
 
@@ -106,7 +110,7 @@ def imdb_proposals(net, imdb):
     _t = Timer()
     imdb_boxes = [[] for _ in xrange(imdb.num_images)]
     for i in xrange(imdb.num_images):
-        im = cv2.imread(imdb.image_path_at(i))
+        im = imread(imdb.image_path_at(i))
         _t.tic()
         imdb_boxes[i], scores = im_proposals(net, im)
         _t.toc()
@@ -117,6 +121,8 @@ def imdb_proposals(net, imdb):
             # from IPython import embed; embed()
             _vis_proposals(im, dets[:3, :], thresh=0.9)
             plt.show()
+    if image_cache.enabled():
+        print image_cache.summary()
 
     return imdb_boxes
 
@@ -149,53 +155,32 @@ def imdb_rpn_compute_stats(net, imdb, anchor_scales=(8,16,32),
     for i in xrange(len(roidb)):
         if not i % 5000:
             print 'computing %d/%d' % (i, imdb.num_images)
-        im = cv2.imread(roidb[i]['image'])
+        im = imread(roidb[i]['image'])
         im_data, im_info = _get_image_blob(im)
         gt_boxes = roidb[i]['boxes']
         gt_boxes = gt_boxes * im_info[0, 2]
         height = map_h[im_data.shape[2]]
         width = map_w[im_data.shape[3]]
         # 1. Generate proposals from bbox deltas and shifted anchors
-        shift_x = np.arange(0, width) * feature_stride
-        shift_y = np.arange(0, height) * feature_stride
-        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-        shifts = np.vstack((shift_x.ravel(), shift_y.ravel(),
-                            shift_x.ravel(), shift_y.ravel())).transpose()
-        # add A anchors (1, A, 4) to
-        # cell K shifts (K, 1, 4) to get
-        # shift anchors (K, A, 4)
-        # reshape to (K*A, 4) shifted anchors
-        A = raw_anchors.shape[0]
-        K = shifts.shape[0]
-        all_anchors = (raw_anchors.reshape((1, A, 4)) +
-                       shifts.reshape((1, K, 4)).transpose((1, 0, 2)))
-        all_anchors = all_anchors.reshape((K * A, 4))
+        all_anchors = anchor_grids.anchors(height, width, feature_stride,
+                                           anchor_scales)
 
         # only keep anchors inside the image
-        inds_inside = np.where(
-            (all_anchors[:, 0] >= 0) &
-            (all_anchors[:, 1] >= 0) &
-            (all_anchors[:, 2] < im_info[0, 1]) &  # width
-            (all_anchors[:, 3] < im_info[0, 0])  # height
-        )[0]
+        inds_inside = anchor_grids.inds_inside(
+            height, width, feature_stride, im_info[0, 0], im_info[0, 1],
+            scales=anchor_scales)
 
         # keep only inside anchors
         anchors = all_anchors[inds_inside, :]
 
-        overlaps = bbox_overlaps(
-            np.ascontiguousarray(anchors, dtype=np.float),
-            np.ascontiguousarray(gt_boxes, dtype=np.float))
+        argmax_overlaps, max_overlaps, _, _, gt_argmax_overlaps = \
+            bbox_overlaps_max(np.ascontiguousarray(anchors, dtype=np.float),
+                              gt_boxes[:, :4], return_ties=True)
 
         # There are 2 types of bbox targets
         # 1. anchor whose overlaps with gt is greater than RPN_POSITIVE_OVERLAP
-        argmax_overlaps = overlaps.argmax(axis=1)
-        max_overlaps = overlaps[np.arange(len(inds_inside)), argmax_overlaps]
         fg_inds = np.where(max_overlaps >= cfg.TRAIN.RPN_POSITIVE_OVERLAP)[0]
         # 2. anchors which best match certain gt
-        gt_argmax_overlaps = overlaps.argmax(axis=0)
-        gt_max_overlaps = overlaps[gt_argmax_overlaps,
-                                   np.arange(overlaps.shape[1])]
-        gt_argmax_overlaps = np.where(overlaps == gt_max_overlaps)[0]
         fg_inds = np.unique(np.hstack((fg_inds, gt_argmax_overlaps)))
         gt_rois = gt_boxes[argmax_overlaps, :]
 
@@ -206,6 +191,8 @@ def imdb_rpn_compute_stats(net, imdb, anchor_scales=(8,16,32),
         squred_sums += (targets ** 2).sum(axis=0)
         counts += targets.shape[0]
 
+    print 'anchor cache hit rate: grids {:.1%}, inds_inside {:.1%}'.format(
+        anchor_grids.stats()['anchors'], anchor_grids.stats()['inds_inside'])
     means = sums / counts
     stds = np.sqrt(squred_sums / counts - means ** 2)
     print means
@@ -0,0 +1,50 @@
+# --------------------------------------------------------
+# Faster R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick and Sean Bell
+# --------------------------------------------------------
+
+"""Per-image views of the blobs of an N-image RPN batch.
+
+Images of a batch are padded to a common size in the data blob. im_info
+holds one (height, width, scale) row per image, the height and width being
+those of the image before padding. gt_boxes holds (x1, y1, x2, y2, label)
+rows for a single image; for N > 1 images every row carries the index of its
+image in a sixth column, (x1, y1, x2, y2, label, n).
+"""
+
+import numpy as np
+
+def split_gt_boxes(gt_boxes, num_images):
+    """G x 5 gt boxes of every image of the batch.
+
+    Arguments:
+        gt_boxes (ndarray): G x 5, or G x 6 with the image index last
+        num_images (int): number of images in the batch
+
+    Returns:
+        gt_boxes (list): num_images arrays of (x1, y1, x2, y2, label) rows
+    """
+    gt_boxes = gt_boxes.reshape(gt_boxes.shape[0], gt_boxes.shape[1])
+    if gt_boxes.shape[1] == 5:
+        assert num_images == 1, \
+            'gt_boxes of a {}-image batch need an image index column' \
+            .format(num_images)
+        return [gt_boxes]
+    assert gt_boxes.shape[1] == 6, \
+        'gt_boxes must have 5 or 6 columns, not {}'.format(gt_boxes.shape[1])
+    image_inds = gt_boxes[:, 5].astype(np.int)
+    return [gt_boxes[image_inds == n, :5] for n in xrange(num_images)]
+
+def batch_gt_boxes(gt_boxes):
+    """Stack per-image G_n x 5 gt boxes into one gt_boxes blob.
+
+    A single image keeps the 5-column layout; several images get the image
+    index appended as a sixth column.
+    """
+    if len(gt_boxes) == 1:
+        return gt_boxes[0]
+    return np.vstack([np.hstack((boxes, np.full((boxes.shape[0], 1), n,
+                                                dtype=boxes.dtype)))
+                      for n, boxes in enumerate(gt_boxes)])
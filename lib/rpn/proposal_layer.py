@@ -7,28 +7,48 @@
 
 import caffe
 import numpy as np
+import time
 import yaml
 from fast_rcnn.config import cfg
 from generate_anchors import generate_anchors
-from fast_rcnn.bbox_transform import bbox_transform_inv, clip_boxes
-from fast_rcnn.nms_wrapper import nms
+from anchor_grid import anchor_grids
+from utils.cython_bbox import bbox_transform_inv_clip_filter
+from fast_rcnn.nms_wrapper import nms, multiclass_nms
+from utils.top_blobs import top_data, ScratchBuffers
 
 DEBUG = False
 
+# forward() stages reported to ProposalLayer.stage_hook, in order; the first
+# three run once per image
+STAGES = ('topk', 'decode', 'nms', 'output')
+
+def _top_k(scores, k):
+    """Indices of the k highest scores, highest first."""
+    if k < scores.shape[0]:
+        order = np.argpartition(scores, scores.shape[0] - k)[-k:]
+    else:
+        order = np.arange(scores.shape[0])
+    return order[scores[order].argsort()[::-1]]
+
 class ProposalLayer(caffe.Layer):
     """
     Outputs object detection proposals by applying estimated bounding-box
     transformations to a set of regular boxes (called "anchors").
     """
 
+    # if set, called as stage_hook(stage, seconds) after every stage of
+    # forward (see STAGES), e.g. with a utils.timer.StageTimers
+    stage_hook = None
+
     def setup(self, bottom, top):
         # parse the layer parameter string, which must be valid YAML
         layer_params = yaml.load(self.param_str)
 
         self._feat_stride = layer_params['feat_stride']
-        anchor_scales = layer_params.get('scales', (8, 16, 32))
-        self._anchors = generate_anchors(scales=np.array(anchor_scales))
+        self._anchor_scales = tuple(layer_params.get('scales', (8, 16, 32)))
+        self._anchors = generate_anchors(scales=np.array(self._anchor_scales))
         self._num_anchors = self._anchors.shape[0]
+        self._buffers = ScratchBuffers()
 
         if DEBUG:
             print 'feat_stride: {}'.format(self._feat_stride)
@@ -44,64 +64,98 @@ class ProposalLayer(caffe.Layer):
         if len(top) > 1:
             top[1].reshape(1, 1, 1, 1)
 
+    def _stage_done(self, stage):
+        if self.stage_hook is not None:
+            now = time.time()
+            self.stage_hook(stage, now - self._stage_start)
+            self._stage_start = now
+
     def forward(self, bottom, top):
         # Algorithm:
         #
-        # for each (H, W) location i
-        #   generate A anchor boxes centered on cell i
-        #   apply predicted bbox deltas at cell i to each of the A anchors
-        # clip predicted boxes to image
-        # remove predicted boxes with either height or width < threshold
-        # sort all (proposal, score) pairs by score from highest to lowest
-        # take top pre_nms_topN proposals before NMS
-        # apply NMS with threshold 0.7 to remaining proposals
-        # take after_nms_topN proposals after NMS
-        # return the top proposals (-> RoIs top, scores top)
-
-        assert bottom[0].data.shape[0] == 1, \
-            'Only single item batches are supported'
+        # for each image n of the batch
+        #   for each (H, W) location i
+        #     generate A anchor boxes centered on cell i
+        #   take the pre_nms_topN highest scoring (anchor, score) pairs,
+        #   sorted from highest to lowest
+        #   apply predicted bbox deltas to each of them
+        #   clip predicted boxes to image n (im_info row n)
+        #   remove predicted boxes with either height or width < threshold
+        #   (widening the top-k if fewer than pre_nms_topN are left)
+        #   apply NMS with threshold 0.7 to remaining proposals
+        #   take after_nms_topN proposals after NMS
+        # return the top proposals of all images (-> RoIs top, scores top)
+
+        num_images = bottom[0].data.shape[0]
+        assert bottom[2].data.shape[0] == num_images, \
+            'im_info needs one row per image'
+        if self.stage_hook is not None:
+            self._stage_start = time.time()
 
         cfg_key = str('TRAIN' if self.phase == 0 else 'TEST') # either 'TRAIN' or 'TEST'
+
+        # 1. Generate proposals from bbox deltas and shifted anchors
+        # (images are padded to one size, so they share the anchors)
+        height, width = bottom[0].data.shape[-2:]
+
+        if DEBUG:
+            print 'score map size: {}'.format(bottom[0].data.shape)
+
+        # Enumerate all shifted anchors, (K*A, 4) rows ordered by (h, w, a);
+        # cached per feature map size
+        anchors = anchor_grids.anchors(height, width, self._feat_stride,
+                                       self._anchor_scales)
+
+        # the first set of _num_anchors channels are bg probs
+        # the second set are the fg probs, which we want
+        image_rois = [self._image_proposals(
+            bottom[0].data[n:n + 1, self._num_anchors:, :, :],
+            bottom[1].data[n:n + 1], bottom[2].data[n, :], anchors, cfg_key)
+            for n in xrange(num_images)]
+
+        # Output rois blob, (n, x1, y1, x2, y2) with the batch index n of
+        # the image each proposal comes from
+        num_rois = sum(proposals.shape[0] for proposals, _ in image_rois)
+        blob = top_data(top[0], (num_rois, 5))
+        # [Optional] output scores blob
+        scores_blob = top_data(top[1], (num_rois, 1)) if len(top) > 1 \
+            else None
+        start = 0
+        for n, (proposals, scores) in enumerate(image_rois):
+            end = start + proposals.shape[0]
+            blob[start:end, 0] = n
+            blob[start:end, 1:] = proposals
+            if scores_blob is not None:
+                scores_blob[start:end] = scores
+            start = end
+        self._stage_done('output')
+
+    def _image_proposals(self, scores, bbox_deltas, im_info, anchors,
+                         cfg_key):
+        """Proposals of one image and their scores, best first.
+
+        Arguments:
+            scores (ndarray): 1 x A x H x W fg scores
+            bbox_deltas (ndarray): 1 x 4A x H x W predicted deltas
+            im_info (ndarray): (height, width, scale) of the image
+            anchors (ndarray): (H * W * A) x 4 shifted anchors
+            cfg_key (str): 'TRAIN' or 'TEST'
+
+        Returns:
+            proposals (ndarray): R x 4 boxes
+            scores (ndarray): R x 1 scores
+        """
         pre_nms_topN  = cfg[cfg_key].RPN_PRE_NMS_TOP_N
         post_nms_topN = cfg[cfg_key].RPN_POST_NMS_TOP_N
         nms_thresh    = cfg[cfg_key].RPN_NMS_THRESH
         min_size      = cfg[cfg_key].RPN_MIN_SIZE
-
-        # the first set of _num_anchors channels are bg probs
-        # the second set are the fg probs, which we want
-        scores = bottom[0].data[:, self._num_anchors:, :, :]
-        bbox_deltas = bottom[1].data
-        im_info = bottom[2].data[0, :]
+        # Soft-NMS / box voting only at test time
+        nms_mode      = cfg.TEST.NMS_MODE if cfg_key == 'TEST' else 'hard'
 
         if DEBUG:
             print 'im_size: ({}, {})'.format(im_info[0], im_info[1])
             print 'scale: {}'.format(im_info[2])
 
-        # 1. Generate proposals from bbox deltas and shifted anchors
-        height, width = scores.shape[-2:]
-
-        if DEBUG:
-            print 'score map size: {}'.format(scores.shape)
-
-        # Enumerate all shifts
-        shift_x = np.arange(0, width) * self._feat_stride
-        shift_y = np.arange(0, height) * self._feat_stride
-        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-        shifts = np.vstack((shift_x.ravel(), shift_y.ravel(),
-                            shift_x.ravel(), shift_y.ravel())).transpose()
-
-        # Enumerate all shifted anchors:
-        #
-        # add A anchors (1, A, 4) to
-        # cell K shifts (K, 1, 4) to get
-        # shift anchors (K, A, 4)
-        # reshape to (K*A, 4) shifted anchors
-        A = self._num_anchors
-        K = shifts.shape[0]
-        anchors = self._anchors.reshape((1, A, 4)) + \
-                  shifts.reshape((1, K, 4)).transpose((1, 0, 2))
-        anchors = anchors.reshape((K * A, 4))
-
         # Transpose and reshape predicted bbox transformations to get them
         # into the same order as the anchors:
         #
@@ -110,59 +164,79 @@ class ProposalLayer(caffe.Layer):
         # reshape to (1 * H * W * A, 4) where rows are ordered by (h, w, a)
         # in slowest to fastest order
         bbox_deltas = bbox_deltas.transpose((0, 2, 3, 1)).reshape((-1, 4))
-        if cfg_key == 'TRAIN' and cfg.TRAIN.RPN_NORMALIZE_TARGETS:
-            bbox_deltas *= cfg.TRAIN.RPN_NORMALIZE_STDS
-            bbox_deltas += cfg.TRAIN.RPN_NORMALIZE_MEANS
 
         # Same story for the scores:
         #
         # scores are (1, A, H, W) format
         # transpose to (1, H, W, A)
-        # reshape to (1 * H * W * A, 1) where rows are ordered by (h, w, a)
-        scores = scores.transpose((0, 2, 3, 1)).reshape((-1, 1))
-
-        # Convert anchors into proposals via bbox transformations
-        proposals = bbox_transform_inv(anchors, bbox_deltas)
-
-        # 2. clip predicted boxes to image
-        proposals = clip_boxes(proposals, im_info[:2])
-
-        # 3. remove predicted boxes with either height or width < threshold
-        # (NOTE: convert min_size to input image scale stored in im_info[2])
-        keep = _filter_boxes(proposals, min_size * im_info[2])
-        proposals = proposals[keep, :]
-        scores = scores[keep]
-
-        # 4. sort all (proposal, score) pairs by score from highest to lowest
-        # 5. take top pre_nms_topN (e.g. 6000)
-        order = scores.ravel().argsort()[::-1]
-        if pre_nms_topN > 0:
-            order = order[:pre_nms_topN]
-        proposals = proposals[order, :]
-        scores = scores[order]
-
-        # 6. apply nms (e.g. threshold = 0.7)
-        # 7. take after_nms_topN (e.g. 300)
-        # 8. return the top proposals (-> RoIs top)
-        keep = nms(np.hstack((proposals, scores)), nms_thresh)
+        # reshape to (1 * H * W * A,) where rows are ordered by (h, w, a)
+        scores = scores.transpose((0, 2, 3, 1)).reshape(-1)
+
+        # 2. take the top pre_nms_topN (e.g. 6000) (anchor, score) pairs and
+        # sort them by score from highest to lowest, without sorting the rest
+        num_boxes = scores.shape[0]
+        top_n = pre_nms_topN if 0 < pre_nms_topN < num_boxes else num_boxes
+        order = _top_k(scores, top_n)
+        self._stage_done('topk')
+
+        while True:
+            # 3. convert their anchors into proposals via bbox
+            # transformations, clip predicted boxes to image and remove
+            # predicted boxes with either height or width < threshold
+            # (NOTE: convert min_size to input image scale stored in
+            # im_info[2]), all in one pass, into buffers kept across forwards
+            proposals, keep = self._decode(anchors, bbox_deltas, order,
+                                           im_info, min_size * im_info[2],
+                                           cfg_key)
+            if keep.shape[0] >= top_n or order.shape[0] == num_boxes:
+                break
+            # some of the top boxes were too small: widen the top-k so that
+            # top_n boxes survive the size filter, as when filtering all
+            # boxes before sorting
+            self._stage_done('decode')
+            order = _top_k(scores, min(2 * order.shape[0], num_boxes))
+            self._stage_done('topk')
+        keep = keep[:top_n]
+        proposals = proposals[:top_n]
+        scores = scores[order[keep]]
+        self._stage_done('decode')
+
+        # 4. apply nms (e.g. threshold = 0.7)
+        # 5. take after_nms_topN (e.g. 300)
+        # 6. return the top proposals (-> RoIs top)
+        dets = np.hstack((proposals, scores[:, np.newaxis]))
+        if nms_mode == 'hard':
+            keep = nms(dets, nms_thresh)
+        else:
+            # one class; kept boxes come out score-descending
+            keep, dets = multiclass_nms(
+                dets.astype(np.float32, copy=False),
+                np.zeros(dets.shape[0], dtype=np.int), nms_thresh,
+                mode=nms_mode)
         if post_nms_topN > 0:
             keep = keep[:post_nms_topN]
-        proposals = proposals[keep, :]
-        scores = scores[keep]
-
-        # Output rois blob
-        # Our RPN implementation only supports a single input image, so all
-        # batch inds are 0
-        batch_inds = np.zeros((proposals.shape[0], 1), dtype=np.float32)
-        blob = np.hstack((batch_inds, proposals.astype(np.float32, copy=False)))
-        # print blob.shape
-        top[0].reshape(*(blob.shape))
-        top[0].data[...] = blob
-
-        # [Optional] output scores blob
-        if len(top) > 1:
-            top[1].reshape(*(scores.shape))
-            top[1].data[...] = scores
+        self._stage_done('nms')
+        return dets[keep, :4], dets[keep, 4:5]
+
+    def _decode(self, anchors, bbox_deltas, order, im_info, min_size,
+                cfg_key):
+        """Decoded, clipped proposals of the anchors in order that are at
+        least min_size on both sides, and their indices into order."""
+        num_boxes = order.shape[0]
+        anchors = np.take(anchors, order, axis=0, mode='clip',
+                          out=self._buffers.get('anchors', (num_boxes, 4),
+                                                anchors.dtype))
+        bbox_deltas = np.take(bbox_deltas, order, axis=0, mode='clip',
+                              out=self._buffers.get('deltas', (num_boxes, 4),
+                                                    bbox_deltas.dtype))
+        if cfg_key == 'TRAIN' and cfg.TRAIN.RPN_NORMALIZE_TARGETS:
+            bbox_deltas *= cfg.TRAIN.RPN_NORMALIZE_STDS
+            bbox_deltas += cfg.TRAIN.RPN_NORMALIZE_MEANS
+        return bbox_transform_inv_clip_filter(
+            anchors, bbox_deltas, im_info[:2], min_size,
+            out=self._buffers.get('proposals', (num_boxes, 4),
+                                  bbox_deltas.dtype),
+            keep=self._buffers.get('keep', (num_boxes,), np.intp))
 
     def backward(self, top, propagate_down, bottom):
         """This layer does not propagate gradients."""
@@ -171,10 +245,3 @@ class ProposalLayer(caffe.Layer):
     def reshape(self, bottom, top):
         """Reshaping happens during the call to forward."""
         pass
-
-def _filter_boxes(boxes, min_size):
-    """Remove all boxes with any side smaller than min_size."""
-    ws = boxes[:, 2] - boxes[:, 0] + 1
-    hs = boxes[:, 3] - boxes[:, 1] + 1
-    keep = np.where((ws >= min_size) & (hs >= min_size))[0]
-    return keep
@@ -10,8 +10,10 @@ import yaml
 import numpy as np
 import numpy.random as npr
 from fast_rcnn.config import cfg
-from fast_rcnn.bbox_transform import bbox_transform
-from utils.cython_bbox import bbox_overlaps
+from fast_rcnn.bbox_transform import bbox_transform, expand_bbox_targets
+from utils.cython_overlaps import bbox_overlaps_max
+from utils.top_blobs import top_data
+from rpn.image_batch import split_gt_boxes
 
 DEBUG = False
 
@@ -25,7 +27,7 @@ class ProposalTargetLayer(caffe.Layer):
         layer_params = yaml.load(self.param_str)
         self._num_classes = layer_params['num_classes']
 
-        # sampled rois (0, x1, y1, x2, y2)
+        # sampled rois (n, x1, y1, x2, y2)
         top[0].reshape(1, 5, 1, 1)
         # labels
         top[1].reshape(1, 1, 1, 1)
@@ -37,33 +39,48 @@ class ProposalTargetLayer(caffe.Layer):
         top[4].reshape(1, self._num_classes * 4, 1, 1)
 
     def forward(self, bottom, top):
-        # Proposal ROIs (0, x1, y1, x2, y2) coming from RPN
-        # (i.e., rpn.proposal_layer.ProposalLayer), or any other source
+        # Proposal ROIs (n, x1, y1, x2, y2) coming from RPN
+        # (i.e., rpn.proposal_layer.ProposalLayer), or any other source,
+        # n being the index of the image in the batch
         all_rois = bottom[0].data
-        # GT boxes (x1, y1, x2, y2, label)
+        # GT boxes (x1, y1, x2, y2, label), plus the image index n for
+        # batches of several images (see rpn.image_batch)
         # TODO(rbg): it's annoying that sometimes I have extra info before
         # and other times after box coordinates -- normalize to one format
         gt_boxes = bottom[1].data
         gt_boxes = gt_boxes.reshape(gt_boxes.shape[0], gt_boxes.shape[1])
-        # Include ground-truth boxes in the set of candidate rois
-        zeros = np.zeros((gt_boxes.shape[0], 1), dtype=gt_boxes.dtype)
-        all_rois = np.vstack(
-            (all_rois, np.hstack((zeros, gt_boxes[:, :-1])))
-        )
-
-        # Sanity check: single batch only
-        assert np.all(all_rois[:, 0] == 0), \
-                'Only single item batches are supported'
-
-        rois_per_image = np.inf if cfg.TRAIN.BATCH_SIZE == -1 else cfg.TRAIN.BATCH_SIZE
+        num_images = 1
+        if all_rois.shape[0] > 0:
+            num_images = max(num_images, int(all_rois[:, 0].max()) + 1)
+        if gt_boxes.shape[1] == 6 and gt_boxes.shape[0] > 0:
+            num_images = max(num_images, int(gt_boxes[:, 5].max()) + 1)
+        gt_boxes = split_gt_boxes(gt_boxes, num_images)
+
+        rois_per_image = np.inf if cfg.TRAIN.BATCH_SIZE == -1 else \
+            cfg.TRAIN.BATCH_SIZE / num_images
         fg_rois_per_image = np.round(cfg.TRAIN.FG_FRACTION * rois_per_image)
 
         # Sample rois with classification labels and bounding box regression
-        # targets
+        # targets, image by image
         # print 'proposal_target_layer:', fg_rois_per_image
-        labels, rois, bbox_targets, bbox_inside_weights = _sample_rois(
-            all_rois, gt_boxes, fg_rois_per_image,
-            rois_per_image, self._num_classes)
+        samples = []
+        for n in xrange(num_images):
+            # Include ground-truth boxes in the set of candidate rois
+            batch_inds = np.empty((gt_boxes[n].shape[0], 1),
+                                  dtype=all_rois.dtype)
+            batch_inds.fill(n)
+            image_rois = np.vstack(
+                (all_rois[all_rois[:, 0] == n],
+                 np.hstack((batch_inds, gt_boxes[n][:, :4])))
+            )
+            samples.append(_sample_rois(
+                image_rois, gt_boxes[n], fg_rois_per_image,
+                rois_per_image, self._num_classes))
+        if num_images == 1:
+            labels, rois, bbox_targets, bbox_inside_weights = samples[0]
+        else:
+            labels, rois, bbox_targets, bbox_inside_weights = [
+                np.concatenate(arrays) for arrays in zip(*samples)]
 
         if DEBUG:
             print 'num fg: {}'.format((labels > 0).sum())
@@ -77,33 +94,23 @@ class ProposalTargetLayer(caffe.Layer):
 
         # sampled rois
         # modified by ywxiong
-        rois = rois.reshape((rois.shape[0], rois.shape[1], 1, 1))
-        top[0].reshape(*rois.shape)
-        top[0].data[...] = rois
+        top_data(top[0], rois.shape + (1, 1))[:, :, 0, 0] = rois
 
         # classification labels
         # modified by ywxiong
-        labels = labels.reshape((labels.shape[0], 1, 1, 1))
-        top[1].reshape(*labels.shape)
-        top[1].data[...] = labels
+        top_data(top[1], (labels.shape[0], 1, 1, 1))[:, 0, 0, 0] = labels
 
         # bbox_targets
         # modified by ywxiong
-        bbox_targets = bbox_targets.reshape((bbox_targets.shape[0], bbox_targets.shape[1], 1, 1))
-        top[2].reshape(*bbox_targets.shape)
-        top[2].data[...] = bbox_targets
+        top_data(top[2], bbox_targets.shape + (1, 1))[:, :, 0, 0] = bbox_targets
 
         # bbox_inside_weights
         # modified by ywxiong
-        bbox_inside_weights = bbox_inside_weights.reshape((bbox_inside_weights.shape[0], bbox_inside_weights.shape[1], 1, 1))
-        top[3].reshape(*bbox_inside_weights.shape)
-        top[3].data[...] = bbox_inside_weights
+        top_data(top[3], bbox_inside_weights.shape + (1, 1))[:, :, 0, 0] = bbox_inside_weights
 
         # bbox_outside_weights
         # modified by ywxiong
-        bbox_inside_weights = bbox_inside_weights.reshape((bbox_inside_weights.shape[0], bbox_inside_weights.shape[1], 1, 1))
-        top[4].reshape(*bbox_inside_weights.shape)
-        top[4].data[...] = np.array(bbox_inside_weights > 0).astype(np.float32)
+        top_data(top[4], bbox_inside_weights.shape + (1, 1))[:, :, 0, 0] = bbox_inside_weights > 0
 
     def backward(self, top, propagate_down, bottom):
         """This layer does not propagate gradients."""
@@ -114,40 +121,6 @@ class ProposalTargetLayer(caffe.Layer):
         pass
 
 
-def _get_bbox_regression_labels(bbox_target_data, num_classes):
-    """Bounding-box regression targets (bbox_target_data) are stored in a
-    compact form N x (class, tx, ty, tw, th)
-
-    This function expands those targets into the 4-of-4*K representation used
-    by the network (i.e. only one class has non-zero targets).
-
-    Returns:
-        bbox_target (ndarray): N x 4K blob of regression targets
-        bbox_inside_weights (ndarray): N x 4K blob of loss weights
-    """
-
-    clss = bbox_target_data[:, 0]
-    bbox_targets = np.zeros((clss.size, 4 * num_classes), dtype=np.float32)
-    # print 'proposal_target_layer:', bbox_targets.shape
-    bbox_inside_weights = np.zeros(bbox_targets.shape, dtype=np.float32)
-    inds = np.where(clss > 0)[0]
-    if cfg.TRAIN.AGNOSTIC:
-        for ind in inds:
-            cls = clss[ind]
-            start = 4 * (1 if cls > 0 else 0)
-            end = start + 4
-            bbox_targets[ind, start:end] = bbox_target_data[ind, 1:]
-            bbox_inside_weights[ind, start:end] = cfg.TRAIN.BBOX_INSIDE_WEIGHTS
-    else:
-        for ind in inds:
-            cls = clss[ind]
-            start = 4 * cls
-            end = start + 4
-            bbox_targets[ind, start:end] = bbox_target_data[ind, 1:]
-            bbox_inside_weights[ind, start:end] = cfg.TRAIN.BBOX_INSIDE_WEIGHTS
-    return bbox_targets, bbox_inside_weights
-
-
 def _compute_targets(ex_rois, gt_rois, labels):
     """Compute bounding-box regression targets for an image."""
 
@@ -168,11 +141,9 @@ def _sample_rois(all_rois, gt_boxes, fg_rois_per_image, rois_per_image, num_clas
     examples.
     """
     # overlaps: (rois x gt_boxes)
-    overlaps = bbox_overlaps(
+    gt_assignment, max_overlaps, _, _ = bbox_overlaps_max(
         np.ascontiguousarray(all_rois[:, 1:5], dtype=np.float),
-        np.ascontiguousarray(gt_boxes[:, :4], dtype=np.float))
-    gt_assignment = overlaps.argmax(axis=1)
-    max_overlaps = overlaps.max(axis=1)
+        gt_boxes[:, :4])
     labels = gt_boxes[gt_assignment, 4]
 
     # Select foreground RoIs as those with >= FG_THRESH overlap
@@ -210,7 +181,8 @@ def _sample_rois(all_rois, gt_boxes, fg_rois_per_image, rois_per_image, num_clas
         rois[:, 1:5], gt_boxes[gt_assignment[keep_inds], :4], labels)
 
     # print 'proposal_target_layer:', bbox_target_data
-    bbox_targets, bbox_inside_weights = \
-        _get_bbox_regression_labels(bbox_target_data, num_classes)
+    bbox_targets, bbox_inside_weights = expand_bbox_targets(
+        bbox_target_data, num_classes, cfg.TRAIN.AGNOSTIC,
+        cfg.TRAIN.BBOX_INSIDE_WEIGHTS)
 
     return labels, rois, bbox_targets, bbox_inside_weights
@@ -116,6 +116,14 @@ ext_modules = [
         extra_compile_args={'gcc': ["-Wno-cpp", "-Wno-unused-function"]},
         include_dirs = [numpy_include]
     ),
+    Extension(
+        "utils.cython_overlaps",
+        ["utils/overlaps.pyx"],
+        extra_compile_args={'gcc': ["-Wno-cpp", "-Wno-unused-function",
+                                    "-fopenmp"]},
+        extra_link_args=['-fopenmp'],
+        include_dirs = [numpy_include]
+    ),
     Extension(
         "nms.cpu_nms",
         ["nms/cpu_nms.pyx"],
@@ -53,3 +53,124 @@ def bbox_overlaps(
                     )
                     overlaps[n, k] = iw * ih / ua
     return overlaps
+
+from libc.math cimport exp
+
+cdef extern from "math.h" nogil:
+    float expf(float x)
+
+ctypedef fused coord_t:
+    np.float32_t
+    np.float64_t
+
+ctypedef fused box_t:
+    np.float32_t
+    np.float64_t
+
+cdef inline coord_t _clip(coord_t v, coord_t hi) nogil:
+    # max(min(v, hi), 0), as clip_boxes
+    v = v if v <= hi else hi
+    return v if v >= 0 else 0
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Py_ssize_t _decode_clip(box_t[:, :] boxes, coord_t[:, :] deltas,
+                             coord_t height, coord_t width, coord_t min_size,
+                             bint filter_small, coord_t[:, ::1] out,
+                             np.intp_t[::1] keep) nogil:
+    # bbox_transform_inv + clip_boxes (+ _filter_boxes), row by row. Rows are
+    # compacted into out[:nkeep]; out may be deltas itself. Arithmetic is in
+    # coord_t, in the same order as the NumPy functions, so results match.
+    cdef Py_ssize_t N = deltas.shape[0]
+    cdef Py_ssize_t C = deltas.shape[1] // 4
+    cdef Py_ssize_t i, c, nkeep = 0
+    cdef coord_t one = 1, half = 0.5
+    cdef coord_t w, h, ctr_x, ctr_y, pred_ctr_x, pred_ctr_y, pred_w, pred_h
+    cdef coord_t x1, y1, x2, y2
+    for i in range(N):
+        x1 = <coord_t>boxes[i, 0]
+        y1 = <coord_t>boxes[i, 1]
+        w = <coord_t>boxes[i, 2] - x1 + one
+        h = <coord_t>boxes[i, 3] - y1 + one
+        ctr_x = x1 + half * w
+        ctr_y = y1 + half * h
+        for c in range(C):
+            pred_ctr_x = deltas[i, 4 * c] * w + ctr_x
+            pred_ctr_y = deltas[i, 4 * c + 1] * h + ctr_y
+            if coord_t is np.float32_t:
+                pred_w = expf(deltas[i, 4 * c + 2]) * w
+                pred_h = expf(deltas[i, 4 * c + 3]) * h
+            else:
+                pred_w = exp(deltas[i, 4 * c + 2]) * w
+                pred_h = exp(deltas[i, 4 * c + 3]) * h
+            x1 = _clip(pred_ctr_x - half * pred_w, width - one)
+            y1 = _clip(pred_ctr_y - half * pred_h, height - one)
+            x2 = _clip(pred_ctr_x + half * pred_w, width - one)
+            y2 = _clip(pred_ctr_y + half * pred_h, height - one)
+            out[nkeep, 4 * c] = x1
+            out[nkeep, 4 * c + 1] = y1
+            out[nkeep, 4 * c + 2] = x2
+            out[nkeep, 4 * c + 3] = y2
+        if filter_small:
+            if x2 - x1 + one < min_size or y2 - y1 + one < min_size:
+                continue
+            keep[nkeep] = i
+        nkeep += 1
+    return nkeep
+
+def _decode_out(deltas, out):
+    if out is None:
+        return np.empty(deltas.shape, dtype=deltas.dtype)
+    assert out.shape == deltas.shape and out.dtype == deltas.dtype
+    return out
+
+def bbox_transform_inv_clip(box_t[:, :] boxes, coord_t[:, :] deltas,
+                            im_shape, out=None):
+    """
+    Parameters
+    ----------
+    boxes: (N, 4) ndarray of float32 or float64
+    deltas: (N, 4 * C) ndarray of float32 or float64
+    im_shape: (height, width, ...) to clip to
+    out: (N, 4 * C) contiguous ndarray of the type of deltas to decode
+        into, may be deltas itself; allocated if None
+    Returns
+    -------
+    pred_boxes: (N, 4 * C) clip_boxes(bbox_transform_inv(boxes, deltas),
+        im_shape) in one pass
+    """
+    assert boxes.shape[0] == deltas.shape[0]
+    out = _decode_out(deltas.base, out)
+    cdef coord_t[:, ::1] out_view = out
+    cdef np.intp_t[::1] keep_view = None
+    _decode_clip(boxes, deltas, <coord_t>im_shape[0], <coord_t>im_shape[1],
+                 0, False, out_view, keep_view)
+    return out
+
+def bbox_transform_inv_clip_filter(box_t[:, :] boxes, coord_t[:, :] deltas,
+                                   im_shape, min_size, out=None, keep=None):
+    """
+    Parameters
+    ----------
+    boxes: (N, 4) ndarray of float32 or float64
+    deltas: (N, 4) ndarray of float32 or float64
+    im_shape: (height, width, ...) to clip to
+    min_size: drop boxes with either side smaller than this
+    out: (N, 4) contiguous ndarray of the type of deltas, or None
+    keep: (N,) ndarray of intp, or None
+    Returns
+    -------
+    pred_boxes: (M, 4) decoded, clipped boxes with both sides >= min_size,
+        the first M rows of out
+    keep: (M,) their indices, the first M entries of keep
+    """
+    assert boxes.shape[0] == deltas.shape[0] and deltas.shape[1] == 4
+    out = _decode_out(deltas.base, out)
+    if keep is None:
+        keep = np.empty(deltas.shape[0], dtype=np.intp)
+    cdef coord_t[:, ::1] out_view = out
+    cdef np.intp_t[::1] keep_view = keep
+    cdef Py_ssize_t nkeep = _decode_clip(
+        boxes, deltas, <coord_t>im_shape[0], <coord_t>im_shape[1],
+        <coord_t>min_size, True, out_view, keep_view)
+    return out[:nkeep], keep[:nkeep]
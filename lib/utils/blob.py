@@ -10,13 +10,23 @@
 import numpy as np
 import cv2
 
-def im_list_to_blob(ims):
+def im_list_to_blob(ims, out=None):
     """Convert a list of images into a network input.
 
     Assumes images are already prepared (means subtracted, BGR order, ...).
+    If out (a flat float32 array) is large enough, the blob is written into
+    its first elements as a contiguous N x 3 x H x W array.
     """
     max_shape = np.array([im.shape for im in ims]).max(axis=0)
     num_images = len(ims)
+    shape = (num_images, 3, max_shape[0], max_shape[1])
+    if out is not None and out.size >= np.prod(shape):
+        blob = out[:np.prod(shape)].reshape(shape)
+        blob.fill(0)
+        for i in xrange(num_images):
+            im = ims[i]
+            blob[i, :, 0:im.shape[0], 0:im.shape[1]] = im.transpose(2, 0, 1)
+        return blob
     blob = np.zeros((num_images, max_shape[0], max_shape[1], 3),
                     dtype=np.float32)
     for i in xrange(num_images):
@@ -28,17 +38,22 @@ def im_list_to_blob(ims):
     blob = blob.transpose(channel_swap)
     return blob
 
-def prep_im_for_blob(im, pixel_means, target_size, max_size):
-    """Mean subtract and scale an image for use in a blob."""
-    im = im.astype(np.float32, copy=False)
-    im -= pixel_means
-    im_shape = im.shape
+def get_im_scale(im_shape, target_size, max_size):
+    """Scale bringing the short side of an image to target_size, or its
+    long side to max_size if that is smaller."""
     im_size_min = np.min(im_shape[0:2])
     im_size_max = np.max(im_shape[0:2])
     im_scale = float(target_size) / float(im_size_min)
     # Prevent the biggest axis from being more than MAX_SIZE
     if np.round(im_scale * im_size_max) > max_size:
         im_scale = float(max_size) / float(im_size_max)
+    return im_scale
+
+def prep_im_for_blob(im, pixel_means, target_size, max_size):
+    """Mean subtract and scale an image for use in a blob."""
+    im = im.astype(np.float32, copy=False)
+    im -= pixel_means
+    im_scale = get_im_scale(im.shape, target_size, max_size)
     im = cv2.resize(im, None, None, fx=im_scale, fy=im_scale,
                     interpolation=cv2.INTER_LINEAR)
 
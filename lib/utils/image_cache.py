@@ -0,0 +1,167 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""A cache of decoded images, shared by the training and test loaders.
+
+Entries are uint8 BGR images keyed on (path, target_size, max_size): the
+image of path resized for target_size / max_size as in prep_im_for_blob, or
+the image as decoded for target_size None. Flipped images are views of the
+unflipped entry, so USE_FLIPPED does not decode an image twice.
+
+There are two tiers, both off by default:
+  - memory: an LRU of decoded images of cfg.IMAGE_CACHE_BYTES bytes per
+    process; every prefetch worker has its own, so training with
+    TRAIN.USE_PREFETCH can hold TRAIN.PREFETCH_WORKERS times that
+  - disk: one .npy file per entry in cfg.IMAGE_CACHE_DIR, memory-mapped on
+    a hit and shared by all processes and runs; disk hits are left to the
+    page cache and not added to the memory LRU
+
+Cached images are read-only. The hit, miss and eviction counters live in
+shared memory, so the training process sees those of the prefetch workers.
+"""
+
+from fast_rcnn.config import cfg
+from utils.blob import get_im_scale, prep_im_for_blob
+from collections import OrderedDict
+from multiprocessing import Array
+import numpy as np
+import cv2
+import hashlib
+import os
+
+COUNTERS = ('hits', 'disk_hits', 'misses', 'evictions')
+
+class ImageCache(object):
+    """Decoded images in a memory LRU and an optional directory of .npy
+    files."""
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._counts = Array('l', len(COUNTERS))
+
+    def enabled(self):
+        return cfg.IMAGE_CACHE_BYTES > 0 or bool(cfg.IMAGE_CACHE_DIR)
+
+    def imread(self, path, target_size=None, max_size=None):
+        """The uint8 BGR image of path, resized for target_size and max_size
+        if target_size is given, and its scale (1 if not)."""
+        key = (path, target_size, max_size)
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._count('hits')
+            self._entries[key] = entry
+            return entry
+        entry = self._disk_get(key)
+        if entry is not None:
+            # memory-mapped, the page cache holds it rather than the LRU
+            self._count('disk_hits')
+            return entry
+        self._count('misses')
+        entry = self._build(key)
+        if cfg.IMAGE_CACHE_BYTES > 0:
+            self._entries[key] = entry
+            self._bytes += entry[0].nbytes
+            while self._bytes > cfg.IMAGE_CACHE_BYTES:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self._count('evictions')
+        return entry
+
+    def stats(self):
+        """Counter name to value, see COUNTERS."""
+        return dict(zip(COUNTERS, self._counts[:]))
+
+    def summary(self):
+        stats = self.stats()
+        lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+        return 'image cache: {} lookups, {} hits, {} disk hits, {} misses, ' \
+               '{} evictions'.format(lookups, stats['hits'],
+                                     stats['disk_hits'], stats['misses'],
+                                     stats['evictions'])
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+        self._counts[:] = [0] * len(COUNTERS)
+
+    def _count(self, name):
+        with self._counts.get_lock():
+            self._counts[COUNTERS.index(name)] += 1
+
+    def _build(self, key):
+        path, target_size, max_size = key
+        im = cv2.imread(path)
+        assert im is not None, 'Cannot read image {}'.format(path)
+        im_scale = 1.
+        if target_size is not None:
+            im_scale = get_im_scale(im.shape, target_size, max_size)
+            im = cv2.resize(im, None, None, fx=im_scale, fy=im_scale,
+                            interpolation=cv2.INTER_LINEAR)
+        self._disk_put(key, im, im_scale)
+        im.flags.writeable = False
+        return im, im_scale
+
+    def _disk_path(self, key):
+        name = hashlib.sha1(repr(key)).hexdigest()
+        return os.path.join(cfg.IMAGE_CACHE_DIR, name)
+
+    def _disk_get(self, key):
+        if not cfg.IMAGE_CACHE_DIR:
+            return None
+        path = self._disk_path(key)
+        if not os.path.exists(path + '.npy'):
+            return None
+        with open(path + '.scale') as f:
+            im_scale = float(f.read())
+        return np.load(path + '.npy', mmap_mode='r'), im_scale
+
+    def _disk_put(self, key, im, im_scale):
+        if not cfg.IMAGE_CACHE_DIR:
+            return
+        if not os.path.exists(cfg.IMAGE_CACHE_DIR):
+            try:
+                os.makedirs(cfg.IMAGE_CACHE_DIR)
+            except OSError:
+                pass  # made by another process in the meantime
+        path = self._disk_path(key)
+        # write and rename, other processes may be reading the same entry;
+        # the .npy file goes last as it marks the entry complete
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(repr(im_scale))
+        os.rename(tmp_path, path + '.scale')
+        with open(tmp_path, 'wb') as f:
+            np.save(f, im)
+        os.rename(tmp_path, path + '.npy')
+
+image_cache = ImageCache()
+
+def load_im_for_blob(path, flipped, target_size, max_size):
+    """The image of path, flipped if asked, mean subtracted and scaled as by
+    prep_im_for_blob, and its scale; through image_cache if it is enabled.
+
+    Cached images are resized before they are flipped and mean subtracted,
+    and rounded to uint8 after resizing, so they can differ from those of
+    prep_im_for_blob by rounding.
+    """
+    if not image_cache.enabled():
+        im = cv2.imread(path)
+        if flipped:
+            im = im[:, ::-1, :]
+        return prep_im_for_blob(im, cfg.PIXEL_MEANS, target_size, max_size)
+    im, im_scale = image_cache.imread(path, target_size, max_size)
+    if flipped:
+        im = im[:, ::-1, :]
+    im = im.astype(np.float32)
+    im -= cfg.PIXEL_MEANS
+    return im, im_scale
+
+def imread(path):
+    """The decoded image of path, through image_cache if it is enabled."""
+    if not image_cache.enabled():
+        return cv2.imread(path)
+    return image_cache.imread(path)[0]
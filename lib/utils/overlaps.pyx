@@ -0,0 +1,204 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""Box overlaps (IoU), parallel over boxes with OpenMP.
+
+Both functions take float32 or float64 boxes and compute in that type. The
+query boxes are sorted by x1 once, so the scan of a box's row stops at the
+first query box starting to the right of it. bbox_overlaps_max returns only
+the row and column maxima, which is all most callers use, without building
+the N x K matrix.
+
+num_threads defaults to the OpenMP maximum. Pass 1 in processes that may
+run after a fork from a process that already ran these kernels (the
+prefetch workers): GNU OpenMP's thread pool does not survive fork, and a
+child starting a parallel team blocks forever.
+"""
+
+cimport cython
+from cython.parallel cimport prange, threadid
+cimport openmp
+import numpy as np
+cimport numpy as np
+
+ctypedef fused coord_t:
+    np.float32_t
+    np.float64_t
+
+cdef inline coord_t _max(coord_t a, coord_t b) nogil:
+    return a if a >= b else b
+
+cdef inline coord_t _min(coord_t a, coord_t b) nogil:
+    return a if a <= b else b
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline coord_t _overlap(coord_t[:, ::1] boxes, Py_ssize_t n,
+                             coord_t area, coord_t[:, ::1] query,
+                             Py_ssize_t s, coord_t[::1] query_areas) nogil:
+    # IoU of boxes[n] and query[s], 0 if they do not intersect
+    cdef coord_t iw, ih, inter
+    iw = _min(boxes[n, 2], query[s, 2]) - _max(boxes[n, 0], query[s, 0]) + 1
+    if iw <= 0:
+        return 0
+    ih = _min(boxes[n, 3], query[s, 3]) - _max(boxes[n, 1], query[s, 1]) + 1
+    if ih <= 0:
+        return 0
+    inter = iw * ih
+    return inter / (area + query_areas[s] - inter)
+
+def _num_threads(num_threads):
+    if num_threads is None:
+        return openmp.omp_get_max_threads()
+    assert num_threads >= 1, 'num_threads must be positive'
+    return num_threads
+
+def _sorted_query(query_boxes, dtype):
+    # query boxes sorted by x1, their areas and original indices
+    order = np.argsort(query_boxes[:, 0], kind='mergesort')
+    query = np.ascontiguousarray(query_boxes[order, :4], dtype=dtype)
+    areas = (query[:, 2] - query[:, 0] + 1) * (query[:, 3] - query[:, 1] + 1)
+    return query, areas, order.astype(np.intp)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def bbox_overlaps(coord_t[:, ::1] boxes, query_boxes, num_threads=None):
+    """
+    Parameters
+    ----------
+    boxes: (N, 4) ndarray of float32 or float64
+    query_boxes: (K, 4) ndarray of float
+    num_threads: OpenMP threads, None for the OpenMP maximum
+    Returns
+    -------
+    overlaps: (N, K) ndarray of overlap between boxes and query_boxes, in
+        the type of boxes
+    """
+    dtype = np.float32 if coord_t is np.float32_t else np.float64
+    cdef Py_ssize_t N = boxes.shape[0]
+    cdef Py_ssize_t K = query_boxes.shape[0]
+    cdef int nthreads = _num_threads(num_threads)
+    overlaps = np.zeros((N, K), dtype=dtype)
+    if N == 0 or K == 0:
+        return overlaps
+    query_arr, areas_arr, order_arr = _sorted_query(query_boxes, dtype)
+    cdef coord_t[:, ::1] query = query_arr
+    cdef coord_t[::1] query_areas = areas_arr
+    cdef np.intp_t[::1] order = order_arr
+    cdef coord_t[:, ::1] out = overlaps
+    cdef Py_ssize_t n, s
+    cdef coord_t area, right
+
+    for n in prange(N, nogil=True, schedule='static', num_threads=nthreads):
+        area = (boxes[n, 2] - boxes[n, 0] + 1) * (boxes[n, 3] - boxes[n, 1] + 1)
+        right = boxes[n, 2] + 1
+        for s in range(K):
+            if query[s, 0] >= right:
+                break
+            out[n, order[s]] = _overlap(boxes, n, area, query, s, query_areas)
+    return overlaps
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def bbox_overlaps_max(coord_t[:, ::1] boxes, query_boxes, return_ties=False,
+                      num_threads=None):
+    """Row and column maxima of bbox_overlaps(boxes, query_boxes).
+
+    Ties go to the lowest index, as with ndarray.argmax.
+
+    Arguments:
+        boxes (ndarray): N x 4, float32 or float64
+        query_boxes (ndarray): K x 4
+        return_ties (bool): also return the boxes that reach the maximum
+            of some query box
+        num_threads (int): OpenMP threads, None for the OpenMP maximum
+
+    Returns:
+        argmax (ndarray): N, best query box of every box
+        max (ndarray): N, its overlap
+        query_argmax (ndarray): K, best box of every query box
+        query_max (ndarray): K, its overlap
+        tie_inds (ndarray): sorted unique rows n with
+            overlaps[n, k] == query_max[k] for some k, i.e. the rows of
+            np.where(overlaps == overlaps.max(axis=0)); only if return_ties
+    """
+    dtype = np.float32 if coord_t is np.float32_t else np.float64
+    cdef Py_ssize_t N = boxes.shape[0]
+    cdef Py_ssize_t K = query_boxes.shape[0]
+    cdef int nthreads = _num_threads(num_threads)
+    row_arg_arr = np.zeros(N, dtype=np.intp)
+    row_max_arr = np.zeros(N, dtype=dtype)
+    # one column buffer per thread, reduced afterwards
+    thread_arg_arr = np.zeros((nthreads, K), dtype=np.intp)
+    thread_max_arr = np.zeros((nthreads, K), dtype=dtype)
+    query_arr, areas_arr, order_arr = _sorted_query(query_boxes, dtype)
+
+    cdef coord_t[:, ::1] query = query_arr
+    cdef coord_t[::1] query_areas = areas_arr
+    cdef np.intp_t[::1] order = order_arr
+    cdef np.intp_t[::1] row_arg = row_arg_arr
+    cdef coord_t[::1] row_max = row_max_arr
+    cdef np.intp_t[:, ::1] thread_arg = thread_arg_arr
+    cdef coord_t[:, ::1] thread_max = thread_max_arr
+    cdef Py_ssize_t n, s, k, best
+    cdef int t
+    cdef coord_t area, right, ovr, best_ovr
+
+    for n in prange(N, nogil=True, schedule='static', num_threads=nthreads):
+        t = threadid()
+        area = (boxes[n, 2] - boxes[n, 0] + 1) * (boxes[n, 3] - boxes[n, 1] + 1)
+        right = boxes[n, 2] + 1
+        best = 0
+        best_ovr = 0
+        for s in range(K):
+            if query[s, 0] >= right:
+                break
+            ovr = _overlap(boxes, n, area, query, s, query_areas)
+            if ovr <= 0:
+                continue
+            k = order[s]
+            if ovr > best_ovr or (ovr == best_ovr and k < best):
+                best_ovr = ovr
+                best = k
+            if ovr > thread_max[t, k] or \
+                    (ovr == thread_max[t, k] and n < thread_arg[t, k]):
+                thread_max[t, k] = ovr
+                thread_arg[t, k] = n
+        row_arg[n] = best
+        row_max[n] = best_ovr
+
+    # threads with no overlap for a column keep (0, 0), which also wins
+    # ties at 0 as the dense argmax does
+    query_max_arr = thread_max_arr.max(axis=0)
+    at_max = thread_max_arr == query_max_arr
+    query_arg_arr = np.where(at_max, thread_arg_arr, N).min(axis=0)
+    query_arg_arr[query_max_arr == 0] = 0
+    if not return_ties:
+        return row_arg_arr, row_max_arr, query_arg_arr, query_max_arr
+    if K > 0 and (query_max_arr == 0).any():
+        # a query box overlapping nothing ties with every box at 0
+        return row_arg_arr, row_max_arr, query_arg_arr, query_max_arr, \
+            np.arange(N)
+
+    cdef coord_t[::1] query_max = query_max_arr
+    tie_arr = np.zeros(N, dtype=np.uint8)
+    cdef np.uint8_t[::1] tie = tie_arr
+    for n in prange(N, nogil=True, schedule='static', num_threads=nthreads):
+        area = (boxes[n, 2] - boxes[n, 0] + 1) * (boxes[n, 3] - boxes[n, 1] + 1)
+        right = boxes[n, 2] + 1
+        for s in range(K):
+            if query[s, 0] >= right:
+                break
+            if _overlap(boxes, n, area, query, s, query_areas) == \
+                    query_max[order[s]]:
+                tie[n] = 1
+                break
+    return row_arg_arr, row_max_arr, query_arg_arr, query_max_arr, \
+        np.where(tie_arr)[0]
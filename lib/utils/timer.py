@@ -30,3 +30,27 @@ class Timer(object):
             return self.average_time
         else:
             return self.diff
+
+class StageTimers(object):
+    """Average time per named stage, fed with (stage, seconds) calls.
+
+    An instance can be set as a layer's stage_hook (see
+    rpn.proposal_layer.ProposalLayer) to collect its per-stage timings.
+    """
+    def __init__(self):
+        self.total_time = {}
+        self.calls = {}
+
+    def __call__(self, stage, seconds):
+        self.total_time[stage] = self.total_time.get(stage, 0.) + seconds
+        self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def average_time(self, stage):
+        return self.total_time[stage] / self.calls[stage]
+
+    def summary(self, stages=None):
+        """'stage: x.xxx ms' for every stage, in the given order."""
+        if stages is None:
+            stages = sorted(self.total_time.keys())
+        return ', '.join('{}: {:.3f} ms'.format(
+            s, self.average_time(s) * 1000) for s in stages if s in self.calls)
@@ -0,0 +1,76 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""Top blob helpers for the Python layers.
+
+Layers write their outputs straight into top[i].data (or into persistent
+scratch buffers) instead of building a fresh array every forward and copying
+it over. New memory the helpers see is counted in allocation_counter:
+reshapes that change a blob's shape (an upper bound, caffe only reallocates
+when a blob grows), scratch buffers that have to grow, and temporaries handed
+to copy_to_top.
+"""
+
+import numpy as np
+
+class AllocationCounter(object):
+    """Bytes allocated for top blobs, averaged over tic/toc intervals."""
+    def __init__(self):
+        self.total_bytes = 0
+        self.calls = 0
+        self.start_bytes = 0
+        self.diff = 0
+        self.average_bytes = 0.
+
+    def add(self, nbytes):
+        self.total_bytes += int(nbytes)
+
+    def tic(self):
+        self.start_bytes = self.total_bytes
+
+    def toc(self, average=True):
+        self.diff = self.total_bytes - self.start_bytes
+        self.calls += 1
+        self.average_bytes = \
+            (self.average_bytes * (self.calls - 1) + self.diff) / self.calls
+        if average:
+            return self.average_bytes
+        else:
+            return self.diff
+
+allocation_counter = AllocationCounter()
+
+def top_data(blob, shape):
+    """blob.data with the given shape; the blob is reshaped only if needed."""
+    shape = tuple(int(d) for d in shape)
+    if blob.data.shape != shape:
+        blob.reshape(*shape)
+        allocation_counter.add(blob.data.nbytes)
+    return blob.data
+
+def copy_to_top(blob, data):
+    """Copy an already computed array into blob, counting it as a temporary."""
+    top_data(blob, data.shape)[...] = data
+    allocation_counter.add(data.nbytes)
+
+class ScratchBuffers(object):
+    """Named arrays kept across forwards; they are reallocated only to grow."""
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, name, shape, dtype=np.float32, fill=None):
+        """A (possibly stale) array of the given shape, filled if asked."""
+        size = int(np.prod(shape))
+        buf = self._buffers.get(name)
+        if buf is None or buf.size < size or buf.dtype != dtype:
+            buf = np.empty(max(size, 1), dtype=dtype)
+            self._buffers[name] = buf
+            allocation_counter.add(buf.nbytes)
+        out = buf[:size].reshape(shape)
+        if fill is not None:
+            out.fill(fill)
+        return out
@@ -1,57 +1,131 @@
-import numpy as np 
-import scipy.io as sio
+import numpy as np
+import argparse
 import sys
+sys.path.insert(0, 'lib')
 sys.path.append('caffe/python')
-import caffe
-proto = 'test_region_pooling.prototxt'
-rfcn_feat = np.random.rand(1, 9 * 4, 10 , 10 )
-seed_point = np.zeros((1,2))
-seed_point[0,0] = 10
-seed_point[0,1] = 10
-sampled_id = sio.loadmat('sampled_id_1.mat')['sampled_id']
-sampled_id = np.floor(sampled_id / 4.0)
-rfcn_region_weights = np.ones((1, 576, 9 )) 
-
-net = caffe.Net(proto, caffe.TRAIN)
-caffe.set_device(0)
-caffe.set_mode_gpu()
-error = 0 
-for i1 in xrange( 9* 4) :
-	for i2 in xrange(10) :
-		for i3 in xrange(10) :
-			rfcn_feat = np.random.rand(1, 9 * 4, 10, 10)
-			net.blobs['rfcn_features'].data[...] = rfcn_feat
-			net.blobs['seed_points'].data[...] = seed_point
-			net.blobs['sampled_id'].data[...] = sampled_id
-			net.blobs['rfcn_region_weights'].data[...] = rfcn_region_weights
-			out = net.forward()
-			weighted_box_cls_1 = net.blobs['weighted_box_cls_1'].data
-			rfcn_feat_new = rfcn_feat
-			rfcn_feat_new[0,i1,i2,i3] += 0.0001
-			net.blobs['rfcn_features'].data[...] = rfcn_feat
-			net.blobs['seed_points'].data[...] = seed_point
-			net.blobs['sampled_id'].data[...] = sampled_id
-			net.blobs['rfcn_region_weights'].data[...] = rfcn_region_weights
-			out = net.forward()
-			weighted_box_cls_1_new = net.blobs['weighted_box_cls_1'].data
-			for o1 in xrange(64):
-				for o2 in xrange(9):
-					for o3 in xrange(4):
-						dy = weighted_box_cls_1_new[0,o1,o2,o3] - weighted_box_cls_1[0,o1,o2,o3]
-						dx = 0.0001
-						net.blobs['weighted_box_cls_1'].diff[...] = np.zeros((1,64,9,4))
-						net.blobs['weighted_box_cls_1'].diff[0,o1,o2,o3] = 1.0
-						d_est = dy / dx
-						out = net.backward()
-						d_com = net.blobs['rfcn_features'].diff[0,i1,i2,i3] 
-						error += np.abs(d_com - d_est)
-
-	print 'a channel'
-	print error
+from roi_data_layer.region_pooling import pooling_matrix, \
+    region_pooling_forward, region_pooling_backward
+from roi_data_layer.region_pooling_layer import RegionPoolingLayer
 
+# Batched check of RegionPooling. The NumPy layer is compared with a dense
+# reference of the CUDA kernel, and its backward with central differences
+# of that reference along random directions: for top diffs U and feature
+# directions V, U . (f(x + eps V) - f(x - eps V)) / 2 eps == backward(U) . V.
+# RegionPoolingLayer is run on stand-in blobs and checked against the same
+# values, and with --gpu so is the caffe RegionPooling layer. Any error above
+# its tolerance exits with status 1.
 
+parser = argparse.ArgumentParser(description='Check RegionPooling gradients')
+parser.add_argument('--gpu', dest='gpu_id', default=None, type=int,
+                    help='also check the caffe layer on this GPU')
+parser.add_argument('--seeds', dest='num_seeds', default=4, type=int)
+parser.add_argument('--dirs', dest='num_dirs', default=16, type=int)
+args = parser.parse_args()
 
+P, F, H, W = 9, 4, 10, 10        # num_rfcn_regions, num_features, height, width
+R, S = 64, 9                     # num_regions, num_samples
+K = R * S
+M = args.num_seeds
+eps = 1e-2
+FORWARD_TOL = 1e-5               # max abs error
+BACKWARD_TOL = 1e-4              # max relative error
 
+def check(name, error, tol):
+    print '{}: {:.3g}'.format(name, error)
+    if not error <= tol:
+        print 'FAILED: {} above {:.3g}'.format(name, tol)
+        sys.exit(1)
 
+class Blob(object):
+    """Stand-in for a caffe blob: data and diff of the same shape."""
+    def __init__(self, data=None):
+        self.data = data
+        if data is not None:
+            self.diff = np.zeros_like(data)
 
+    def reshape(self, *shape):
+        self.data = np.zeros(shape, dtype=np.float32)
+        self.diff = np.zeros(shape, dtype=np.float32)
 
+np.random.seed(3)
+seed_point = np.hstack((np.random.randint(0, W, (M, 1)),
+                        np.random.randint(0, H, (M, 1)))).astype(np.float32)
+sampled_id = np.random.randint(-6, 7, (M, K, 2)).astype(np.float32)
+rfcn_region_weights = np.random.rand(M, K, P).astype(np.float32)
+x = seed_point[:, 0:1] + sampled_id[:, :, 0]
+y = seed_point[:, 1:2] + sampled_id[:, :, 1]
+inside = (x >= 0) & (x < W) & (y >= 0) & (y < H)
+# the CUDA kernel reads outside samples unchecked; give them no weight
+rfcn_region_weights[~inside] = 0
+
+def reference_forward(rfcn_feat):
+    feat = rfcn_feat[0].reshape((P, F, H, W))
+    xi = np.where(inside, x, 0).astype(np.int)
+    yi = np.where(inside, y, 0).astype(np.int)
+    gathered = feat[:, :, yi, xi]                    # P x F x M x K
+    return np.einsum('pfmk,mkp->mkf', gathered, rfcn_region_weights) / P
+
+rfcn_feat = np.random.rand(1, P * F, H, W).astype(np.float32)
+mat = pooling_matrix(seed_point, sampled_id, rfcn_region_weights, H, W)
+out = region_pooling_forward(rfcn_feat, mat, P)
+ref = reference_forward(rfcn_feat.astype(np.float64))
+check('forward max abs error', np.abs(out - ref.reshape(-1, F)).max(),
+      FORWARD_TOL)
+
+V = np.random.randn(args.num_dirs, 1, P * F, H, W)
+U = np.random.randn(args.num_dirs, M, R, S, F)
+numeric = np.array([(reference_forward(rfcn_feat + eps * v) -
+                     reference_forward(rfcn_feat - eps * v)).ravel() / (2 * eps)
+                    for v in V])
+grads = np.array([region_pooling_backward(u, mat, rfcn_feat.shape, P).ravel()
+                  for u in U])
+d_est = U.reshape((args.num_dirs, -1)).dot(numeric.transpose())
+d_com = grads.dot(V.reshape((args.num_dirs, -1)).transpose())
+check('backward max relative error',
+      np.abs(d_com - d_est).max() / np.abs(d_est).max(), BACKWARD_TOL)
+
+layer = RegionPoolingLayer.__new__(RegionPoolingLayer)
+layer.param_str = str({'num_features': F, 'num_samples': S,
+                       'num_rfcn_regions': P, 'num_regions': R})
+bottom = [Blob(rfcn_feat.copy()), Blob(seed_point), Blob(sampled_id),
+          Blob(rfcn_region_weights.reshape((M, R, S, P)))]
+top = [Blob()]
+layer.setup(bottom, top)
+layer.forward(bottom, top)
+check('layer forward max abs error',
+      np.abs(top[0].data.ravel() - ref.ravel()).max(), FORWARD_TOL)
+error = 0
+for u, g in zip(U, grads):
+    top[0].diff[...] = u
+    bottom[0].diff[...] = np.nan
+    layer.backward(top, [True, False, False, False], bottom)
+    error = max(error, np.abs(bottom[0].diff.ravel() - g).max() /
+                np.abs(g).max())
+check('layer backward max relative error', error, BACKWARD_TOL)
+
+if args.gpu_id is not None:
+    import caffe
+    caffe.set_device(args.gpu_id)
+    caffe.set_mode_gpu()
+    net = caffe.Net('test_region_pooling.prototxt', caffe.TRAIN)
+    net.blobs['seed_points'].reshape(M, 2)
+    net.blobs['sampled_id'].reshape(M, K, 2)
+    net.blobs['rfcn_region_weights'].reshape(M, K, P)
+    net.reshape()
+    net.blobs['rfcn_features'].data[...] = rfcn_feat
+    net.blobs['seed_points'].data[...] = seed_point
+    net.blobs['sampled_id'].data[...] = sampled_id
+    net.blobs['rfcn_region_weights'].data[...] = rfcn_region_weights
+    net.forward()
+    weighted_box_cls_1 = net.blobs['weighted_box_cls_1'].data
+    check('caffe forward max abs error',
+          np.abs(weighted_box_cls_1.ravel() - out.ravel()).max(), FORWARD_TOL)
+    error = 0
+    for u, g in zip(U, grads):
+        net.blobs['weighted_box_cls_1'].diff[...] = u
+        net.backward(start='weighted_box_cls_1')
+        error = max(error, np.abs(net.blobs['rfcn_features'].diff.ravel() - g).max() /
+                    np.abs(g).max())
+    check('caffe backward max relative error', error, BACKWARD_TOL)
+
+print 'RegionPooling forward and backward within tolerance'
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""Benchmark box decoding before and after the fused kernel.
+
+The NumPy path (bbox_transform_inv, clip_boxes, then the min-size filter
+ProposalLayer used to run) is compared with cython_bbox's
+bbox_transform_inv_clip(_filter), for ProposalLayer's anchors and for
+im_detect's RoIs x classes. Per-call time and the number of NumPy array
+buffers allocated per call are reported; outputs must match exactly."""
+
+import _init_paths
+from fast_rcnn.config import cfg
+from fast_rcnn.bbox_transform import bbox_transform_inv, clip_boxes
+from rpn.generate_anchors import generate_anchors
+from utils.cython_bbox import bbox_transform_inv_clip, \
+    bbox_transform_inv_clip_filter
+from utils.timer import Timer
+import argparse
+import ctypes
+import numpy as np
+import sys
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark box decoding')
+    parser.add_argument('--height', dest='height', default=38, type=int)
+    parser.add_argument('--width', dest='width', default=63, type=int)
+    parser.add_argument('--rois', dest='num_rois', default=300, type=int)
+    parser.add_argument('--classes', dest='num_classes', default=21,
+                        type=int)
+    parser.add_argument('--iters', dest='iters', default=20, type=int)
+
+    args = parser.parse_args()
+    return args
+
+class NumpyAllocations(object):
+    """Counts NumPy data buffer allocations through PyDataMem_SetEventHook."""
+
+    _HOOK = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_void_p,
+                             ctypes.c_size_t, ctypes.c_void_p)
+
+    def __init__(self):
+        api = np.core.multiarray._ARRAY_API
+        get_pointer = ctypes.pythonapi.PyCObject_AsVoidPtr
+        get_pointer.restype = ctypes.c_void_p
+        get_pointer.argtypes = [ctypes.py_object]
+        table = ctypes.cast(get_pointer(api), ctypes.POINTER(ctypes.c_void_p))
+        # PyDataMem_SetEventHook is entry 291 of the multiarray C API
+        self._set_hook = ctypes.CFUNCTYPE(
+            ctypes.c_void_p, self._HOOK, ctypes.c_void_p,
+            ctypes.POINTER(ctypes.c_void_p))(table[291])
+        self._hook = self._HOOK(self._event)
+        self.count = 0
+
+    def _event(self, inp, outp, size, user_data):
+        # malloc/calloc events have no input pointer
+        if not inp and outp:
+            self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        self._set_hook(self._hook, None, ctypes.byref(ctypes.c_void_p()))
+        return self
+
+    def __exit__(self, *exc):
+        self._set_hook(ctypes.cast(None, self._HOOK), None,
+                       ctypes.byref(ctypes.c_void_p()))
+
+def numpy_proposals(anchors, deltas, im_info, min_size):
+    proposals = clip_boxes(bbox_transform_inv(anchors, deltas), im_info[:2])
+    ws = proposals[:, 2] - proposals[:, 0] + 1
+    hs = proposals[:, 3] - proposals[:, 1] + 1
+    keep = np.where((ws >= min_size) & (hs >= min_size))[0]
+    return proposals[keep, :], keep
+
+def fused_proposals(anchors, deltas, im_info, min_size, out, keep):
+    return bbox_transform_inv_clip_filter(anchors, deltas, im_info[:2],
+                                          min_size, out=out, keep=keep)
+
+def numpy_detect(rois, deltas, im_shape):
+    return clip_boxes(bbox_transform_inv(rois, deltas), im_shape)
+
+def fused_detect(rois, deltas, im_shape):
+    return bbox_transform_inv_clip(rois, deltas, im_shape)
+
+def run(name, cases, iters):
+    allocs = NumpyAllocations()
+    results = []
+    for label, fn, fn_args in cases:
+        timer = Timer()
+        for it in xrange(iters):
+            with allocs:
+                timer.tic()
+                out = fn(*fn_args)
+                timer.toc()
+        results.append((label, timer.average_time * 1000, allocs.count, out))
+    ref = results[0][3]
+    for label, _, _, out in results[1:]:
+        if isinstance(ref, tuple):
+            same = all(np.array_equal(a, b) for a, b in zip(ref, out))
+        else:
+            same = np.array_equal(ref, out)
+        if not same:
+            print 'MISMATCH in {} ({})'.format(name, label)
+            sys.exit(1)
+    for label, ms, count, _ in results:
+        print '{:>14s} {:>8s} {:10.3f} {:8d}'.format(name, label, ms, count)
+
+if __name__ == '__main__':
+    args = parse_args()
+    np.random.seed(cfg.RNG_SEED)
+    print '{:>14s} {:>8s} {:>10s} {:>8s}'.format('case', 'path', 'ms/call',
+                                                 'allocs')
+
+    # ProposalLayer: all anchors of a feature map, one set of deltas each
+    feat_stride = 16
+    base = generate_anchors()
+    shift_x, shift_y = np.meshgrid(np.arange(args.width) * feat_stride,
+                                   np.arange(args.height) * feat_stride)
+    shifts = np.vstack((shift_x.ravel(), shift_y.ravel(),
+                        shift_x.ravel(), shift_y.ravel())).transpose()
+    anchors = (base[np.newaxis] + shifts[:, np.newaxis]).reshape((-1, 4))
+    deltas = (np.random.randn(anchors.shape[0], 4) * 0.2).astype(np.float32)
+    im_info = np.array([args.height * feat_stride, args.width * feat_stride,
+                        1.6], dtype=np.float32)
+    min_size = cfg.TEST.RPN_MIN_SIZE * im_info[2]
+    out = np.empty(deltas.shape, dtype=np.float32)
+    keep = np.empty(deltas.shape[0], dtype=np.intp)
+    run('proposals', [
+        ('numpy', numpy_proposals, (anchors, deltas, im_info, min_size)),
+        ('fused', fused_proposals,
+         (anchors, deltas, im_info, min_size, out, keep))], args.iters)
+
+    # im_detect: RoIs x (4 * classes) deltas
+    im_shape = (args.height * feat_stride, args.width * feat_stride, 3)
+    x1 = np.random.rand(args.num_rois) * im_shape[1] * 0.8
+    y1 = np.random.rand(args.num_rois) * im_shape[0] * 0.8
+    rois = np.vstack((x1, y1, x1 + np.random.rand(args.num_rois) * 200,
+                      y1 + np.random.rand(args.num_rois) * 200)) \
+        .transpose().astype(np.float32)
+    deltas = (np.random.randn(args.num_rois, 4 * args.num_classes) * 0.2) \
+        .astype(np.float32)
+    run('im_detect', [
+        ('numpy', numpy_detect, (rois, deltas, im_shape)),
+        ('fused', fused_detect, (rois, deltas, im_shape))], args.iters)
+    print 'fused outputs match the NumPy path'
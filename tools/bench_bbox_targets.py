@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""Benchmark the expansion of compact regression targets into the 4K
+layout: the per-RoI loop the data layers used to run against the scatter of
+expand_bbox_targets, class-aware and agnostic. Outputs must match."""
+
+import _init_paths
+from fast_rcnn.config import cfg
+from fast_rcnn.bbox_transform import expand_bbox_targets
+from utils.timer import Timer
+import argparse
+import numpy as np
+import sys
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark target expansion')
+    parser.add_argument('--rois', dest='num_rois',
+                        help='comma separated RoI counts',
+                        default='300,2000', type=str)
+    parser.add_argument('--classes', dest='num_classes', default=21,
+                        type=int)
+    parser.add_argument('--fg_fraction', dest='fg_fraction', default=0.25,
+                        type=float)
+    parser.add_argument('--iters', dest='iters', default=100, type=int)
+
+    args = parser.parse_args()
+    return args
+
+def loop_expand(bbox_target_data, num_reg_class, agnostic, inside_weights):
+    """One foreground RoI at a time."""
+    clss = bbox_target_data[:, 0]
+    bbox_targets = np.zeros((clss.size, 4 * num_reg_class), dtype=np.float32)
+    bbox_inside_weights = np.zeros(bbox_targets.shape, dtype=np.float32)
+    inds = np.where(clss > 0)[0]
+    for ind in inds:
+        cls = int(clss[ind])
+        start = 4 * (1 if agnostic else cls)
+        end = start + 4
+        bbox_targets[ind, start:end] = bbox_target_data[ind, 1:]
+        bbox_inside_weights[ind, start:end] = inside_weights
+    return bbox_targets, bbox_inside_weights
+
+if __name__ == '__main__':
+    args = parse_args()
+    np.random.seed(cfg.RNG_SEED)
+    weights = cfg.TRAIN.BBOX_INSIDE_WEIGHTS
+
+    print '{:>6s} {:>9s} {:>10s} {:>10s} {:>8s}'.format(
+        'rois', 'mode', 'loop (ms)', 'scatter', 'speedup')
+    for num_rois in [int(n) for n in args.num_rois.split(',')]:
+        for agnostic in (False, True):
+            num_reg_class = 2 if agnostic else args.num_classes
+            timers = {'loop': Timer(), 'scatter': Timer()}
+            for it in xrange(args.iters):
+                clss = np.random.randint(1, args.num_classes, num_rois)
+                clss[np.random.rand(num_rois) >= args.fg_fraction] = 0
+                data = np.hstack((clss[:, np.newaxis],
+                                  np.random.randn(num_rois, 4))) \
+                    .astype(np.float32)
+                timers['loop'].tic()
+                ref = loop_expand(data, num_reg_class, agnostic, weights)
+                timers['loop'].toc()
+                timers['scatter'].tic()
+                out = expand_bbox_targets(data, num_reg_class, agnostic,
+                                          weights)
+                timers['scatter'].toc()
+                if not all(np.array_equal(a, b) for a, b in zip(ref, out)):
+                    print 'MISMATCH at {} RoIs, agnostic {}'.format(
+                        num_rois, agnostic)
+                    sys.exit(1)
+            print '{:6d} {:>9s} {:10.3f} {:10.3f} {:7.1f}x'.format(
+                num_rois, 'agnostic' if agnostic else 'class',
+                timers['loop'].average_time * 1000,
+                timers['scatter'].average_time * 1000,
+                timers['loop'].average_time / timers['scatter'].average_time)
+    print 'scatter matches the loop'
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""Benchmark the batched box_prediction decoder against a per-seed loop on
+synthetic score maps, for agnostic and class-aware heads, and check that
+both return the same boxes. Then run im_detect_boxcls on a stand-in net
+with cfg.TEST.HAS_RPN off, which must forward the image alone."""
+
+import _init_paths
+from fast_rcnn.config import cfg
+from roi_data_layer.region_bucketizer import RegionBucketizer
+from roi_data_layer.box_prediction_layer import box_prediction
+from fast_rcnn.test import im_detect_boxcls
+from fast_rcnn.bbox_transform import clip_boxes
+from utils.timer import Timer
+import argparse
+import numpy as np
+import sys
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark box_prediction')
+    parser.add_argument('--thresh', dest='thresh',
+                        help='comma separated seed thresholds',
+                        default='0.9,0.7,0.5', type=str)
+    parser.add_argument('--top_k', dest='top_k',
+                        help='seed cap (0 keeps all)',
+                        default=0, type=int)
+    parser.add_argument('--iters', dest='iters',
+                        help='iterations per threshold',
+                        default=5, type=int)
+    parser.add_argument('--height', dest='height', default=38, type=int)
+    parser.add_argument('--width', dest='width', default=63, type=int)
+
+    args = parser.parse_args()
+    return args
+
+def _synthetic_maps(height, width, num_classes, num_classes_box, S):
+    # peaked foreground scores so every threshold keeps some seeds
+    scores = np.random.rand(1, num_classes, height, width) ** 4
+    scores[0, 0] = 0.05
+    cls_score = (scores / scores.sum(axis=1, keepdims=True) * 1.6) \
+        .astype(np.float32)
+    bbox_cls = np.random.rand(1, num_classes_box * S * S, height, width) \
+        .astype(np.float32)
+    bbox_reg = (np.random.rand(1, num_classes_box * S * 2, height, width) -
+                0.5).astype(np.float32)
+    return cls_score, bbox_cls, bbox_reg
+
+class Blob(object):
+    """The parts of a caffe blob im_detect_boxcls uses."""
+    def __init__(self, data=None):
+        self.data = data if data is not None else \
+            np.zeros((1,), dtype=np.float32)
+
+    def reshape(self, *shape):
+        self.data = np.zeros(shape, dtype=np.float32)
+
+class BoxclsNet(object):
+    """A box_cls_reg net whose forward outputs fixed maps."""
+    def __init__(self, maps):
+        self.blobs = {'data': Blob()}
+        for name, data in zip(cfg.TEST.BOXCLS_BLOBS, maps):
+            self.blobs[name] = Blob(data)
+
+    def forward(self, **kwargs):
+        assert sorted(kwargs.keys()) == ['data'], \
+            'forward got {}'.format(sorted(kwargs.keys()))
+        assert kwargs['data'].shape == self.blobs['data'].data.shape
+
+def loop_prediction(cls_score, bbox_cls, bbox_reg, bucketizer, thresh,
+                    top_k, spatial_scale):
+    """One seed at a time, as box_prediction used to decode."""
+    S = bucketizer.num_regions_one_side
+    half = S / 2
+    width = cls_score.shape[3]
+    fg_score = cls_score[0, 1:]
+    max_score = fg_score.max(axis=0).ravel()
+    seed_point_ind = np.where(max_score > thresh)[0]
+    seed_point_ind = seed_point_ind[
+        np.argsort(-max_score[seed_point_ind], kind='mergesort')]
+    if top_k > 0:
+        seed_point_ind = seed_point_ind[:top_k]
+    pred_boxes = np.zeros((len(seed_point_ind), 5))
+    pred_classes = np.zeros(len(seed_point_ind), dtype=np.int)
+    for i in xrange(len(seed_point_ind)):
+        ww = seed_point_ind[i] % width
+        hh = seed_point_ind[i] / width
+        seed_cls = np.argmax(fg_score[:, hh, ww]) + 1
+        c = 0 if bbox_cls.shape[1] == S * S else seed_cls - 1
+        seed_bbox_cls = bbox_cls[0, c * S * S:(c + 1) * S * S, hh, ww]
+        seed_bbox_reg = bbox_reg[0, c * S * 2:(c + 1) * S * 2, hh, ww]
+        seed_bbox_cls = seed_bbox_cls.reshape((S, S))
+        hori_pool = seed_bbox_cls.mean(axis=0)
+        vert_pool = seed_bbox_cls.mean(axis=1)
+        line_x1 = np.argmax(hori_pool[0:half])
+        line_x2 = np.argmax(hori_pool[half:])
+        line_y1 = np.argmax(vert_pool[0:half])
+        line_y2 = np.argmax(vert_pool[half:])
+        bound_x = bucketizer.bounds('x', seed_cls)
+        bound_y = bucketizer.bounds('y', seed_cls)
+        i_x1 = half - 1 - line_x1
+        i_y1 = half - 1 - line_y1
+        left = bound_x[i_x1 + 1] - (seed_bbox_reg[line_x1] + 0.5) * \
+            (bound_x[i_x1 + 1] - bound_x[i_x1])
+        right = bound_x[line_x2 + 1] - \
+            (seed_bbox_reg[half + line_x2] + 0.5) * \
+            (bound_x[line_x2 + 1] - bound_x[line_x2])
+        top = bound_y[i_y1 + 1] - (seed_bbox_reg[S + line_y1] + 0.5) * \
+            (bound_y[i_y1 + 1] - bound_y[i_y1])
+        bottom = bound_y[line_y2 + 1] - \
+            (seed_bbox_reg[S + half + line_y2] + 0.5) * \
+            (bound_y[line_y2 + 1] - bound_y[line_y2])
+        pred_boxes[i, 0] = max_score[seed_point_ind[i]]
+        pred_boxes[i, 1] = ww / spatial_scale - left
+        pred_boxes[i, 2] = hh / spatial_scale - top
+        pred_boxes[i, 3] = ww / spatial_scale + right
+        pred_boxes[i, 4] = hh / spatial_scale + bottom
+        pred_classes[i] = seed_cls
+    return pred_boxes, pred_classes
+
+if __name__ == '__main__':
+    args = parse_args()
+    np.random.seed(cfg.RNG_SEED)
+    spatial_scale = cfg.TRAIN.spatial_scale
+    num_classes = cfg.TRAIN.num_classes
+    S = int(np.sqrt(cfg.TRAIN.num_regions))
+    bucketizer = RegionBucketizer(
+        np.hstack((0, np.sort(np.random.rand(S / 2)) * 400)),
+        np.hstack((0, np.sort(np.random.rand(S / 2)) * 300)), S)
+
+    print '{:>7s} {:>6s} {:>8s} {:>12s} {:>12s} {:>8s}'.format(
+        'thresh', 'head', 'seeds', 'loop (ms)', 'batched (ms)', 'speedup')
+    for thresh in [float(t) for t in args.thresh.split(',')]:
+        for head, num_classes_box in (('agn', 1), ('cls', num_classes - 1)):
+            timers = {'loop': Timer(), 'batched': Timer()}
+            num_seeds = 0
+            for it in xrange(args.iters):
+                maps = _synthetic_maps(args.height, args.width, num_classes,
+                                       num_classes_box, S)
+                timers['loop'].tic()
+                ref = loop_prediction(*(maps + (bucketizer, thresh,
+                                                args.top_k, spatial_scale)))
+                timers['loop'].toc()
+                timers['batched'].tic()
+                out = box_prediction(*(maps + (bucketizer, thresh,
+                                               args.top_k, spatial_scale)))
+                timers['batched'].toc()
+                num_seeds += out[0].shape[0]
+                if not (np.array_equal(ref[1], out[1]) and
+                        np.allclose(ref[0], out[0], rtol=1e-6, atol=1e-4)):
+                    print 'MISMATCH at thresh {} ({} head)'.format(thresh,
+                                                                   head)
+                    sys.exit(1)
+            print '{:7.2f} {:>6s} {:8d} {:12.2f} {:12.2f} {:7.1f}x'.format(
+                thresh, head, num_seeds / args.iters,
+                timers['loop'].average_time * 1000,
+                timers['batched'].average_time * 1000,
+                timers['loop'].average_time / timers['batched'].average_time)
+    print 'batched boxes match the loop'
+
+    # the boxcls test mode with proposals off
+    cfg.TEST.HAS_RPN = False
+    im = np.random.randint(0, 256, (375, 500, 3)).astype(np.uint8)
+    maps = _synthetic_maps(args.height, args.width, num_classes, 1, S)
+    scores, boxes, classes = im_detect_boxcls(net=BoxclsNet(maps), im=im,
+                                              bucketizer=bucketizer)
+    pred_boxes, pred_classes = box_prediction(*(maps + (bucketizer,)))
+    im_scale = float(cfg.TEST.SCALES[0]) / min(im.shape[:2])
+    if np.round(im_scale * max(im.shape[:2])) > cfg.TEST.MAX_SIZE:
+        im_scale = float(cfg.TEST.MAX_SIZE) / max(im.shape[:2])
+    if not (np.array_equal(classes, pred_classes) and
+            np.array_equal(scores, pred_boxes[:, 0]) and
+            np.allclose(boxes, clip_boxes(pred_boxes[:, 1:5] / im_scale,
+                                          im.shape))):
+        print 'MISMATCH in im_detect_boxcls with TEST.HAS_RPN off'
+        sys.exit(1)
+    print 'im_detect_boxcls runs with TEST.HAS_RPN off'
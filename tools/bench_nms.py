@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""Benchmark the CPU NMS implementations (cpu_nms, cpu_nms_bitmask and
+py_cpu_nms) on RPN-like proposals over a range of box counts. The bitmask
+keep list is checked against cpu_nms.
+
+Then time the cfg.TEST.NMS_MODE variants of multiclass_nms on per-image
+detections of several classes: Soft-NMS is checked against py_soft_nms, and
+every mode must stay within --max_slowdown of hard NMS."""
+
+import _init_paths
+from fast_rcnn.config import cfg
+from fast_rcnn.nms_wrapper import multiclass_nms, NMS_MODES, \
+    SOFT_NMS_METHODS
+from nms.cpu_nms import cpu_nms, cpu_nms_bitmask
+from nms.py_cpu_nms import py_cpu_nms, py_soft_nms
+from utils.timer import Timer
+import argparse
+import numpy as np
+import sys
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark CPU NMS')
+    parser.add_argument('--num', dest='num_boxes',
+                        help='comma separated box counts',
+                        default='300,1000,2000,6000,12000,20000', type=str)
+    parser.add_argument('--thresh', dest='thresh',
+                        help='comma separated NMS thresholds',
+                        default='0.3,0.7', type=str)
+    parser.add_argument('--iters', dest='iters', default=3, type=int)
+    parser.add_argument('--dets', dest='num_dets',
+                        help='comma separated detections per image '
+                        '(NMS modes)', default='1000,5000', type=str)
+    parser.add_argument('--classes', dest='num_classes', default=20, type=int)
+    parser.add_argument('--max_slowdown', dest='max_slowdown',
+                        help='fail if a mode is slower than hard NMS by more',
+                        default=4.0, type=float)
+
+    args = parser.parse_args()
+    return args
+
+def _synthetic_proposals(num_boxes, im_w=1000, im_h=600):
+    """Clustered boxes of RPN-like scales, scored higher near the centers."""
+    centers = np.random.rand(max(num_boxes / 50, 1), 2) * [im_w, im_h]
+    inds = np.random.randint(0, centers.shape[0], num_boxes)
+    ctr = centers[inds] + np.random.randn(num_boxes, 2) * 30
+    size = 2 ** np.random.uniform(4, 9, (num_boxes, 1)) * \
+        np.sqrt(np.random.choice([0.5, 1, 2], (num_boxes, 1)) ** [1, -1])
+    boxes = np.hstack((ctr - size / 2, ctr + size / 2))
+    boxes[:, 0::2] = np.clip(boxes[:, 0::2], 0, im_w - 1)
+    boxes[:, 1::2] = np.clip(boxes[:, 1::2], 0, im_h - 1)
+    scores = np.random.rand(num_boxes, 1)
+    return np.hstack((boxes, scores)).astype(np.float32)
+
+if __name__ == '__main__':
+    args = parse_args()
+    np.random.seed(cfg.RNG_SEED)
+    methods = [('cpu_nms', cpu_nms), ('bitmask', cpu_nms_bitmask),
+               ('py_cpu_nms', py_cpu_nms)]
+
+    print '{:>6s} {:>6s} {:>6s} {:>12s} {:>12s} {:>12s} {:>8s}'.format(
+        'boxes', 'thresh', 'kept', 'cpu_nms (ms)', 'bitmask (ms)',
+        'python (ms)', 'speedup')
+    for num_boxes in [int(n) for n in args.num_boxes.split(',')]:
+        for thresh in [float(t) for t in args.thresh.split(',')]:
+            timers = dict((name, Timer()) for name, _ in methods)
+            for it in xrange(args.iters):
+                dets = _synthetic_proposals(num_boxes)
+                keeps = {}
+                for name, method in methods:
+                    timers[name].tic()
+                    keeps[name] = method(dets, thresh)
+                    timers[name].toc()
+                if list(keeps['bitmask']) != list(keeps['cpu_nms']):
+                    print 'MISMATCH at {} boxes, thresh {}'.format(
+                        num_boxes, thresh)
+                    sys.exit(1)
+            times = [timers[name].average_time for name, _ in methods]
+            print '{:6d} {:6.2f} {:6d} {:12.1f} {:12.1f} {:12.1f} {:7.2f}x' \
+                .format(num_boxes, thresh, len(keeps['cpu_nms']),
+                        times[0] * 1000, times[1] * 1000, times[2] * 1000,
+                        times[0] / times[1])
+    print 'cpu_nms_bitmask matches cpu_nms'
+    print
+
+    print '{:>6s} {:>9s} {:>6s} {:>10s} {:>10s} {:>8s}'.format(
+        'dets', 'mode', 'kept', 'ms/image', 'images/s', 'vs hard')
+    slow = []
+    for num_dets in [int(n) for n in args.num_dets.split(',')]:
+        # untimed: the first multiclass_nms call may run the NMS backend
+        # calibration (cfg.NMS_BACKEND 'auto'), which must not land in
+        # hard_time
+        dets = _synthetic_proposals(num_dets)
+        classes = np.random.randint(1, args.num_classes + 1, num_dets)
+        for mode in NMS_MODES:
+            multiclass_nms(dets, classes, cfg.TEST.NMS, mode=mode)
+        hard_time = None
+        for mode in NMS_MODES:
+            timer = Timer()
+            for it in xrange(args.iters):
+                dets = _synthetic_proposals(num_dets)
+                classes = np.random.randint(1, args.num_classes + 1, num_dets)
+                timer.tic()
+                keep, out = multiclass_nms(dets, classes, cfg.TEST.NMS,
+                                           mode=mode)
+                timer.toc()
+                if mode in SOFT_NMS_METHODS:
+                    # a class at random against the Python baseline
+                    j = classes[0]
+                    inds = np.where(classes == j)[0]
+                    ref_keep, ref_scores = py_soft_nms(
+                        dets[inds], cfg.TEST.NMS, SOFT_NMS_METHODS[mode],
+                        cfg.TEST.SOFT_NMS_SIGMA, cfg.TEST.SOFT_NMS_MIN_SCORE)
+                    cls_keep = keep[classes[keep] == j]
+                    if sorted(inds[ref_keep]) != sorted(cls_keep) or \
+                            not np.allclose(np.sort(ref_scores),
+                                            np.sort(out[cls_keep, 4]),
+                                            atol=1e-5):
+                        print 'MISMATCH with py_soft_nms ({})'.format(mode)
+                        sys.exit(1)
+            if hard_time is None:
+                hard_time = timer.average_time
+            slowdown = timer.average_time / hard_time
+            if slowdown > args.max_slowdown:
+                slow.append((num_dets, mode))
+            print '{:6d} {:>9s} {:6d} {:10.2f} {:10.1f} {:7.2f}x'.format(
+                num_dets, mode, len(keep), timer.average_time * 1000,
+                1. / timer.average_time, slowdown)
+    if len(slow) > 0:
+        print 'slower than {}x hard NMS: {}'.format(args.max_slowdown, slow)
+        sys.exit(1)
+    print 'Soft-NMS matches py_soft_nms, all modes within {}x of hard NMS' \
+        .format(args.max_slowdown)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""Benchmark box overlaps as AnchorTargetLayer uses them: row argmax/max,
+column argmax/max and the rows tying a column maximum. cython_bbox's dense
+float64 matrix followed by NumPy reductions is compared with
+cython_overlaps.bbox_overlaps_max in float64 and float32; the float64
+results must match exactly.
+
+Then bbox_overlaps_max is run with num_threads=1 in a forked child of this
+process, which has already run it with the OpenMP maximum, as the prefetch
+workers do; it must return the same results instead of hanging."""
+
+import _init_paths
+from fast_rcnn.config import cfg
+from rpn.generate_anchors import generate_anchors
+from utils.cython_bbox import bbox_overlaps
+from utils.cython_overlaps import bbox_overlaps_max
+from utils.timer import Timer
+from multiprocessing import Process, Queue
+from Queue import Empty
+import argparse
+import numpy as np
+import sys
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark box overlaps')
+    parser.add_argument('--gt', dest='num_gt',
+                        help='comma separated gt box counts',
+                        default='2,8,32,128', type=str)
+    parser.add_argument('--height', dest='height', default=38, type=int)
+    parser.add_argument('--width', dest='width', default=63, type=int)
+    parser.add_argument('--iters', dest='iters', default=10, type=int)
+    parser.add_argument('--fork_timeout', dest='fork_timeout',
+                        help='seconds to wait for the forked child',
+                        default=60, type=float)
+
+    args = parser.parse_args()
+    return args
+
+def dense_reductions(anchors, gt_boxes):
+    """The reductions AnchorTargetLayer takes from the dense matrix."""
+    overlaps = bbox_overlaps(anchors, gt_boxes)
+    argmax_overlaps = overlaps.argmax(axis=1)
+    max_overlaps = overlaps[np.arange(overlaps.shape[0]), argmax_overlaps]
+    gt_argmax_overlaps = overlaps.argmax(axis=0)
+    gt_max_overlaps = overlaps[gt_argmax_overlaps,
+                               np.arange(overlaps.shape[1])]
+    ties = np.where(overlaps == gt_max_overlaps)[0]
+    return argmax_overlaps, max_overlaps, gt_argmax_overlaps, \
+        gt_max_overlaps, np.unique(ties)
+
+def _forked_max(anchors, gt_boxes, queue):
+    queue.put(bbox_overlaps_max(anchors, gt_boxes, return_ties=True,
+                                num_threads=1))
+
+if __name__ == '__main__':
+    args = parse_args()
+    np.random.seed(cfg.RNG_SEED)
+
+    # all anchors of a feature map, as AnchorTargetLayer sees them
+    feat_stride = 16
+    base = generate_anchors()
+    shift_x, shift_y = np.meshgrid(np.arange(args.width) * feat_stride,
+                                   np.arange(args.height) * feat_stride)
+    shifts = np.vstack((shift_x.ravel(), shift_y.ravel(),
+                        shift_x.ravel(), shift_y.ravel())).transpose()
+    anchors = (base[np.newaxis] + shifts[:, np.newaxis]).reshape((-1, 4))
+    anchors = np.ascontiguousarray(anchors, dtype=np.float)
+    im_w, im_h = args.width * feat_stride, args.height * feat_stride
+
+    print '{} anchors'.format(anchors.shape[0])
+    print '{:>5s} {:>11s} {:>13s} {:>13s} {:>8s}'.format(
+        'gt', 'dense (ms)', 'max f64 (ms)', 'max f32 (ms)', 'speedup')
+    for num_gt in [int(g) for g in args.num_gt.split(',')]:
+        timers = {'dense': Timer(), 'f64': Timer(), 'f32': Timer()}
+        for it in xrange(args.iters):
+            x1 = np.random.rand(num_gt) * im_w * 0.8
+            y1 = np.random.rand(num_gt) * im_h * 0.8
+            gt_boxes = np.vstack(
+                (x1, y1, x1 + 16 + np.random.rand(num_gt) * im_w * 0.5,
+                 y1 + 16 + np.random.rand(num_gt) * im_h * 0.5)).transpose()
+            timers['dense'].tic()
+            ref = dense_reductions(anchors, gt_boxes)
+            timers['dense'].toc()
+            timers['f64'].tic()
+            res = bbox_overlaps_max(anchors, gt_boxes, return_ties=True)
+            timers['f64'].toc()
+            anchors32 = anchors.astype(np.float32)
+            timers['f32'].tic()
+            bbox_overlaps_max(anchors32, gt_boxes, return_ties=True)
+            timers['f32'].toc()
+            for a, b in zip(ref, res):
+                if not np.array_equal(a, b):
+                    print 'MISMATCH with {} gt boxes'.format(num_gt)
+                    sys.exit(1)
+        times = [timers[k].average_time * 1000 for k in ('dense', 'f64', 'f32')]
+        print '{:5d} {:11.2f} {:13.2f} {:13.2f} {:7.2f}x'.format(
+            num_gt, times[0], times[1], times[2], times[0] / times[1])
+    print 'bbox_overlaps_max matches the dense reductions'
+
+    queue = Queue()
+    child = Process(target=_forked_max, args=(anchors, gt_boxes, queue))
+    child.start()
+    try:
+        res = queue.get(timeout=args.fork_timeout)
+    except Empty:
+        print 'HUNG: bbox_overlaps_max in a forked child'
+        child.terminate()
+        sys.exit(1)
+    child.join()
+    for a, b in zip(ref, res):
+        if not np.array_equal(a, b):
+            print 'MISMATCH in the forked child'
+            sys.exit(1)
+    print 'bbox_overlaps_max with num_threads=1 runs in a forked child'
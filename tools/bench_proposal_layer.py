@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""Benchmark ProposalLayer per stage at the TRAIN and TEST settings.
+
+The layer takes the top RPN_PRE_NMS_TOP_N scores with argpartition and
+decodes only those; the reference decodes and size-filters every anchor and
+argsorts all scores, as the layer used to. Stage times come from the layer's
+stage_hook; RoIs and scores must match the reference exactly (the synthetic
+scores have no ties)."""
+
+import _init_paths
+from fast_rcnn.config import cfg
+from fast_rcnn.nms_wrapper import nms
+from rpn.anchor_grid import anchor_grids
+from rpn.proposal_layer import ProposalLayer, STAGES
+from utils.cython_bbox import bbox_transform_inv_clip_filter
+from utils.timer import Timer, StageTimers
+import argparse
+import numpy as np
+import sys
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark ProposalLayer')
+    parser.add_argument('--height', dest='height', default=38, type=int)
+    parser.add_argument('--width', dest='width', default=63, type=int)
+    parser.add_argument('--iters', dest='iters', default=10, type=int)
+
+    args = parser.parse_args()
+    return args
+
+class Blob(object):
+    """The parts of a caffe blob the layer uses."""
+    def __init__(self, data=None):
+        self.data = data if data is not None else \
+            np.zeros((1,), dtype=np.float32)
+
+    def reshape(self, *shape):
+        self.data = np.zeros(shape, dtype=np.float32)
+
+def reference_forward(bottom, num_anchors, cfg_key, timer):
+    """Decode and filter all anchors, then argsort all scores."""
+    c = cfg[cfg_key]
+    scores = bottom[0].data[:, num_anchors:, :, :]
+    height, width = scores.shape[-2:]
+    im_info = bottom[2].data[0, :]
+    timer.tic()
+    anchors = anchor_grids.anchors(height, width, 16)
+    deltas = bottom[1].data.transpose((0, 2, 3, 1)).reshape((-1, 4))
+    scores = scores.transpose((0, 2, 3, 1)).reshape((-1, 1))
+    proposals, keep = bbox_transform_inv_clip_filter(
+        anchors, deltas, im_info[:2], c.RPN_MIN_SIZE * im_info[2])
+    scores = scores[keep]
+    order = scores.ravel().argsort()[::-1]
+    if c.RPN_PRE_NMS_TOP_N > 0:
+        order = order[:c.RPN_PRE_NMS_TOP_N]
+    dets = np.hstack((proposals[order, :], scores[order]))
+    timer.toc()
+    keep = nms(dets, c.RPN_NMS_THRESH)
+    if c.RPN_POST_NMS_TOP_N > 0:
+        keep = keep[:c.RPN_POST_NMS_TOP_N]
+    return dets[keep, :4], dets[keep, 4:5]
+
+if __name__ == '__main__':
+    args = parse_args()
+    np.random.seed(cfg.RNG_SEED)
+    A = 9
+    count = A * args.height * args.width
+    print '{:>6s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s}'.format(
+        'phase', 'topN', 'ref pre', 'topk', 'decode', 'nms')
+    for phase, cfg_key in enumerate(('TRAIN', 'TEST')):
+        layer = ProposalLayer()
+        layer.param_str = "{'feat_stride': 16}"
+        layer.phase = phase
+        layer.stage_hook = StageTimers()
+        top = [Blob(), Blob()]
+        ref_timer = Timer()
+        for it in xrange(args.iters):
+            fg = np.random.permutation(count).astype(np.float32) / count
+            scores = np.concatenate((1 - fg, fg)).reshape(
+                (1, 2 * A, args.height, args.width))
+            bottom = [Blob(scores),
+                      Blob((np.random.randn(1, 4 * A, args.height,
+                                            args.width) * 0.3)
+                           .astype(np.float32)),
+                      Blob(np.array([[args.height * 16, args.width * 16,
+                                      1.6]], dtype=np.float32))]
+            if it == 0:
+                layer.setup(bottom, top)
+            layer.forward(bottom, top)
+            rois, roi_scores = reference_forward(bottom, A, cfg_key,
+                                                 ref_timer)
+            if not np.array_equal(top[0].data[:, 1:], rois) or \
+                    not np.array_equal(top[1].data, roi_scores):
+                print 'MISMATCH at {}'.format(cfg_key)
+                sys.exit(1)
+        stages = layer.stage_hook
+        print '{:>6s} {:8d} {:10.3f} {:10.3f} {:10.3f} {:10.3f}'.format(
+            cfg_key, cfg[cfg_key].RPN_PRE_NMS_TOP_N,
+            ref_timer.average_time * 1000,
+            stages.average_time('topk') * 1000,
+            stages.average_time('decode') * 1000,
+            stages.average_time('nms') * 1000)
+        print '       {}'.format(stages.summary(STAGES))
+    print 'times in ms; ref pre = decode, filter and full sort of the ' \
+        'reference; outputs match the reference'
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""Benchmark the NumPy PSROIPooling (RoIs/sec for forward and backward)
+against group_size and output_dim. Forward is checked against a per-bin
+loop of the CUDA kernel and backward against forward with the adjoint
+identity <forward(x), u> == <x, backward(u)>."""
+
+import _init_paths
+from fast_rcnn.config import cfg
+from roi_data_layer.psroi_pooling import psroi_bins, psroi_pooling_forward, \
+    psroi_pooling_backward
+from utils.timer import Timer
+import argparse
+import numpy as np
+import sys
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark PSROIPooling')
+    parser.add_argument('--group_size', dest='group_size',
+                        help='comma separated group sizes',
+                        default='3,5,7', type=str)
+    parser.add_argument('--output_dim', dest='output_dim',
+                        help='comma separated output dims',
+                        default='8,21', type=str)
+    parser.add_argument('--rois', dest='num_rois', default=300, type=int)
+    parser.add_argument('--iters', dest='iters', default=3, type=int)
+    parser.add_argument('--height', dest='height', default=38, type=int)
+    parser.add_argument('--width', dest='width', default=63, type=int)
+
+    args = parser.parse_args()
+    return args
+
+def _synthetic_rois(num_rois, height, width, spatial_scale):
+    im_w = width / spatial_scale
+    im_h = height / spatial_scale
+    x1 = np.random.rand(num_rois) * im_w * 0.8
+    y1 = np.random.rand(num_rois) * im_h * 0.8
+    x2 = np.minimum(x1 + np.random.rand(num_rois) * im_w * 0.6, im_w - 1)
+    y2 = np.minimum(y1 + np.random.rand(num_rois) * im_h * 0.6, im_h - 1)
+    return np.vstack((np.zeros(num_rois), x1, y1, x2, y2)).transpose() \
+        .astype(np.float32)
+
+def loop_forward(data, rois, spatial_scale, output_dim, group_size):
+    """One bin at a time, as the CUDA kernel pools."""
+    batch_inds, hstart, hend, wstart, wend = psroi_bins(
+        rois, spatial_scale, group_size, data.shape[2], data.shape[3])
+    out = np.zeros((rois.shape[0], output_dim, group_size, group_size),
+                   dtype=np.float32)
+    for n in xrange(rois.shape[0]):
+        for d in xrange(output_dim):
+            for ph in xrange(group_size):
+                for pw in xrange(group_size):
+                    c = (d * group_size + ph) * group_size + pw
+                    bin_data = data[batch_inds[n], c,
+                                    hstart[n, ph]:hend[n, ph],
+                                    wstart[n, pw]:wend[n, pw]]
+                    if bin_data.size > 0:
+                        out[n, d, ph, pw] = bin_data.sum(dtype=np.float64) / \
+                            bin_data.size
+    return out
+
+if __name__ == '__main__':
+    args = parse_args()
+    np.random.seed(cfg.RNG_SEED)
+    spatial_scale = cfg.TRAIN.spatial_scale
+
+    print '{:>5s} {:>5s} {:>14s} {:>14s} {:>14s}'.format(
+        'group', 'dim', 'fwd (RoIs/s)', 'bwd (RoIs/s)', 'loop (RoIs/s)')
+    for group_size in [int(g) for g in args.group_size.split(',')]:
+        for output_dim in [int(d) for d in args.output_dim.split(',')]:
+            timers = {'fwd': Timer(), 'bwd': Timer(), 'loop': Timer()}
+            channels = output_dim * group_size * group_size
+            for it in xrange(args.iters):
+                data = np.random.rand(1, channels, args.height, args.width) \
+                    .astype(np.float32)
+                rois = _synthetic_rois(args.num_rois, args.height, args.width,
+                                       spatial_scale)
+                timers['fwd'].tic()
+                out = psroi_pooling_forward(data, rois, spatial_scale,
+                                            output_dim, group_size)
+                timers['fwd'].toc()
+                top_diff = np.random.rand(*out.shape).astype(np.float32)
+                timers['bwd'].tic()
+                grad = psroi_pooling_backward(top_diff, rois, data.shape,
+                                              spatial_scale, output_dim,
+                                              group_size)
+                timers['bwd'].toc()
+                # the per-bin loop is slow; time it on a few RoIs
+                timers['loop'].tic()
+                ref = loop_forward(data, rois[:10], spatial_scale,
+                                   output_dim, group_size)
+                timers['loop'].toc()
+                lhs = np.vdot(out.astype(np.float64), top_diff)
+                rhs = np.vdot(data.astype(np.float64), grad)
+                if not np.allclose(ref, out[:10], rtol=1e-5, atol=1e-5) or \
+                        not np.isclose(lhs, rhs, rtol=1e-5):
+                    print 'MISMATCH at group_size {} output_dim {}'.format(
+                        group_size, output_dim)
+                    sys.exit(1)
+            print '{:5d} {:5d} {:14.0f} {:14.0f} {:14.0f}'.format(
+                group_size, output_dim,
+                args.num_rois / timers['fwd'].average_time,
+                args.num_rois / timers['bwd'].average_time,
+                10 / timers['loop'].average_time)
+    print 'forward matches the per-bin loop, backward is its adjoint'
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""Benchmark the batched seed-point label engine (labels and region weights)
+against the per-seed loop that rfcn_anno_layer used to run, and check that
+both agree bit for bit."""
+
+import _init_paths
+from fast_rcnn.config import cfg
+from roi_data_layer.region_bucketizer import RegionBucketizer
+from roi_data_layer.seed_labels import select_seeds, seed_distances, \
+    seed_box_labels, half_plane_masks, seed_region_weights
+from utils.timer import Timer
+import argparse
+import numpy as np
+import sys
+
+# region weight chunk sizes checked besides cfg.TRAIN.region_weights_chunk
+SMALL_CHUNKS = (7, 1000)
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark seed labels')
+    parser.add_argument('--rois', dest='num_rois',
+                        help='comma separated RoI counts',
+                        default='16,32,64,128,256', type=str)
+    parser.add_argument('--iters', dest='iters',
+                        help='iterations per RoI count',
+                        default=5, type=int)
+    parser.add_argument('--height', dest='height', default=38, type=int)
+    parser.add_argument('--width', dest='width', default=63, type=int)
+
+    args = parser.parse_args()
+    return args
+
+def _synthetic_inputs(num_rois, height, width, num_classes, roi_scale):
+    conf = np.random.rand(1, height, width, 7, 7, num_classes) \
+        .astype(np.float32)
+    feat = np.random.rand(1, cfg.TRAIN.num_rfcn_regions *
+                          cfg.TRAIN.num_features, height, width) \
+        .astype(np.float32)
+    im_w = width / roi_scale
+    im_h = height / roi_scale
+    x1 = np.random.rand(num_rois) * im_w * 0.7
+    y1 = np.random.rand(num_rois) * im_h * 0.7
+    x2 = np.minimum(x1 + 32 + np.random.rand(num_rois) * im_w * 0.5, im_w - 1)
+    y2 = np.minimum(y1 + 32 + np.random.rand(num_rois) * im_h * 0.5, im_h - 1)
+    cls = np.random.randint(1, num_classes, size=num_rois)
+    rois = np.vstack((x1, y1, x2, y2, cls)).transpose().astype(np.float32)
+    S = int(np.sqrt(cfg.TRAIN.num_regions))
+    bound_w = np.hstack((0, np.sort(np.random.rand(S / 2)) * im_w * 0.6))
+    bound_h = np.hstack((0, np.sort(np.random.rand(S / 2)) * im_h * 0.6))
+    offsets = np.random.randint(-12, 13, size=(num_classes, cfg.TRAIN.num_regions *
+                                               cfg.TRAIN.num_samples, 2))
+    return conf, feat, rois, bound_w, bound_h, offsets.astype(np.float64)
+
+def _outputs(num_rois, num_classes_box):
+    N = num_rois * cfg.TRAIN.M
+    S = int(np.sqrt(cfg.TRAIN.num_regions))
+    return {'seed_points': np.zeros((N, 2)),
+            'seed_points_feat': np.zeros((N, cfg.TRAIN.num_features)),
+            'bbox_cls_labels':
+                np.zeros((N, num_classes_box * cfg.TRAIN.num_regions)),
+            'bbox_cls_inweights':
+                np.zeros((N, num_classes_box * cfg.TRAIN.num_regions)),
+            'bbox_reg_labels': np.zeros((N, num_classes_box * S * 2)),
+            'bbox_inweights': np.zeros((N, num_classes_box * S * 2)),
+            'rfcn_region_weights':
+                np.zeros((N, cfg.TRAIN.num_regions * cfg.TRAIN.num_samples,
+                          cfg.TRAIN.num_rfcn_regions))}
+
+def loop_labels(rfcn_conf, rfcn_feat, rois, roi_scale, bound_x, bound_y,
+                offsets, num_classes_box):
+    """The per-RoI, per-seed labelling loop of rfcn_anno_layer."""
+    M = cfg.TRAIN.M
+    num_regions = cfg.TRAIN.num_regions
+    S = int(np.sqrt(num_regions))
+    out = _outputs(rois.shape[0], num_classes_box)
+    for nroi in xrange(rois.shape[0]):
+        roi_x1 = rois[nroi, 0] * roi_scale
+        roi_y1 = rois[nroi, 1] * roi_scale
+        roi_x2 = rois[nroi, 2] * roi_scale
+        roi_y2 = rois[nroi, 3] * roi_scale
+        roi_class = int(rois[nroi, 4])
+        conf_in_roi = rfcn_conf[0, int(np.ceil(roi_y1)):int(np.floor(roi_y2)) + 1,
+                                int(np.ceil(roi_x1)):int(np.floor(roi_x2)) + 1,
+                                :, :, roi_class]
+        conf_in_roi = conf_in_roi.reshape((conf_in_roi.shape[0],
+                                           conf_in_roi.shape[1],
+                                           cfg.TRAIN.num_rfcn_regions))
+        max_conf = np.max(conf_in_roi, axis=2).reshape(
+            (conf_in_roi.shape[0] * conf_in_roi.shape[1]))
+        seed_inds = np.argsort(max_conf)[-M:]
+        for m in xrange(np.minimum(M, seed_inds.shape[0])):
+            row = nroi * M + m
+            sx_in = seed_inds[m] % conf_in_roi.shape[1]
+            sy_in = seed_inds[m] / conf_in_roi.shape[1]
+            seed_x = sx_in + np.ceil(roi_x1)
+            seed_y = sy_in + np.ceil(roi_y1)
+            region = np.argmax(conf_in_roi[sy_in, sx_in, :])
+            out['seed_points'][row, 0] = seed_x
+            out['seed_points'][row, 1] = seed_y
+            out['seed_points_feat'][row, :] = rfcn_feat[
+                0, region * cfg.TRAIN.num_features:
+                (region + 1) * cfg.TRAIN.num_features,
+                int(seed_y), int(seed_x)]
+            for idx in xrange(offsets.shape[1]):
+                sampled_x = seed_x + offsets[roi_class, idx, 0]
+                sampled_y = seed_y + offsets[roi_class, idx, 1]
+                if sampled_x >= 0 and sampled_x < rfcn_conf.shape[2] and \
+                        sampled_y >= 0 and sampled_y < rfcn_conf.shape[1]:
+                    weights = rfcn_conf[0, int(sampled_y), int(sampled_x),
+                                        :, :, roi_class].copy()
+                    if offsets[roi_class, idx, 0] > 0:
+                        weights[:, 0:sx_in] = 0.0
+                    else:
+                        weights[:, sx_in + 1:] = 0.0
+                    if offsets[roi_class, idx, 1] > 0:
+                        weights[0:sy_in, :] = 0.0
+                    else:
+                        weights[sy_in + 1:, :] = 0.0
+                    out['rfcn_region_weights'][row, idx, :] = \
+                        weights.reshape((cfg.TRAIN.num_rfcn_regions))
+            if num_classes_box == 1:
+                c = 0
+            else:
+                c = roi_class - 1
+            top = (seed_y - roi_y1) / roi_scale
+            left = (seed_x - roi_x1) / roi_scale
+            bottom = (-seed_y + roi_y2) / roi_scale
+            right = (-seed_x + roi_x2) / roi_scale
+            out['bbox_cls_inweights'][row, c * num_regions:
+                                      (c + 1) * num_regions] = \
+                1.0 / np.minimum(M, seed_inds.shape[0])
+            lab = out['bbox_cls_labels']
+            reg = out['bbox_reg_labels']
+            inw = out['bbox_inweights']
+            for i in xrange(S / 2):
+                if bound_x[i] < left and left < bound_x[1 + i]:
+                    x_ind = S / 2 - i - 1
+                    for j in xrange(S / 2):
+                        if bound_y[j] < top:
+                            lab[row, c * num_regions + (S / 2 - j - 1) * S + x_ind] = 1
+                        if bound_y[j] < bottom:
+                            lab[row, c * num_regions + (S / 2 + j) * S + x_ind] = 1
+                    reg[row, c * S * 2 + x_ind] = (bound_x[1 + i] - left) / \
+                        (bound_x[1 + i] - bound_x[i]) - 0.5
+                    inw[row, c * S * 2 + x_ind] = 1
+                if bound_x[i] < right and right < bound_x[1 + i]:
+                    x_ind = S / 2 + i
+                    for j in xrange(S / 2):
+                        if bound_x[j] < top:
+                            lab[row, c * num_regions + (S / 2 - j - 1) * S + x_ind] = 1
+                        if bound_x[j] < bottom:
+                            lab[row, c * num_regions + (S / 2 + j) * S + x_ind] = 1
+                    reg[row, c * S * 2 + x_ind] = (bound_x[1 + i] - right) / \
+                        (bound_x[1 + i] - bound_x[i]) - 0.5
+                    inw[row, c * S * 2 + x_ind] = 1
+            for i in xrange(S / 2):
+                if bound_y[i] < top and top < bound_y[1 + i]:
+                    y_ind = S / 2 - i - 1
+                    for j in xrange(S / 2):
+                        if bound_x[j] < left:
+                            lab[row, c * num_regions + y_ind * S + S / 2 - j - 1] = 1
+                        if bound_x[j] < right:
+                            lab[row, c * num_regions + y_ind * S + S / 2 + j] = 1
+                    reg[row, c * S * 2 + S + y_ind] = (bound_y[1 + i] - top) / \
+                        (bound_y[1 + i] - bound_y[i]) - 0.5
+                    inw[row, c * S * 2 + S + y_ind] = 1
+                if bound_y[i] < bottom and bottom < bound_y[1 + i]:
+                    y_ind = S / 2 + i
+                    for j in xrange(S / 2):
+                        if bound_x[j] < left:
+                            lab[row, c * num_regions + y_ind * S + S / 2 - j - 1] = 1
+                        if bound_x[j] < right:
+                            lab[row, c * num_regions + y_ind * S + S / 2 + j] = 1
+                    reg[row, c * S * 2 + S + y_ind] = (bound_y[1 + i] - bottom) / \
+                        (bound_y[1 + i] - bound_y[i]) - 0.5
+                    inw[row, c * S * 2 + S + y_ind] = 1
+    return out
+
+def batched_labels(rfcn_conf, rfcn_feat, rois, roi_scale, bound_x, bound_y,
+                   offsets, num_classes_box, chunk_size=None):
+    """Same outputs as loop_labels, computed with roi_data_layer.seed_labels,
+    gathering region weights chunk_size pairs at a time (default
+    cfg.TRAIN.region_weights_chunk)."""
+    if chunk_size is None:
+        chunk_size = cfg.TRAIN.region_weights_chunk
+    num_regions = cfg.TRAIN.num_regions
+    S = int(np.sqrt(num_regions))
+    out = _outputs(rois.shape[0], num_classes_box)
+    conf = rfcn_conf[0].reshape(rfcn_conf.shape[1:3] +
+                                (cfg.TRAIN.num_rfcn_regions, -1))
+    seeds = select_seeds(conf, rois, cfg.TRAIN.M, roi_scale)
+    rows = seeds['rows']
+    out['seed_points'][rows, 0] = seeds['x']
+    out['seed_points'][rows, 1] = seeds['y']
+    feat = rfcn_feat[0].reshape((cfg.TRAIN.num_rfcn_regions,
+                                 cfg.TRAIN.num_features) + rfcn_feat.shape[2:])
+    out['seed_points_feat'][rows, :] = feat[seeds['regions'], :,
+                                            seeds['y'].astype(np.int),
+                                            seeds['x'].astype(np.int)]
+    classes = rois[seeds['roi_inds'], 4].astype(np.int)
+    seed_region_weights(conf, seeds, classes, offsets,
+                        half_plane_masks(np.sqrt(cfg.TRAIN.num_rfcn_regions)),
+                        out['rfcn_region_weights'], chunk_size)
+    if num_classes_box == 1:
+        c = np.zeros(rows.shape[0], dtype=np.int)
+    else:
+        c = classes - 1
+    cls_labels, reg_labels, reg_weights = seed_box_labels(
+        *(seed_distances(seeds, roi_scale) +
+          (RegionBucketizer(bound_x, bound_y, S), classes)))
+    cls_cols = c[:, np.newaxis] * num_regions + np.arange(num_regions)
+    reg_cols = c[:, np.newaxis] * S * 2 + np.arange(S * 2)
+    out['bbox_cls_labels'][rows[:, np.newaxis], cls_cols] = cls_labels
+    out['bbox_cls_inweights'][rows[:, np.newaxis], cls_cols] = \
+        1.0 / seeds['num_in_roi'][:, np.newaxis]
+    out['bbox_reg_labels'][rows[:, np.newaxis], reg_cols] = reg_labels
+    out['bbox_inweights'][rows[:, np.newaxis], reg_cols] = reg_weights
+    return out
+
+if __name__ == '__main__':
+    args = parse_args()
+    np.random.seed(cfg.RNG_SEED)
+    roi_scale = cfg.TRAIN.spatial_scale
+    num_classes = cfg.TRAIN.num_classes
+
+    print '{:>6s} {:>12s} {:>12s} {:>8s}'.format(
+        'rois', 'loop (ms)', 'batched (ms)', 'speedup')
+    for num_rois in [int(n) for n in args.num_rois.split(',')]:
+        timers = {'loop': Timer(), 'batched': Timer()}
+        for it in xrange(args.iters):
+            inputs = _synthetic_inputs(num_rois, args.height, args.width,
+                                       num_classes, roi_scale)
+            for num_classes_box in (1, num_classes - 1):
+                timers['loop'].tic()
+                ref = loop_labels(*(inputs[:2] + (inputs[2], roi_scale) +
+                                    inputs[3:] + (num_classes_box,)))
+                timers['loop'].toc()
+                timers['batched'].tic()
+                out = batched_labels(*(inputs[:2] + (inputs[2], roi_scale) +
+                                       inputs[3:] + (num_classes_box,)))
+                timers['batched'].toc()
+                outs = [(cfg.TRAIN.region_weights_chunk, out)]
+                # untimed: small chunks that leave a partial last chunk
+                for chunk_size in SMALL_CHUNKS:
+                    outs.append((chunk_size, batched_labels(
+                        *(inputs[:2] + (inputs[2], roi_scale) + inputs[3:] +
+                          (num_classes_box, chunk_size)))))
+                for chunk_size, out in outs:
+                    for k in ref:
+                        if not np.array_equal(ref[k], out[k]):
+                            print 'MISMATCH in {} at {} RoIs, chunk size ' \
+                                '{}'.format(k, num_rois, chunk_size)
+                            sys.exit(1)
+        print '{:6d} {:12.2f} {:12.2f} {:7.1f}x'.format(
+            num_rois, timers['loop'].average_time * 1000,
+            timers['batched'].average_time * 1000,
+            timers['loop'].average_time / timers['batched'].average_time)
+    print 'batched outputs are bit-exact with the loop, for chunk sizes ' \
+        '{}'.format((cfg.TRAIN.region_weights_chunk,) + SMALL_CHUNKS)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Ross Girshick
+# --------------------------------------------------------
+
+"""Pack an imdb, its roidb and its images resized for TRAIN.SCALES into
+memory-mapped shards (see datasets.packed_dataset).
+
+Train on the result with --imdb packed:<output directory>, using the same
+TRAIN.SCALES, TRAIN.MAX_SIZE and TRAIN.PROPOSAL_METHOD."""
+
+import _init_paths
+from fast_rcnn.config import cfg, cfg_from_file, cfg_from_list
+from datasets.factory import get_imdb
+from datasets.packed_dataset import pack_imdb
+from utils.timer import Timer
+import argparse
+import pprint
+import sys
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Pack a dataset')
+    parser.add_argument('--imdb', dest='imdb_name',
+                        help='dataset to pack',
+                        default='voc_2007_trainval', type=str)
+    parser.add_argument('--output', dest='output_dir',
+                        help='directory to write the packed dataset to',
+                        required=True, type=str)
+    parser.add_argument('--shard_size', dest='images_per_shard',
+                        help='images per image shard file',
+                        default=1000, type=int)
+    parser.add_argument('--cfg', dest='cfg_file',
+                        help='optional config file', default=None, type=str)
+    parser.add_argument('--set', dest='set_cfgs',
+                        help='set config keys', default=None,
+                        nargs=argparse.REMAINDER)
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args()
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    print('Called with args:')
+    print(args)
+
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+    if args.set_cfgs is not None:
+        cfg_from_list(args.set_cfgs)
+
+    print('Using config:')
+    pprint.pprint(cfg)
+
+    imdb = get_imdb(args.imdb_name)
+    imdb.set_proposal_method(cfg.TRAIN.PROPOSAL_METHOD)
+    print 'Packing `{:s}` ({:s} proposals) for scales {} into {:s}'.format(
+        imdb.name, cfg.TRAIN.PROPOSAL_METHOD, cfg.TRAIN.SCALES,
+        args.output_dir)
+    timer = Timer()
+    timer.tic()
+    pack_imdb(imdb, args.output_dir, args.images_per_shard)
+    timer.toc()
+    print 'Packed {:d} images in {:.1f}s'.format(imdb.num_images,
+                                                 timer.total_time)
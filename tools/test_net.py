@@ -51,6 +51,9 @@ def parse_args():
                         default=400, type=int)
     parser.add_argument('--rpn_file', dest='rpn_file',
                         default=None, type=str)
+    parser.add_argument('--mode', dest='mode',
+                        help='rcnn (proposal scoring) or boxcls (seed decoding)',
+                        default='rcnn', choices=['rcnn', 'boxcls'], type=str)
 
     if len(sys.argv) == 1:
         parser.print_help()
@@ -87,9 +90,10 @@ if __name__ == '__main__':
     imdb = get_imdb(args.imdb_name)
     imdb.competition_mode(args.comp_mode)
 
-    if not cfg.TEST.HAS_RPN:
+    if not cfg.TEST.HAS_RPN and args.mode == 'rcnn':
         imdb.set_proposal_method(cfg.TEST.PROPOSAL_METHOD)
         if cfg.TEST.PROPOSAL_METHOD == 'rpn':
             imdb.config['rpn_file'] = args.rpn_file
 
-    test_net(net, imdb, max_per_image=args.max_per_image, vis=args.vis)
+    test_net(net, imdb, max_per_image=args.max_per_image, vis=args.vis,
+             mode=args.mode)